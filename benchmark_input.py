@@ -0,0 +1,229 @@
+# -*- coding: UTF-8 -*-
+"""Benchmarks the run.py input pipeline on its own, without the model.
+
+For every thread count and batch size it reports examples/sec and bytes/sec
+of the full training input_fn, and the latency per batch up to each stage
+(read, batch, parse, cast) together with what each stage adds over the
+previous one, as JSON. Reads the records given by
+--train_input_file and uses run.py's flags for the record layout. The npy
+layout has no parse stages, so only its full input_fn is timed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+import time
+
+import tensorflow as tf
+from absl import flags
+
+import run
+from records import (compact_record_features, decode_compact_records,
+                     decode_record, padded_record_features)
+from util import load_examples
+from vocab import load_vocab
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list("batch_sizes", ["64", "256"], "Batch sizes to benchmark.")
+
+flags.DEFINE_list("thread_counts", ["1", "4", "8"],
+                  "Parallel reads / map calls to benchmark.")
+
+flags.DEFINE_integer("num_batches", 200, "Batches timed per measurement.")
+
+flags.DEFINE_string("output_file", "input_benchmark.json",
+                    "Where to write the results as JSON.")
+
+
+def list_input_files(patterns):
+    input_files = []
+    for input_pattern in patterns.split(","):
+        input_files.extend(tf.io.gfile.glob(input_pattern))
+    return input_files
+
+
+def read_stage(input_files, num_threads):
+    d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
+    d = d.repeat()
+    return d.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=min(num_threads, len(input_files)),
+        num_parallel_calls=num_threads,
+        deterministic=False)
+
+
+def stage_datasets(input_files, num_threads, batch_size, compact, masked,
+                   packed):
+    """Returns [(stage name, dataset)] where every stage adds one step, so
+    a stage's dataset also runs all the previous ones (cast parses again).
+
+    The read stage yields single records, so its time per batch also holds
+    the per-element overhead that batching removes for the later stages.
+    The parse and cast stages use the feature specs and decoders of run.py.
+
+    `masked` is False for the unmasked windows of --dynamic_masking, and
+    `packed` is --pack_sequences.
+    """
+    read = read_stage(input_files, num_threads)
+    batch = read.batch(batch_size)
+    if compact:
+        spec = compact_record_features(masked, packed)
+        # densify and cast
+        decode = lambda records: decode_compact_records(
+            records, FLAGS.max_seq_length, FLAGS.max_predictions_per_seq,
+            masked=masked, packed=packed)
+    else:
+        spec = padded_record_features(
+            FLAGS.max_seq_length, FLAGS.max_predictions_per_seq,
+            masked=masked, packed=packed)
+        decode = lambda records: decode_record(records, spec)
+    parse = batch.map(lambda records: tf.io.parse_example(records, spec),
+                      num_parallel_calls=num_threads)
+    cast = batch.map(decode, num_parallel_calls=num_threads)
+    return [("read", read), ("batch", batch), ("parse", parse),
+            ("cast", cast)]
+
+
+@tf.function
+def consume(iterator, num_elements):
+    for _ in tf.range(num_elements):
+        next(iterator)
+
+
+def time_dataset(d, num_elements, num_warmup=10):
+    """Seconds to pull `num_elements` elements through `d` after
+    `num_warmup` from the same iterator, consumed inside the runtime so
+    Python iteration does not count."""
+    iterator = iter(d)
+    consume(iterator, tf.constant(num_warmup, tf.int64))
+    start_time = time.perf_counter()
+    consume(iterator, tf.constant(num_elements, tf.int64))
+    return time.perf_counter() - start_time
+
+
+def mean_record_bytes(input_files, num_records=10000):
+    d = tf.data.TFRecordDataset(input_files).take(num_records)
+    total, count = d.reduce(
+        (tf.constant(0, tf.int64), tf.constant(0, tf.int64)),
+        lambda acc, record: (acc[0] + tf.cast(tf.strings.length(record),
+                                              tf.int64), acc[1] + 1))
+    return float(total) / max(int(count), 1)
+
+
+def mean_row_bytes(prefix):
+    examples = load_examples(prefix)
+    return float(sum(array[0].nbytes for array in examples.values()))
+
+
+def benchmark(input_files, num_threads, batch_size, record_bytes, masking):
+    compact = FLAGS.record_format == "compact"
+    result = {"num_threads": num_threads, "batch_size": batch_size,
+              "stages": {}}
+
+    if FLAGS.record_format == "npy":
+        input_fn = run.npy_input_fn_builder(
+            prefix=input_files[0],
+            max_seq_length=FLAGS.max_seq_length,
+            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+            is_training=True,
+            masking=masking)
+        seconds = time_dataset(input_fn({"batch_size": batch_size}),
+                               FLAGS.num_batches)
+        examples_per_sec = FLAGS.num_batches * batch_size / seconds
+        result["examples_per_sec"] = examples_per_sec
+        result["bytes_per_sec"] = examples_per_sec * record_bytes
+        return result
+
+    previous_ms_per_batch = 0.0
+    for name, d in stage_datasets(input_files, num_threads, batch_size,
+                                  compact, masking is None,
+                                  FLAGS.pack_sequences):
+        if name == "read":
+            seconds = time_dataset(d, FLAGS.num_batches * batch_size,
+                                   num_warmup=10 * batch_size)
+        else:
+            seconds = time_dataset(d, FLAGS.num_batches)
+        ms_per_batch = 1000.0 * seconds / FLAGS.num_batches
+        # cumulative, and the part this stage adds
+        result["stages"][name] = {
+            "ms_per_batch": ms_per_batch,
+            "added_ms_per_batch": ms_per_batch - previous_ms_per_batch,
+        }
+        previous_ms_per_batch = ms_per_batch
+
+    input_fn = run.input_fn_builder(
+        input_files=input_files,
+        max_seq_length=FLAGS.max_seq_length,
+        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+        is_training=True,
+        num_cpu_threads=num_threads,
+        masking=masking,
+        compact=compact,
+        shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+        packed=FLAGS.pack_sequences)
+    seconds = time_dataset(input_fn({"batch_size": batch_size}),
+                           FLAGS.num_batches)
+    examples_per_sec = FLAGS.num_batches * batch_size / seconds
+    result["examples_per_sec"] = examples_per_sec
+    result["bytes_per_sec"] = examples_per_sec * record_bytes
+    return result
+
+
+def main():
+    if FLAGS.record_format == "npy":
+        input_files = [FLAGS.train_input_file]
+    else:
+        input_files = list_input_files(FLAGS.train_input_file)
+    if not input_files:
+        raise ValueError("no files match " + FLAGS.train_input_file)
+
+    masking = None
+    if FLAGS.dynamic_masking:
+        vocab = load_vocab(FLAGS.vocab_filename)
+        masking = {
+            "masked_lm_prob": FLAGS.masked_lm_prob,
+            "mask_prob": FLAGS.mask_prob,
+            "mask_last_prob": FLAGS.mask_last_prob,
+            "mask_id": vocab.get_special_token_id("[MASK]"),
+            "item_count": vocab.get_item_count(),
+        }
+
+    if FLAGS.record_format == "npy":
+        record_bytes = mean_row_bytes(input_files[0])
+    else:
+        record_bytes = mean_record_bytes(input_files)
+    results = []
+    for num_threads in [int(x) for x in FLAGS.thread_counts]:
+        for batch_size in [int(x) for x in FLAGS.batch_sizes]:
+            result = benchmark(input_files, num_threads, batch_size,
+                               record_bytes, masking)
+            print("threads:{}, batch_size:{}, examples/sec:{:.1f}, "
+                  "bytes/sec:{:.1f}, ms/batch (added by the stage): {}".format(
+                      num_threads, batch_size, result["examples_per_sec"],
+                      result["bytes_per_sec"],
+                      ", ".join("{} {:.2f} ({:+.2f})".format(
+                          name, stage["ms_per_batch"],
+                          stage["added_ms_per_batch"])
+                          for name, stage in result["stages"].items())))
+            results.append(result)
+
+    output = {
+        "input_files": input_files,
+        "record_format": FLAGS.record_format,
+        "dynamic_masking": FLAGS.dynamic_masking,
+        "mean_record_bytes": record_bytes,
+        "results": results,
+    }
+    with open(FLAGS.output_file, "w") as output_file:
+        json.dump(output, output_file, indent=2)
+    print("results: " + FLAGS.output_file)
+
+
+if __name__ == "__main__":
+    flags.mark_flag_as_required("train_input_file")
+    FLAGS(sys.argv)
+    main()
@@ -0,0 +1,134 @@
+"""Benchmarks the sequence builders of gen_learn_sequence.py.
+
+Times the original row-wise builders, kept here as the reference, against
+the vectorized and streaming builders on --input_file and checks that all
+of them write the same files.
+"""
+
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from gen_learn_sequence import (FLAGS, USECOLS, build_sequences_streaming,
+                                lesson_based, unit_based)
+
+
+def lesson_based_rowwise(df, only_correct = False,
+                         output_file="./data/learn-hist/lesson-based.txt"):
+    sequences = {}
+    for index, row in df.iterrows():
+        if pd.isna(row["question_grad_unit"]):
+            continue
+
+        grad_unit = row["question_grad_unit"].split("_")
+        student_id_grad_unit = (
+            row["student_id"] * 10000
+            + int(grad_unit[0][3]) * 1000
+            + int(grad_unit[1]) * 100
+            + int(grad_unit[2]) * 10
+            + int(grad_unit[3])
+        )
+
+        if student_id_grad_unit not in sequences:
+            sequences[student_id_grad_unit] = []
+        sequences[student_id_grad_unit].append(row["question_code"])
+
+    users = 0
+    items = set()
+    actions = 0
+    with open(output_file, "w") as file:
+        for id, qc_list in sequences.items(): # student_id, question_code
+            if len(qc_list) < 5:
+                continue
+
+            users += 1
+            actions += len(qc_list)
+            for qc in qc_list:
+                file.write(f"{id} {qc}\n")
+                items.add(qc)
+
+
+def unit_based_rowwise(df, only_correct=False,
+                       output_file="./data/learn-hist/unit-based-OC.txt"):
+    sequences = {}
+    for index, row in df.iterrows():
+        if pd.isna(row["question_grad_unit"]):
+            continue
+        elif only_correct and row["correct"] == 0:
+            continue
+
+        grad_unit = row["question_grad_unit"].split("_")
+        student_id_grad_unit = (
+            row["student_id"] * 1000
+            + int(grad_unit[0][3]) * 100
+            + int(grad_unit[1]) * 10
+            + int(grad_unit[2])
+        )
+
+        if student_id_grad_unit not in sequences:
+            sequences[student_id_grad_unit] = []
+        sequences[student_id_grad_unit].append(row["question_code"])
+
+    users = 0
+    items = set()
+    actions = 0
+    with open(output_file, "w") as file:
+        for id, qc_list in sequences.items():  # student_id, question_code
+            if len(qc_list) < 5:
+                continue
+
+            users += 1
+            actions += len(qc_list)
+            for qc in qc_list:
+                file.write(f"{id} {qc}\n")
+                items.add(qc)
+
+    print("#users:", users)
+    print("#items:", len(items))
+    print("#actions:", actions)
+    print("Avg. length:", actions/users)
+
+
+# (name, granularity, row-wise builder, vectorized builder, only_correct)
+CASES = [
+    ("lesson-based", "lesson", lesson_based_rowwise, lesson_based, False),
+    ("unit-based-OC", "unit", unit_based_rowwise, unit_based, True),
+]
+
+
+def benchmark(df, input_file):
+    """Times the row-wise, vectorized and streaming builders and checks their
+    outputs match."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, granularity, rowwise_fn, vectorized_fn, only_correct in CASES:
+            timings = []
+            paths = []
+            for tag, fn in (("rowwise", rowwise_fn), ("vectorized", vectorized_fn)):
+                path = os.path.join(tmp_dir, "{}.{}.txt".format(name, tag))
+                start_time = time.perf_counter()
+                fn(df, only_correct, output_file=path)
+                timings.append(time.perf_counter() - start_time)
+                paths.append(path)
+
+            path = os.path.join(tmp_dir, "{}.streaming.txt".format(name))
+            start_time = time.perf_counter()
+            build_sequences_streaming(input_file, granularity, only_correct,
+                                      path, spill_dir=tmp_dir)
+            timings.append(time.perf_counter() - start_time)
+            paths.append(path)
+
+            print("{}: rowwise {:.2f}s, vectorized {:.2f}s, streaming {:.2f}s, "
+                  "speedup {:.1f}x, identical: {}".format(
+                      name, timings[0], timings[1], timings[2],
+                      timings[0] / timings[1],
+                      filecmp.cmp(paths[0], paths[1], shallow=False)
+                      and filecmp.cmp(paths[0], paths[2], shallow=False)))
+
+
+if __name__ == "__main__":
+    FLAGS(sys.argv)
+    benchmark(pd.read_csv(FLAGS.input_file, usecols=USECOLS), FLAGS.input_file)
@@ -6,17 +6,16 @@ import codecs
 import collections
 import random
 
+import numpy as np
 import tensorflow as tf
 from absl import flags
 import six
 
 from util import *
 from vocab import *
-import pickle
 import multiprocessing
 import time
 
-random_seed = 12345
 short_seq_prob = 0  # Probability of creating sequences which are shorter than the maximum length。
 
 FLAGS = flags.FLAGS
@@ -49,6 +48,47 @@ flags.DEFINE_integer(
 
 flags.DEFINE_float("prop_sliding_window", 0.1, "sliding window step size.")
 
+flags.DEFINE_bool(
+    "batch_masking", True,
+    "Mask all training windows of a dupe step at once with numpy. Set to "
+    "False to mask sequence by sequence as in earlier versions.")
+
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Write every train window once, unmasked, for run.py --dynamic_masking "
+    "to mask in its input pipeline. dupe_factor is then unused.")
+
+flags.DEFINE_enum(
+    "record_format", 'padded', ['padded', 'compact', 'npy'],
+    "padded: fixed-length int64 features padded to max_seq_length and "
+    "max_predictions_per_seq. compact: only the real ids and masked "
+    "positions, no input_mask or weights. npy: no tfrecords, dense arrays "
+    "<name>.train.<field>.npy and <name>.test.<field>.npy; pass run.py the "
+    "<name>.train and <name>.test prefixes. run.py and run_eval.py need the "
+    "same --record_format.")
+
+flags.DEFINE_bool(
+    "pack_sequences", False,
+    "Pack several short train windows into one max_seq_length row, with "
+    "segment_ids telling them apart; run.py needs --pack_sequences too. Not "
+    "supported with dynamic_masking.")
+
+flags.DEFINE_integer(
+    "num_shards", None,
+    "Number of user shards for train generation, defaults to pool_size. "
+    "Every user shard task writes all its dupe steps, mixed, to its own "
+    "file, named <name>.train.tfrecord-0000i-of-0000N; pass run.py a glob "
+    "to read them.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 100000,
+    "Instances held per output shard while shuffling. Train generation also "
+    "masks and packs this many windows at a time.")
+
+flags.DEFINE_integer(
+    "random_seed", 12345,
+    "Seed of the user shuffle, the masks and the output shuffle.")
+
 flags.DEFINE_string(
     "data_dir", './data/',
     "data dir.")
@@ -57,6 +97,12 @@ flags.DEFINE_string(
     "dataset_name", 'ml-1m',
     "dataset name.")
 
+flags.DEFINE_enum(
+    "input_format", 'text', ['text', 'csr'],
+    "text: <dataset_name>.txt with one 'user item' line per action. "
+    "csr: memory-mapped <dataset_name>.users/.offsets/.items.npy written by "
+    "gen_learn_sequence.py.")
+
 
 def printable_text(text):
     """Returns text encoded in a way suitable for print or `tf.get_logger()`."""
@@ -104,21 +150,25 @@ def convert_to_unicode(text):
 class TrainingInstance(object):
     """A single training instance (sentence pair)."""
 
-    def __init__(self, info, tokens, masked_lm_positions, masked_lm_labels):
+    def __init__(self, info, tokens, masked_lm_positions, masked_lm_labels,
+                 segment_ids=None):
         self.info = info  # info = [user]
-        self.tokens = tokens
+        self.tokens = tokens  # vocab ids
         self.masked_lm_positions = masked_lm_positions
         self.masked_lm_labels = masked_lm_labels
+        self.segment_ids = segment_ids  # packed instances only
 
     def __str__(self):
         s = ""
-        s += "info: %s\n" % (" ".join([printable_text(x) for x in self.info]))
-        s += "tokens: %s\n" % (
-            " ".join([printable_text(x) for x in self.tokens]))
+        s += "info: %s\n" % (" ".join([str(x) for x in self.info]))
+        s += "tokens: %s\n" % (" ".join([str(x) for x in self.tokens]))
         s += "masked_lm_positions: %s\n" % (
             " ".join([str(x) for x in self.masked_lm_positions]))
         s += "masked_lm_labels: %s\n" % (
-            " ".join([printable_text(x) for x in self.masked_lm_labels]))
+            " ".join([str(x) for x in self.masked_lm_labels]))
+        if self.segment_ids is not None:
+            s += "segment_ids: %s\n" % (
+                " ".join([str(x) for x in self.segment_ids]))
         s += "\n"
         return s
 
@@ -127,77 +177,265 @@ class TrainingInstance(object):
 
 
 def write_instance_to_example_files(instances, max_seq_length,
-                                    max_predictions_per_seq, vocab,
-                                    output_files):
-    """Create TF example files from `TrainingInstance`s."""
+                                    max_predictions_per_seq, output_files,
+                                    rng=None, shuffle_buffer_size=0,
+                                    compact=False):
+    """Create TF example files from an iterable of `TrainingInstance`s.
+
+    Instances go round-robin to `output_files`. With `rng`, every file
+    shuffles through its own buffer of `shuffle_buffer_size` instances, so
+    memory does not grow with the data; an input that fits in the buffer is
+    shuffled exactly as by `rng.shuffle`.
+    """
     writers = []
     for output_file in output_files:
         writers.append(tf.io.TFRecordWriter(output_file))
+    buffers = [[] for _ in output_files]
 
     writer_index = 0
 
     total_written = 0
-    for (inst_index, instance) in enumerate(instances):
-        try:
-            input_ids = vocab.convert_tokens_to_ids(instance.tokens)
-        except:
-            print(instance)
+    for instance in instances:
+        if rng is not None:
+            buffer = buffers[writer_index]
+            if len(buffer) < shuffle_buffer_size:
+                buffer.append(instance)
+                writer_index = (writer_index + 1) % len(writers)
+                continue
+            # write a random buffered instance, keep the new one
+            pos = rng.randrange(len(buffer))
+            buffer[pos], instance = instance, buffer[pos]
+
+        write_instance(writers[writer_index], instance, max_seq_length,
+                       max_predictions_per_seq, log=total_written < 20,
+                       compact=compact)
+        writer_index = (writer_index + 1) % len(writers)
+
+        total_written += 1
+
+    for writer, buffer in zip(writers, buffers):
+        if buffer:
+            rng.shuffle(buffer)
+        for instance in buffer:
+            write_instance(writer, instance, max_seq_length,
+                           max_predictions_per_seq, log=total_written < 20,
+                           compact=compact)
+            total_written += 1
 
-        input_mask = [1] * len(input_ids)
-        assert len(input_ids) <= max_seq_length
+    for writer in writers:
+        writer.close()
+
+    tf.get_logger().info("Wrote %d total instances", total_written)
+    return total_written
+
+
+def write_instance_to_npy_files(instances, max_seq_length,
+                                max_predictions_per_seq, output_prefix,
+                                rng=None, shuffle_buffer_size=0):
+    """Writes `TrainingInstance`s, shuffled with `rng`, as the dense arrays
+    of `create_example_arrays` with `save_examples`. Returns the count.
+
+    With `shuffle_buffer_size`, instances are shuffled through a buffer as
+    in `write_instance_to_example_files` and saved in parts of that many
+    rows, which `concat_examples` joins, so memory does not grow with the
+    data.
+    """
+    if not shuffle_buffer_size:
+        instances = list(instances)
+        if rng is not None:
+            rng.shuffle(instances)
+        save_examples(output_prefix,
+                      create_example_arrays(instances, max_seq_length,
+                                            max_predictions_per_seq))
+        tf.get_logger().info("Wrote %d total instances", len(instances))
+        return len(instances)
+
+    if rng is not None:
+        instances = shuffle_instances(instances, rng, shuffle_buffer_size)
+    part_prefixes = []
+    total_written = 0
+    for chunk in chunked(instances, shuffle_buffer_size):
+        part_prefix = '%s.part-%05d' % (output_prefix, len(part_prefixes))
+        save_examples(part_prefix,
+                      create_example_arrays(chunk, max_seq_length,
+                                            max_predictions_per_seq))
+        part_prefixes.append(part_prefix)
+        total_written += len(chunk)
+    if part_prefixes:
+        concat_examples(output_prefix, part_prefixes)
+    else:
+        save_examples(output_prefix,
+                      create_example_arrays([], max_seq_length,
+                                            max_predictions_per_seq))
+    tf.get_logger().info("Wrote %d total instances", total_written)
+    return total_written
+
+
+def shuffle_instances(instances, rng, buffer_size):
+    """Yields `instances` shuffled through a buffer of `buffer_size`."""
+    buffer = []
+    for instance in instances:
+        if len(buffer) < buffer_size:
+            buffer.append(instance)
+            continue
+        pos = rng.randrange(len(buffer))
+        buffer[pos], instance = instance, buffer[pos]
+        yield instance
+    rng.shuffle(buffer)
+    for instance in buffer:
+        yield instance
+
+
+def chunked(iterable, size):
+    """Yields lists of `size` consecutive items of `iterable`, the last one
+    possibly shorter."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def create_example_arrays(instances, max_seq_length, max_predictions_per_seq):
+    """Dense arrays of the padded layout, one row per instance, without
+    input_mask (input_ids > 0). info is int64 as in the tfrecords, the other
+    fields are int32/float32.
+
+    Instances without `masked_lm_positions` are unmasked windows and only
+    get info and input_ids.
+    """
+    num_instances = len(instances)
+    examples = collections.OrderedDict()
+    examples["info"] = np.array([instance.info for instance in instances],
+                                dtype=np.int64).reshape(num_instances, 1)
+    input_ids = np.zeros((num_instances, max_seq_length), dtype=np.int32)
+    for row, instance in enumerate(instances):
+        assert len(instance.tokens) <= max_seq_length
+        input_ids[row, :len(instance.tokens)] = instance.tokens
+    examples["input_ids"] = input_ids
+
+    if num_instances and instances[0].segment_ids is not None:
+        segment_ids = np.zeros((num_instances, max_seq_length), dtype=np.int32)
+        for row, instance in enumerate(instances):
+            segment_ids[row, :len(instance.segment_ids)] = instance.segment_ids
+        examples["segment_ids"] = segment_ids
+
+    if num_instances and instances[0].masked_lm_positions is not None:
+        shape = (num_instances, max_predictions_per_seq)
+        positions = np.zeros(shape, dtype=np.int32)
+        ids = np.zeros(shape, dtype=np.int32)
+        weights = np.zeros(shape, dtype=np.float32)
+        for row, instance in enumerate(instances):
+            num_masked = len(instance.masked_lm_positions)
+            assert num_masked <= max_predictions_per_seq
+            positions[row, :num_masked] = instance.masked_lm_positions
+            ids[row, :num_masked] = instance.masked_lm_labels
+            weights[row, :num_masked] = 1.0
+        examples["masked_lm_positions"] = positions
+        examples["masked_lm_ids"] = ids
+        examples["masked_lm_weights"] = weights
+    return examples
+
+
+def write_instance(writer, instance, max_seq_length, max_predictions_per_seq,
+                   log=False, compact=False):
+    """Writes one `TrainingInstance` as a tf.train.Example, padded or, with
+    `compact`, in the layout of `create_compact_features`."""
+    if compact:
+        features = create_compact_features(instance, max_seq_length,
+                                           max_predictions_per_seq)
+    else:
+        features = create_padded_features(instance, max_seq_length,
+                                          max_predictions_per_seq)
+
+    tf_example = tf.train.Example(
+        features=tf.train.Features(feature=features))
+
+    writer.write(tf_example.SerializeToString())
+
+    if log:
+        tf.get_logger().info("*** Example ***")
+        tf.get_logger().info(
+            "tokens: %s" % " ".join([str(x) for x in instance.tokens])
+        )
+
+        for feature_name in features.keys():
+            feature = features[feature_name]
+            values = []
+            if feature.int64_list.value:
+                values = feature.int64_list.value
+            elif feature.float_list.value:
+                values = feature.float_list.value
+            tf.get_logger().info(
+                "%s: %s" % (feature_name, " ".join([str(x) for x in values]))
+            )
 
-        input_ids += [0] * (max_seq_length - len(input_ids))
-        input_mask += [0] * (max_seq_length - len(input_mask))
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
+def create_padded_features(instance, max_seq_length, max_predictions_per_seq):
+    """Features of the padded record layout.
 
+    Instances without `masked_lm_positions` are unmasked windows and only
+    get info, input_ids and input_mask.
+    """
+    input_ids = list(instance.tokens)
+    input_mask = [1] * len(input_ids)
+    assert len(input_ids) <= max_seq_length
+
+    input_ids += [0] * (max_seq_length - len(input_ids))
+    input_mask += [0] * (max_seq_length - len(input_mask))
+
+    assert len(input_ids) == max_seq_length
+    assert len(input_mask) == max_seq_length
+
+    features = collections.OrderedDict()
+    features["info"] = create_int_feature(instance.info)
+    features["input_ids"] = create_int_feature(input_ids)
+    features["input_mask"] = create_int_feature(input_mask)
+    if instance.segment_ids is not None:
+        segment_ids = list(instance.segment_ids)
+        segment_ids += [0] * (max_seq_length - len(segment_ids))
+        features["segment_ids"] = create_int_feature(segment_ids)
+
+    if instance.masked_lm_positions is not None:
         masked_lm_positions = list(instance.masked_lm_positions)
-        masked_lm_ids = vocab.convert_tokens_to_ids(instance.masked_lm_labels)
+        masked_lm_ids = list(instance.masked_lm_labels)
         masked_lm_weights = [1.0] * len(masked_lm_ids)
 
         masked_lm_positions += [0] * (max_predictions_per_seq - len(masked_lm_positions))
         masked_lm_ids += [0] * (max_predictions_per_seq - len(masked_lm_ids))
         masked_lm_weights += [0.0] * (max_predictions_per_seq - len(masked_lm_weights))
 
-        features = collections.OrderedDict()
-        features["info"] = create_int_feature(instance.info)
-        features["input_ids"] = create_int_feature(input_ids)
-        features["input_mask"] = create_int_feature(input_mask)
         features["masked_lm_positions"] = create_int_feature(
             masked_lm_positions)
         features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
         features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
-
-        tf_example = tf.train.Example(
-            features=tf.train.Features(feature=features))
-
-        writers[writer_index].write(tf_example.SerializeToString())
-        writer_index = (writer_index + 1) % len(writers)
-
-        total_written += 1
-
-        if inst_index < 20:
-            tf.get_logger().info("*** Example ***")
-            tf.get_logger().info(
-                "tokens: %s" % " ".join([printable_text(x) for x in instance.tokens])
-            )
-
-            for feature_name in features.keys():
-                feature = features[feature_name]
-                values = []
-                if feature.int64_list.value:
-                    values = feature.int64_list.value
-                elif feature.float_list.value:
-                    values = feature.float_list.value
-                tf.get_logger().info(
-                    "%s: %s" % (feature_name, " ".join([str(x) for x in values]))
-                )
-
-    for writer in writers:
-        writer.close()
-
-    tf.get_logger().info("Wrote %d total instances", total_written)
+    return features
+
+
+def create_compact_features(instance, max_seq_length, max_predictions_per_seq):
+    """Features of the compact record layout.
+
+    Only the real input ids and, for masked instances, the masked positions
+    and labels are stored, as variable-length lists; input_mask and
+    masked_lm_weights follow from the lengths. The int64 lists are varint
+    encoded, so small ids take one or two bytes.
+    """
+    assert len(instance.tokens) <= max_seq_length
+    features = collections.OrderedDict()
+    features["info"] = create_int_feature(instance.info)
+    features["input_ids"] = create_int_feature(instance.tokens)
+    if instance.segment_ids is not None:
+        features["segment_ids"] = create_int_feature(instance.segment_ids)
+    if instance.masked_lm_positions is not None:
+        assert len(instance.masked_lm_positions) <= max_predictions_per_seq
+        features["masked_lm_positions"] = create_int_feature(
+            instance.masked_lm_positions)
+        features["masked_lm_ids"] = create_int_feature(
+            instance.masked_lm_labels)
+    return features
 
 
 def create_int_feature(values):
@@ -212,26 +450,67 @@ def create_float_feature(values):
     return feature
 
 
-def create_training_instances(all_documents_raw,
-                              max_seq_length,
-                              dupe_factor,
-                              short_seq_prob,
-                              masked_lm_prob,
-                              max_predictions_per_seq,
-                              rng,
-                              vocab,
-                              mask_prob,
-                              prop_sliding_window,
-                              pool_size,
-                              force_last=False):
-    """Create `TrainingInstance`s from raw text."""
+def pack_instances(instances, max_seq_length, max_predictions_per_seq):
+    """Packs masked `TrainingInstance`s into rows of at most `max_seq_length`
+    tokens and `max_predictions_per_seq` masks, with segment_ids 1, 2, ...
+    per packed instance. Instances are placed longest first, each into the
+    fullest row that still has room. A row keeps the info of its first
+    instance.
+    """
+    rows = []
+    num_masked = []
+    # row indexes by their free tokens
+    rows_by_space = [[] for _ in range(max_seq_length + 1)]
+    for instance in sorted(instances, key=lambda x: -len(x.tokens)):
+        length = len(instance.tokens)
+        masks = len(instance.masked_lm_positions)
+        row = None
+        for space in range(length, max_seq_length + 1):
+            for i, candidate in enumerate(rows_by_space[space]):
+                if num_masked[candidate] + masks <= max_predictions_per_seq:
+                    row = rows_by_space[space].pop(i)
+                    break
+            if row is not None:
+                rows_by_space[space - length].append(row)
+                break
+        if row is None:
+            row = len(rows)
+            rows.append([])
+            num_masked.append(0)
+            rows_by_space[max_seq_length - length].append(row)
+        rows[row].append(instance)
+        num_masked[row] += masks
+
+    packed = []
+    for row in rows:
+        tokens = []
+        segment_ids = []
+        positions = []
+        labels = []
+        for segment, instance in enumerate(row):
+            positions.extend(p + len(tokens)
+                             for p in instance.masked_lm_positions)
+            labels.extend(instance.masked_lm_labels)
+            tokens.extend(instance.tokens)
+            segment_ids.extend([segment + 1] * len(instance.tokens))
+        packed.append(TrainingInstance(
+            info=row[0].info, tokens=tokens, masked_lm_positions=positions,
+            masked_lm_labels=labels, segment_ids=segment_ids))
+    return packed
+
+
+def create_documents(all_documents_raw, max_seq_length, prop_sliding_window,
+                     force_last=False):
+    """Cuts every user's vocab id array into windows of at most
+    `max_seq_length` ids: only the last window with `force_last`, else
+    sliding windows with a step of `prop_sliding_window * max_seq_length`."""
     all_documents = {}
 
     if force_last:
         max_num_tokens = max_seq_length
         for user, item_seq in all_documents_raw.items():
             if len(item_seq) == 0:
-                print("got empty seq:" + user)
+                print("got empty seq:" + str(user))
                 continue
             all_documents[user] = [item_seq[-max_num_tokens:]]
     else:
@@ -242,7 +521,7 @@ def create_training_instances(all_documents_raw,
             max_num_tokens) if prop_sliding_window != -1.0 else max_num_tokens
         for user, item_seq in all_documents_raw.items():
             if len(item_seq) == 0:
-                print("got empty seq:" + user)
+                print("got empty seq:" + str(user))
                 continue
 
             #todo: add slide
@@ -252,86 +531,345 @@ def create_training_instances(all_documents_raw,
                 beg_idx = list(range(len(item_seq)-max_num_tokens, 0, -sliding_step))
                 beg_idx.append(0)
                 all_documents[user] = [item_seq[i:i + max_num_tokens] for i in beg_idx[::-1]]
+    return all_documents
 
-    instances = []
+
+def create_training_instances(all_documents_raw,
+                              max_seq_length,
+                              dupe_factor,
+                              short_seq_prob,
+                              masked_lm_prob,
+                              max_predictions_per_seq,
+                              rng,
+                              vocab,
+                              mask_prob,
+                              prop_sliding_window,
+                              force_last=False,
+                              batch_masking=True):
+    """Yields `TrainingInstance`s for `{user: vocab id array}` documents.
+
+    Instances are generated lazily, in this process and unshuffled; the
+    writer shuffles them. `write_train_shards` generates the train instances
+    with a pool instead.
+    """
+    all_documents = create_documents(all_documents_raw, max_seq_length,
+                                     prop_sliding_window, force_last)
+    mask_id = vocab.get_special_token_id("[MASK]")
+    # random replacements are drawn from the items in Counter order
+    item_ids = vocab.convert_tokens_to_ids(vocab.get_items())
+
+    num_instances = 0
     if force_last:
         for user in all_documents:
-            instances.extend(
-                create_instances_from_document_test(
-                    all_documents, user, max_seq_length))
-        print("num of instance:{}".format(len(instances)))
+            for instance in create_instances_from_document_test(
+                    all_documents, user, max_seq_length, mask_id):
+                num_instances += 1
+                yield instance
+        print("num of instance:{}".format(num_instances))
     else:
-        start_time = time.perf_counter()
-        pool = multiprocessing.Pool(processes=pool_size)
-        instances = []
-        print("document num: {}".format(len(all_documents)))
-
-        def log_result(result):
-            print("callback function result type: {}, size: {} ".format(type(result), len(result)))
-            instances.extend(result)
-
+        # distinct seeds, so no two dupe steps share masks
+        seeds = rng.sample(range(2**31 - 1), dupe_factor)
         for step in range(dupe_factor):
-            pool.apply_async(
-                create_instances_threading, args=(
-                    all_documents, user, max_seq_length, short_seq_prob,
-                    masked_lm_prob, max_predictions_per_seq, vocab, random.Random(random.randint(1,10000)),
-                    mask_prob, step), callback=log_result)
-        pool.close()
-        pool.join()
-        
+            for instance in create_instances_threading(
+                    [all_documents], max_seq_length, short_seq_prob,
+                    masked_lm_prob, max_predictions_per_seq, item_ids, mask_id,
+                    seeds[step], mask_prob, step, batch_masking):
+                num_instances += 1
+                yield instance
+
         for user in all_documents:
-            instances.extend(
-                mask_last(
+            for instance in mask_last(
                     all_documents, user, max_seq_length, short_seq_prob,
-                    masked_lm_prob, max_predictions_per_seq, vocab, rng))
-
-        print("num of instance:{}; time:{}".format(len(instances), time.perf_counter() - start_time))
-    rng.shuffle(instances)
-    return instances
-
-
-def create_instances_threading(all_documents, user, max_seq_length, short_seq_prob,
-                               masked_lm_prob, max_predictions_per_seq, vocab, rng,
-                               mask_prob, step):
+                    masked_lm_prob, max_predictions_per_seq, mask_id, rng):
+                num_instances += 1
+                yield instance
+        print("num of instance:{}".format(num_instances))
+
+
+def write_train_shards(all_documents_raw, output_filename, rng, vocab,
+                       max_seq_length, dupe_factor, short_seq_prob,
+                       masked_lm_prob, max_predictions_per_seq, mask_prob,
+                       prop_sliding_window, pool_size, num_shards,
+                       shuffle_buffer_size, batch_masking=True,
+                       dynamic_masking=False, record_format='padded',
+                       pack=False):
+    """Generates and writes the train instances with a pool of workers.
+
+    Users are shuffled and split into `num_shards` shards. Every user shard
+    task writes one tfrecord file holding its `dupe_factor` masking steps and
+    one extra step that masks the last item of every window as `mask_last`,
+    mixed by `write_train_shard`. The windows are
+    written once, one at a time, as memory-mapped CSR files shared by all
+    workers, so tasks only carry index ranges and seeds, and only file names
+    and counts come back. Tasks stream their windows in batches of
+    `shuffle_buffer_size`, so no process holds a whole shard.
+    With `dynamic_masking`, every shard is written once with its windows
+    unmasked. With `record_format` 'npy' the shards are arrays, concatenated
+    into `output_filename` at the end. With `pack`, every task packs its
+    instances with `pack_instances`, a batch at a time. Returns the output
+    file names.
+    """
+    start_time = time.perf_counter()
+    all_documents = create_documents(all_documents_raw, max_seq_length,
+                                     prop_sliding_window)
+    mask_id = vocab.get_special_token_id("[MASK]")
+    item_ids = vocab.convert_tokens_to_ids(vocab.get_items())
+    print("document num: {}".format(len(all_documents)))
+
+    users = list(all_documents)
+    rng.shuffle(users)
+    user_windows = np.array([len(all_documents[u]) for u in users],
+                            dtype=np.int64)
+    num_windows = int(user_windows.sum())
+    window_lengths = np.fromiter(
+        (len(tokens) for user in users for tokens in all_documents[user]),
+        dtype=np.int64, count=num_windows)
+    windows_prefix = output_filename + '.windows'
+    write_sequences(
+        windows_prefix,
+        np.repeat(np.asarray(users, dtype=np.int64), user_windows),
+        window_lengths,
+        (tokens for user in users for tokens in all_documents[user]))
+
+    # window index range of every user shard
+    user_bounds = np.linspace(0, len(users), num_shards + 1).astype(np.int64)
+    window_bounds = np.concatenate([[0], np.cumsum(user_windows)])[user_bounds]
+
+    if dynamic_masking:
+        steps = [(-1, False)]
+    else:
+        steps = [(step, step == dupe_factor) for step in range(dupe_factor + 1)]
+    # distinct seeds, so no two steps share masks and no two files shuffles;
+    # the last seed of every task is its output shuffle
+    seeds = rng.sample(range(2**31 - 1), (len(steps) + 1) * num_shards)
+    tasks = []
+    for shard in range(num_shards):
+        task_seeds = seeds[shard * (len(steps) + 1):
+                           (shard + 1) * (len(steps) + 1)]
+        tasks.append([
+            windows_prefix, window_bounds[shard], window_bounds[shard + 1],
+            steps, task_seeds])
+    output_files = ['%s-%05d-of-%05d' % (output_filename, i, len(tasks))
+                    for i in range(len(tasks))]
+
+    pool = multiprocessing.Pool(processes=pool_size)
+    results = [
+        pool.apply_async(write_train_shard, args=task + [
+            output_file, max_seq_length, short_seq_prob, masked_lm_prob,
+            max_predictions_per_seq, item_ids, mask_id, mask_prob,
+            batch_masking, shuffle_buffer_size, record_format, pack])
+        for task, output_file in zip(tasks, output_files)
+    ]
+    num_instances = sum(result.get() for result in results)
+    pool.close()
+    pool.join()
+
+    for suffix in ['.users.npy', '.offsets.npy', '.items.npy']:
+        os.remove(windows_prefix + suffix)
+
+    if record_format == 'npy':
+        concat_examples(output_filename, output_files)
+        output_files = [output_filename]
+
+    print("num of instance:{}; time:{}".format(num_instances, time.perf_counter() - start_time))
+    return output_files
+
+
+def write_train_shard(windows_prefix, beg, end, steps, seeds, output_file,
+                      max_seq_length, short_seq_prob, masked_lm_prob,
+                      max_predictions_per_seq, item_ids, mask_id, mask_prob,
+                      batch_masking, shuffle_buffer_size,
+                      record_format='padded', pack=False):
+    """Masks windows [beg, end) of the shared windows file for every
+    `(step, force_last)` of `steps` and writes them, mixed and shuffled, to
+    `output_file`. Returns the count.
+
+    Every step yields one instance per window; the steps take turns, one
+    instance each, and start at different chunks of the windows, so every
+    part of the file holds all steps and the shuffle buffer mixes different
+    windows. `seeds` has one seed per step and one for the output shuffle.
+    Windows are read, masked and packed `shuffle_buffer_size` at a time in
+    total over the steps.
+    """
+    chunk_size = max(1, shuffle_buffer_size // len(steps))
+    num_chunks = -(-(end - beg) // chunk_size)
+    step_instances = [
+        train_step_instances(
+            read_window_chunks(windows_prefix, beg, end, chunk_size,
+                               first_chunk=i * num_chunks // len(steps)),
+            step, force_last, seed, max_seq_length, short_seq_prob,
+            masked_lm_prob, max_predictions_per_seq, item_ids, mask_id,
+            mask_prob, batch_masking)
+        for i, ((step, force_last), seed) in enumerate(zip(steps, seeds))]
+    instances = interleave(step_instances)
+    if pack:
+        instances = (
+            instance
+            for chunk in chunked(instances, shuffle_buffer_size)
+            for instance in pack_instances(chunk, max_seq_length,
+                                           max_predictions_per_seq))
+
+    rng = random.Random(seeds[-1])
+    if record_format == 'npy':
+        return write_instance_to_npy_files(
+            instances, max_seq_length, max_predictions_per_seq, output_file,
+            rng, shuffle_buffer_size)
+    return write_instance_to_example_files(
+        instances, max_seq_length, max_predictions_per_seq, [output_file],
+        rng, shuffle_buffer_size, record_format == 'compact')
+
+
+def train_step_instances(chunks, step, force_last, seed, max_seq_length,
+                         short_seq_prob, masked_lm_prob,
+                         max_predictions_per_seq, item_ids, mask_id,
+                         mask_prob, batch_masking):
+    """Yields the instances of one dupe step for the `{user: [windows]}`
+    documents of `chunks`. Step -1 yields the windows unmasked."""
+    if step < 0:
+        return (
+            TrainingInstance(info=[user], tokens=tokens.tolist(),
+                             masked_lm_positions=None, masked_lm_labels=None)
+            for documents in chunks
+            for user in documents for tokens in documents[user])
+    if force_last:
+        rng = random.Random(seed)
+        return (
+            instance
+            for documents in chunks for user in documents
+            for instance in mask_last(
+                documents, user, max_seq_length, short_seq_prob,
+                masked_lm_prob, max_predictions_per_seq, mask_id, rng))
+    return create_instances_threading(
+        chunks, max_seq_length, short_seq_prob, masked_lm_prob,
+        max_predictions_per_seq, item_ids, mask_id, seed, mask_prob, step,
+        batch_masking)
+
+
+def interleave(iterables):
+    """Yields an item of every iterable in turn, until all are exhausted."""
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        remaining = []
+        for iterator in iterators:
+            for item in iterator:
+                yield item
+                remaining.append(iterator)
+                break
+        iterators = remaining
+
+
+def read_window_chunks(windows_prefix, beg, end, chunk_size, first_chunk=0):
+    """Yields windows [beg, end) of the windows file as `{user: [windows]}`
+    documents of at most `chunk_size` windows, starting at chunk
+    `first_chunk` and wrapping around. A user whose windows cross a chunk
+    boundary is in both chunks."""
+    users, offsets, items = load_sequences(windows_prefix)
+    chunk_begs = list(range(beg, end, chunk_size))
+    for chunk_beg in chunk_begs[first_chunk:] + chunk_begs[:first_chunk]:
+        documents = collections.OrderedDict()
+        for i in range(chunk_beg, min(chunk_beg + chunk_size, end)):
+            documents.setdefault(int(users[i]), []).append(
+                items[offsets[i]:offsets[i + 1]])
+        yield documents
+
+
+def create_instances_threading(document_chunks, max_seq_length, short_seq_prob,
+                               masked_lm_prob, max_predictions_per_seq, item_ids,
+                               mask_id, seed, mask_prob, step, batch_masking):
+    """Yields the masked instances of every window of the `{user: [windows]}`
+    documents of `document_chunks`, one chunk at a time."""
+    if batch_masking:
+        np_rng = np.random.RandomState(seed)
+        start_time = time.perf_counter()
+        num_instances = 0
+        for all_documents in document_chunks:
+            instances = create_instances_batch(
+                all_documents, max_seq_length, masked_lm_prob,
+                max_predictions_per_seq, item_ids, mask_id, np_rng,
+                mask_prob)
+            num_instances += len(instances)
+            for instance in instances:
+                yield instance
+        print("step: {}, name: {}, instances: {}, time: {}".format(
+            step, multiprocessing.current_process().name, num_instances,
+            time.perf_counter() - start_time))
+        return
+
+    rng = random.Random(seed)
     cnt = 0
     start_time = time.perf_counter()
-    instances = []
-    for user in all_documents:
-        cnt += 1
-        if cnt % 1000 == 0:
-            print(
-                "step: {}, name: {}, step: {}, time: {}".format(
-                    step,
-                    multiprocessing.current_process().name,
-                    cnt,
-                    time.perf_counter() - start_time,
+    for all_documents in document_chunks:
+        for user in all_documents:
+            cnt += 1
+            if cnt % 1000 == 0:
+                print(
+                    "step: {}, name: {}, step: {}, time: {}".format(
+                        step,
+                        multiprocessing.current_process().name,
+                        cnt,
+                        time.perf_counter() - start_time,
+                    )
                 )
-            )
-            start_time = time.perf_counter()
-        instances.extend(create_instances_from_document_train(
-            all_documents, user, max_seq_length, short_seq_prob,
-            masked_lm_prob, max_predictions_per_seq, vocab, rng,
-            mask_prob))
+                start_time = time.perf_counter()
+            for instance in create_instances_from_document_train(
+                    all_documents, user, max_seq_length, short_seq_prob,
+                    masked_lm_prob, max_predictions_per_seq, item_ids,
+                    mask_id, rng, mask_prob):
+                yield instance
+
+
+def create_instances_batch(all_documents, max_seq_length, masked_lm_prob,
+                           max_predictions_per_seq, item_ids, mask_id, rng,
+                           mask_prob):
+    """Creates `TrainingInstance`s for every window of every document with
+    one `create_masked_lm_predictions_batch` call."""
+    users = []
+    windows = []
+    for user in all_documents:
+        for tokens in all_documents[user]:
+            assert len(tokens) >= 1 and len(tokens) <= max_seq_length
+            users.append(user)
+            windows.append(tokens)
+    if not windows:
+        return []
+
+    lengths = np.array([len(tokens) for tokens in windows])
+    input_ids = np.zeros([len(windows), max_seq_length], dtype=np.int32)
+    input_ids[np.arange(max_seq_length) < lengths[:, None]] = np.concatenate(
+        windows)
+
+    (output_ids, masked_lm_positions, masked_lm_ids,
+     masked_lm_weights) = create_masked_lm_predictions_batch(
+         input_ids, masked_lm_prob, max_predictions_per_seq, item_ids,
+         mask_id, rng, mask_prob)
+    num_masked = np.count_nonzero(masked_lm_weights, axis=1)
 
+    instances = []
+    for i in range(len(windows)):
+        instances.append(TrainingInstance(
+            info=[int(users[i])],
+            tokens=output_ids[i, :lengths[i]].tolist(),
+            masked_lm_positions=masked_lm_positions[i, :num_masked[i]].tolist(),
+            masked_lm_labels=masked_lm_ids[i, :num_masked[i]].tolist()))
     return instances
 
 
 def mask_last(
         all_documents, user, max_seq_length, short_seq_prob, masked_lm_prob,
-        max_predictions_per_seq, vocab, rng):
+        max_predictions_per_seq, mask_id, rng):
     """Creates `TrainingInstance`s for a single document."""
     document = all_documents[user]
     max_num_tokens = max_seq_length
     
     instances = []
-    info = [int(user.split("_")[1])]
-    vocab_items = vocab.get_items()
+    info = [int(user)]
 
     for tokens in document:
         assert len(tokens) >= 1 and len(tokens) <= max_num_tokens
         
         (tokens, masked_lm_positions,
-         masked_lm_labels) = create_masked_lm_predictions_force_last(tokens)
+         masked_lm_labels) = create_masked_lm_predictions_force_last(
+             tokens, mask_id)
         instance = TrainingInstance(
             info=info,
             tokens=tokens,
@@ -342,7 +880,8 @@ def mask_last(
     return instances
 
 
-def create_instances_from_document_test(all_documents, user, max_seq_length):
+def create_instances_from_document_test(all_documents, user, max_seq_length,
+                                        mask_id):
     """Creates `TrainingInstance`s for a single document."""
     document = all_documents[user]
     max_num_tokens = max_seq_length
@@ -353,9 +892,10 @@ def create_instances_from_document_test(all_documents, user, max_seq_length):
     assert len(tokens) >= 1
 
     (tokens, masked_lm_positions,
-     masked_lm_labels) = create_masked_lm_predictions_force_last(tokens)
+     masked_lm_labels) = create_masked_lm_predictions_force_last(
+         tokens, mask_id)
 
-    info = [int(user.split("_")[1])]
+    info = [int(user)]
     instance = TrainingInstance(
         info=info,
         tokens=tokens,
@@ -367,15 +907,14 @@ def create_instances_from_document_test(all_documents, user, max_seq_length):
 
 def create_instances_from_document_train(
         all_documents, user, max_seq_length, short_seq_prob, masked_lm_prob,
-        max_predictions_per_seq, vocab, rng, mask_prob):
+        max_predictions_per_seq, item_ids, mask_id, rng, mask_prob):
     """Creates `TrainingInstance`s for a single document."""
     document = all_documents[user]
 
     max_num_tokens = max_seq_length
 
     instances = []
-    info = [int(user.split("_")[1])]
-    vocab_items = vocab.get_items()
+    info = [int(user)]
 
     for tokens in document:
         assert len(tokens) >= 1 and len(tokens) <= max_num_tokens
@@ -383,7 +922,7 @@ def create_instances_from_document_train(
         (tokens, masked_lm_positions,
          masked_lm_labels) = create_masked_lm_predictions(
              tokens, masked_lm_prob, max_predictions_per_seq,
-             vocab_items, rng, mask_prob)
+             item_ids, mask_id, rng, mask_prob)
         instance = TrainingInstance(
             info=info,
             tokens=tokens,
@@ -398,19 +937,17 @@ MaskedLmInstance = collections.namedtuple("MaskedLmInstance",
                                           ["index", "label"])
 
 
-def create_masked_lm_predictions_force_last(tokens):
+def create_masked_lm_predictions_force_last(tokens, mask_id):
     """Creates the predictions for the masked LM objective."""
 
-    last_index = -1
-    for (i, token) in enumerate(tokens):
-        if token == "[CLS]" or token == "[PAD]" or token == '[NO_USE]':
-            continue
-        last_index = i
+    # documents only hold item ids, the last one is always the target
+    tokens = np.asarray(tokens).tolist()
+    last_index = len(tokens) - 1
 
     assert last_index > 0
 
     output_tokens = list(tokens)
-    output_tokens[last_index] = "[MASK]"
+    output_tokens[last_index] = mask_id
 
     masked_lm_positions = [last_index]
     masked_lm_labels = [tokens[last_index]]
@@ -419,18 +956,18 @@ def create_masked_lm_predictions_force_last(tokens):
 
 
 def create_masked_lm_predictions(tokens, masked_lm_prob,
-                                 max_predictions_per_seq, vocab_words, rng,
-                                 mask_prob):
+                                 max_predictions_per_seq, item_ids, mask_id,
+                                 rng, mask_prob):
     """Creates the predictions for the masked LM objective."""
 
-    cand_indexes = []
-    for (i, token) in enumerate(tokens):
-        if token not in vocab_words:
-            continue
-        cand_indexes.append(i)
+    # items take the vocab ids 1..len(item_ids)
+    tokens = np.asarray(tokens)
+    cand_indexes = np.flatnonzero(
+        (tokens > 0) & (tokens <= len(item_ids))).tolist()
 
     rng.shuffle(cand_indexes)
 
+    tokens = tokens.tolist()
     output_tokens = list(tokens)
 
     num_to_predict = min(max_predictions_per_seq,
@@ -448,15 +985,14 @@ def create_masked_lm_predictions(tokens, masked_lm_prob,
         masked_token = None
         # 80% of the time, replace with [MASK]
         if rng.random() < mask_prob:
-            masked_token = "[MASK]"
+            masked_token = mask_id
         else:
             # 10% of the time, keep original
             if rng.random() < 0.5:
                 masked_token = tokens[index]
             # 10% of the time, replace with random word
             else:
-                # masked_token = vocab_words[rng.randint(0, len(vocab_words) - 1)]
-                masked_token = rng.choice(vocab_words)  
+                masked_token = rng.choice(item_ids)
 
         output_tokens[index] = masked_token
 
@@ -473,6 +1009,66 @@ def create_masked_lm_predictions(tokens, masked_lm_prob,
     return (output_tokens, masked_lm_positions, masked_lm_labels)
 
 
+def create_masked_lm_predictions_batch(input_ids, masked_lm_prob,
+                                       max_predictions_per_seq, item_ids,
+                                       mask_id, rng, mask_prob):
+    """Vectorized `create_masked_lm_predictions` for a padded
+    [N, max_seq_length] id matrix, 0 being padding.
+
+    Every row gets min(max_predictions_per_seq, max(1, round(length *
+    masked_lm_prob))) of its item positions, chosen uniformly without
+    replacement. A chosen position becomes `mask_id` with probability
+    `mask_prob`, otherwise it keeps its item or gets a random one from
+    `item_ids` with equal odds. `rng` is a `np.random.RandomState`.
+
+    Returns (output_ids, masked_lm_positions, masked_lm_ids,
+    masked_lm_weights); the last three are [N, max_predictions_per_seq],
+    sorted by position and padded with 0.
+    """
+    input_ids = np.asarray(input_ids)
+    item_ids = np.asarray(item_ids)
+    num_rows, seq_length = input_ids.shape
+
+    lengths = np.count_nonzero(input_ids, axis=1)
+    # items take the vocab ids 1..len(item_ids)
+    cand = (input_ids > 0) & (input_ids <= len(item_ids))
+    num_to_predict = np.minimum(
+        max_predictions_per_seq,
+        np.maximum(1, np.round(lengths * masked_lm_prob).astype(np.int64)))
+    num_to_predict = np.minimum(num_to_predict, cand.sum(axis=1))
+
+    # the candidates with the num_to_predict smallest random keys
+    keys = rng.random_sample(input_ids.shape)
+    keys[~cand] = 2.0
+    threshold = np.sort(keys, axis=1)[
+        np.arange(num_rows), np.maximum(num_to_predict - 1, 0)]
+    selected = (keys <= threshold[:, None]) & (num_to_predict > 0)[:, None]
+
+    # selected positions first, in increasing order
+    num_slots = min(max_predictions_per_seq, seq_length)
+    positions = np.argsort(~selected, axis=1, kind='stable')[:, :num_slots]
+    weights = np.arange(num_slots) < num_to_predict[:, None]
+    positions = np.where(weights, positions, 0)
+    labels = np.where(
+        weights, np.take_along_axis(input_ids, positions, axis=1), 0)
+
+    use_mask = rng.random_sample(positions.shape) < mask_prob
+    keep = rng.random_sample(positions.shape) < 0.5
+    random_items = item_ids[rng.randint(len(item_ids), size=positions.shape)]
+    masked_tokens = np.where(use_mask, mask_id,
+                             np.where(keep, labels, random_items))
+
+    output_ids = input_ids.copy()
+    rows, slots = np.nonzero(weights)
+    output_ids[rows, positions[rows, slots]] = masked_tokens[rows, slots]
+
+    pad = max_predictions_per_seq - num_slots
+    masked_lm_positions = np.pad(positions, [[0, 0], [0, pad]])
+    masked_lm_ids = np.pad(labels, [[0, 0], [0, pad]])
+    masked_lm_weights = np.pad(weights, [[0, 0], [0, pad]]).astype(np.float32)
+    return output_ids, masked_lm_positions, masked_lm_ids, masked_lm_weights
+
+
 def gen_samples(data,
                 output_filename,
                 rng,
@@ -485,19 +1081,59 @@ def gen_samples(data,
                 max_predictions_per_seq,
                 prop_sliding_window,
                 pool_size,
-                force_last=False):
-    # create train
+                force_last=False,
+                batch_masking=True,
+                num_shards=1,
+                shuffle_buffer_size=100000,
+                dynamic_masking=False,
+                record_format='padded',
+                pack=False):
+    if not force_last:
+        # create train
+        return write_train_shards(
+            data, output_filename, rng, vocab, max_seq_length, dupe_factor,
+            short_seq_prob, masked_lm_prob, max_predictions_per_seq,
+            mask_prob, prop_sliding_window, pool_size, num_shards,
+            shuffle_buffer_size, batch_masking, dynamic_masking,
+            record_format, pack)
+
     instances = create_training_instances(
         data, max_seq_length, dupe_factor, short_seq_prob, masked_lm_prob,
         max_predictions_per_seq, rng, vocab, mask_prob, prop_sliding_window,
-        pool_size, force_last)
+        force_last, batch_masking)
+
+    if record_format == 'npy':
+        write_instance_to_npy_files(instances, max_seq_length,
+                                    max_predictions_per_seq, output_filename,
+                                    rng)
+        return [output_filename]
 
+    output_files = shard_filenames(output_filename, num_shards)
     tf.get_logger().info("*** Writing to output files ***")
-    tf.get_logger().info("  %s", output_filename)
+    for output_file in output_files:
+        tf.get_logger().info("  %s", output_file)
 
     write_instance_to_example_files(instances, max_seq_length,
-                                    max_predictions_per_seq, vocab,
-                                    [output_filename])
+                                    max_predictions_per_seq, output_files,
+                                    rng, shuffle_buffer_size,
+                                    record_format == 'compact')
+    return output_files
+
+
+def shard_filenames(output_filename, num_shards):
+    """`output_filename` itself, or `<output_filename>-0000i-of-0000N`."""
+    if num_shards <= 1:
+        return [output_filename]
+    return ['%s-%05d-of-%05d' % (output_filename, i, num_shards)
+            for i in range(num_shards)]
+
+
+def convert_documents(vocab, seqs):
+    """Maps lists of raw item ids to vocab id arrays with one lookup."""
+    if not seqs:
+        return []
+    ids = vocab.convert_items_to_ids(np.concatenate(seqs))
+    return np.split(ids, np.cumsum([len(seq) for seq in seqs])[:-1])
 
 
 def main():
@@ -510,6 +1146,15 @@ def main():
     dupe_factor = FLAGS.dupe_factor
     prop_sliding_window = FLAGS.prop_sliding_window
     pool_size = FLAGS.pool_size
+    batch_masking = FLAGS.batch_masking
+    num_shards = FLAGS.num_shards or pool_size
+    shuffle_buffer_size = FLAGS.shuffle_buffer_size
+    record_format = FLAGS.record_format
+    if FLAGS.pack_sequences and FLAGS.dynamic_masking:
+        raise ValueError("pack_sequences needs masked windows, it does not "
+                         "work with dynamic_masking")
+    # npy outputs are prefixes of the .<field>.npy arrays
+    suffix = '' if record_format == 'npy' else '.tfrecord'
 
     output_dir = FLAGS.data_dir
     dataset_name = FLAGS.dataset_name
@@ -521,7 +1166,10 @@ def main():
         print(os.getcwd())
         exit(1)
 
-    dataset = data_partition(output_dir+dataset_name+'.txt')
+    if FLAGS.input_format == 'csr':
+        dataset = data_partition_csr(output_dir + dataset_name)
+    else:
+        dataset = data_partition_fast(output_dir + dataset_name + '.txt')
     [user_train, user_valid, user_test, usernum, itemnum] = dataset
     cc = 0.0
     max_len = 0
@@ -550,27 +1198,26 @@ def main():
         if u in user_valid:
             user_train[u].extend(user_valid[u])
 
-    # get the max index of the data
-    user_train_data = {
-        'user_' + str(k): ['item_' + str(item) for item in v]
-        for k, v in user_train.items() if len(v) > 0
-    }
-    user_test_data = {
-        'user_' + str(u):
-            ['item_' + str(item) for item in (user_train[u] + user_test[u])]
-        for u in user_train if len(user_train[u]) > 0 and len(user_test[u]) > 0
-    }
-    rng = random.Random(random_seed)
-
-    vocab = FreqVocab(user_test_data)
-    user_test_data_output = {
-        k: [vocab.convert_tokens_to_ids(v)]
-        for k, v in user_test_data.items()
-    }
+    # documents are vocab id arrays keyed by the integer user id
+    test_users = [
+        u for u in user_train
+        if len(user_train[u]) > 0 and len(user_test[u]) > 0
+    ]
+    test_seqs = [user_train[u] + user_test[u] for u in test_users]
+    rng = random.Random(FLAGS.random_seed)
+
+    vocab = FreqVocab(dict(zip(test_users, test_seqs)))
+
+    train_users = [u for u, v in user_train.items() if len(v) > 0]
+    train_ids = convert_documents(
+        vocab, [user_train[u] for u in train_users])
+    test_ids = convert_documents(vocab, test_seqs)
+    user_train_data = dict(zip(train_users, train_ids))
+    user_test_data = dict(zip(test_users, test_ids))
 
     print('begin to generate train')
-    output_filename = output_dir + dataset_name + version_id + '.train.tfrecord'
-    gen_samples(
+    output_filename = output_dir + dataset_name + version_id + '.train' + suffix
+    output_files = gen_samples(
         user_train_data,
         output_filename,
         rng,
@@ -583,11 +1230,17 @@ def main():
         max_predictions_per_seq,
         prop_sliding_window,
         pool_size,
-        force_last=False)
-    print('train:{}'.format(output_filename))
+        force_last=False,
+        batch_masking=batch_masking,
+        num_shards=num_shards,
+        shuffle_buffer_size=shuffle_buffer_size,
+        dynamic_masking=FLAGS.dynamic_masking,
+        record_format=record_format,
+        pack=FLAGS.pack_sequences)
+    print('train:{}'.format(','.join(output_files)))
 
     print('begin to generate test')
-    output_filename = output_dir + dataset_name + version_id + '.test.tfrecord'
+    output_filename = output_dir + dataset_name + version_id + '.test' + suffix
     gen_samples(
         user_test_data,
         output_filename,
@@ -601,7 +1254,9 @@ def main():
         max_predictions_per_seq,
         -1.0,
         pool_size,
-        force_last=True)
+        force_last=True,
+        shuffle_buffer_size=shuffle_buffer_size,
+        record_format=record_format)
     print('test:{}'.format(output_filename))
 
     print('vocab_size:{}, user_size:{}, item_size:{}, item_with_other_size:{}'.
@@ -610,14 +1265,12 @@ def main():
                  vocab.get_item_count(),
                  vocab.get_item_count() + vocab.get_special_token_count()))
     vocab_file_name = output_dir + dataset_name + version_id + '.vocab'
-    print('vocab pickle file: ' + vocab_file_name)
-    with open(vocab_file_name, 'wb') as output_file:
-        pickle.dump(vocab, output_file, protocol=2)
+    print('vocab file: ' + vocab_file_name + '.{meta,items,counts}.npy')
+    save_vocab(vocab, vocab_file_name)
 
     his_file_name = output_dir + dataset_name + version_id + '.his'
-    print('test data pickle file: ' + his_file_name)
-    with open(his_file_name, 'wb') as output_file:
-        pickle.dump(user_test_data_output, output_file, protocol=2)
+    print('test data file: ' + his_file_name + '.{users,offsets,items}.npy')
+    save_history(his_file_name, test_users, test_ids)
     print('done.')
 
 
@@ -0,0 +1,150 @@
+import unittest
+
+import numpy as np
+
+import gen_data
+
+MAX_SEQ_LENGTH = 50
+MASK_ID = 1003
+ITEM_IDS = np.arange(1, 1001)
+
+
+def make_input_ids(num_rows, seed=0):
+    """A padded id matrix of item windows of every length 1..50."""
+    rng = np.random.RandomState(seed)
+    lengths = np.arange(num_rows) % MAX_SEQ_LENGTH + 1
+    input_ids = rng.randint(1, len(ITEM_IDS) + 1,
+                            size=(num_rows, MAX_SEQ_LENGTH)).astype(np.int32)
+    input_ids[np.arange(MAX_SEQ_LENGTH) >= lengths[:, None]] = 0
+    return input_ids, lengths
+
+
+class MaskedLmPredictionsBatchTest(unittest.TestCase):
+
+    def mask(self, input_ids, masked_lm_prob=0.2, max_predictions_per_seq=10,
+             mask_prob=0.8, seed=1):
+        return gen_data.create_masked_lm_predictions_batch(
+            input_ids, masked_lm_prob, max_predictions_per_seq, ITEM_IDS,
+            MASK_ID, np.random.RandomState(seed), mask_prob)
+
+    def test_mask_counts(self):
+        input_ids, lengths = make_input_ids(500)
+        for masked_lm_prob, max_predictions_per_seq in [(0.2, 10), (0.5, 10),
+                                                        (1.0, 60)]:
+            (_, positions, labels, weights) = self.mask(
+                input_ids, masked_lm_prob, max_predictions_per_seq)
+            self.assertEqual(positions.shape, (500, max_predictions_per_seq))
+            self.assertEqual(labels.shape, (500, max_predictions_per_seq))
+            self.assertEqual(weights.shape, (500, max_predictions_per_seq))
+
+            expected = np.minimum(
+                max_predictions_per_seq,
+                np.maximum(1, np.round(lengths * masked_lm_prob)))
+            num_masked = weights.sum(axis=1)
+            np.testing.assert_array_equal(num_masked, expected)
+            self.assertLessEqual(num_masked.max(), max_predictions_per_seq)
+            # the weights are a prefix of ones
+            np.testing.assert_array_equal(
+                weights, np.arange(max_predictions_per_seq) < num_masked[:, None])
+
+    def test_positions_and_labels(self):
+        input_ids, lengths = make_input_ids(500)
+        output_ids, positions, labels, weights = self.mask(input_ids)
+        for row in range(len(input_ids)):
+            num_masked = int(weights[row].sum())
+            row_positions = positions[row, :num_masked]
+            # distinct item positions, in increasing order
+            self.assertTrue(np.all(np.diff(row_positions) > 0))
+            self.assertTrue(np.all(row_positions < lengths[row]))
+            np.testing.assert_array_equal(labels[row, :num_masked],
+                                          input_ids[row, row_positions])
+            self.assertFalse(positions[row, num_masked:].any())
+            self.assertFalse(labels[row, num_masked:].any())
+
+            # only the masked positions change
+            changed = np.flatnonzero(output_ids[row] != input_ids[row])
+            self.assertTrue(set(changed) <= set(row_positions))
+            for token in output_ids[row, row_positions]:
+                self.assertTrue(token == MASK_ID or token in ITEM_IDS)
+
+    def test_mask_prob(self):
+        input_ids, _ = make_input_ids(2000)
+        output_ids, positions, _, weights = self.mask(input_ids, mask_prob=1.0)
+        masked = np.take_along_axis(output_ids, positions, axis=1)
+        self.assertTrue(np.all(masked[weights > 0] == MASK_ID))
+
+        output_ids, positions, _, weights = self.mask(input_ids, mask_prob=0.8)
+        masked = np.take_along_axis(output_ids, positions, axis=1)
+        share = np.mean(masked[weights > 0] == MASK_ID)
+        self.assertAlmostEqual(share, 0.8, delta=0.02)
+
+    def test_special_tokens_are_not_masked(self):
+        input_ids, _ = make_input_ids(200)
+        # a window of special tokens only has nothing to mask
+        input_ids[0, :5] = MASK_ID
+        input_ids[0, 5:] = 0
+        output_ids, _, _, weights = self.mask(input_ids)
+        self.assertEqual(weights[0].sum(), 0)
+        np.testing.assert_array_equal(output_ids[0], input_ids[0])
+
+    def test_seeded(self):
+        input_ids, _ = make_input_ids(100)
+        for a, b in zip(self.mask(input_ids, seed=7),
+                        self.mask(input_ids, seed=7)):
+            np.testing.assert_array_equal(a, b)
+
+
+class PackInstancesTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        documents = {
+            user: [rng.randint(1, len(ITEM_IDS) + 1, size=length).tolist()
+                   for length in rng.randint(1, 30, size=3)]
+            for user in range(1, 101)}
+        self.instances = gen_data.create_instances_batch(
+            documents, MAX_SEQ_LENGTH, 0.2, 10, ITEM_IDS, MASK_ID, rng, 0.8)
+
+    def unpack(self, row):
+        """The (tokens, positions, labels) of every segment of a row, with
+        positions relative to the segment."""
+        segment_ids = np.array(row.segment_ids)
+        positions = np.array(row.masked_lm_positions)
+        labels = np.array(row.masked_lm_labels)
+        tokens = np.array(row.tokens)
+        segments = []
+        for segment in np.unique(segment_ids):
+            index = np.flatnonzero(segment_ids == segment)
+            in_segment = (positions >= index[0]) & (positions <= index[-1])
+            segments.append((tuple(tokens[index]),
+                             tuple(positions[in_segment] - index[0]),
+                             tuple(labels[in_segment])))
+        return segments
+
+    def test_rows_fit(self):
+        rows = gen_data.pack_instances(self.instances, MAX_SEQ_LENGTH, 10)
+        self.assertLess(len(rows), len(self.instances))
+        for row in rows:
+            self.assertLessEqual(len(row.tokens), MAX_SEQ_LENGTH)
+            self.assertLessEqual(len(row.masked_lm_positions), 10)
+            self.assertEqual(len(row.segment_ids), len(row.tokens))
+            # segments are consecutive runs 1, 2, ...
+            segment_ids = np.array(row.segment_ids)
+            self.assertEqual(segment_ids[0], 1)
+            self.assertTrue(np.all(np.diff(segment_ids) >= 0))
+            self.assertTrue(np.all(np.diff(segment_ids) <= 1))
+            self.assertTrue(all(0 <= p < len(row.tokens)
+                                for p in row.masked_lm_positions))
+
+    def test_unpacks_to_instances(self):
+        rows = gen_data.pack_instances(self.instances, MAX_SEQ_LENGTH, 10)
+        packed = sorted(segment for row in rows for segment in self.unpack(row))
+        expected = sorted((tuple(instance.tokens),
+                           tuple(instance.masked_lm_positions),
+                           tuple(instance.masked_lm_labels))
+                          for instance in self.instances)
+        self.assertEqual(packed, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
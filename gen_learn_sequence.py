@@ -1,6 +1,65 @@
+import os
+import sys
+import collections
+import concurrent.futures
+import tempfile
+
+import numpy as np
 import pandas as pd
+from absl import flags
+
+from util import save_sequences
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "input_file", "./data/learn-hist/learn-hist.csv",
+    "learn-hist csv file.")
+
+flags.DEFINE_string(
+    "output_dir", "./data/learn-hist/",
+    "Directory of the sequence files.")
+
+flags.DEFINE_list(
+    "outputs", ["unit_oc"],
+    "Sequence files to write in a single pass over `input_file`, as "
+    "`name[:min_len]` with name one of lesson, lesson_oc, unit, unit_oc.")
+
+flags.DEFINE_integer(
+    "min_seq_length", 5,
+    "Sequences shorter than this are dropped, unless overridden per output.")
+
+flags.DEFINE_bool(
+    "streaming", False,
+    "Read `input_file` in chunks and spill events to disk partitions instead "
+    "of loading it into memory.")
+
+flags.DEFINE_bool(
+    "write_csr", True,
+    "Also write every sequence file in the binary CSR layout read by "
+    "`util.load_sequences` (<name>.users.npy, .offsets.npy, .items.npy).")
+
+flags.DEFINE_bool(
+    "incremental", False,
+    "Only read the events not read yet (after the stored `event_time` "
+    "watermark, or at it and not seen) and append them to the existing "
+    "sequence files. The first run without a stored state builds the files "
+    "from scratch in streaming mode.")
+
+flags.DEFINE_integer(
+    "chunk_size", 1 << 20,
+    "Number of csv rows per chunk in streaming and incremental mode.")
+
+flags.DEFINE_integer(
+    "num_partitions", 64,
+    "Number of on-disk partitions (hashed by student) in streaming mode. "
+    "Peak memory is about one partition.")
+
+flags.DEFINE_string(
+    "spill_dir", None,
+    "Directory for the streaming mode partitions. Defaults to the system "
+    "temp dir.")
 
-df = pd.read_csv("./data/learn-hist/learn-hist.csv")
 # learn-hist.csv columns:
 # student_id           # 학생 ID
 # question_code        # 문항 ID
@@ -11,89 +70,887 @@ df = pd.read_csv("./data/learn-hist/learn-hist.csv")
 # question_difficulty  # 문항 난이도
 # question_correct     # 문항 정답률
 
+# only the columns needed to build the sequences are read.
+USECOLS = ["student_id", "question_code", "correct", "question_grad_unit"]
 
-def lesson_based(df, only_correct = False):
-    sequences = {}
-    for index, row in df.iterrows():
-        if pd.isna(row["question_grad_unit"]):
-            continue
+# sequence key = student_id * student_weight + sum(field * weight)
+# where the fields are grade, semester, unit, lesson of `question_grad_unit`.
+SEQUENCE_KEYS = {
+    "lesson": (10000, (1000, 100, 10, 1)),
+    "unit": (1000, (100, 10, 1)),
+}
 
-        grad_unit = row["question_grad_unit"].split("_")
-        student_id_grad_unit = (
-            row["student_id"] * 10000
-            + int(grad_unit[0][3]) * 1000
-            + int(grad_unit[1]) * 100
-            + int(grad_unit[2]) * 10
-            + int(grad_unit[3])
-        )
-
-        if student_id_grad_unit not in sequences:
-            sequences[student_id_grad_unit] = []
-        sequences[student_id_grad_unit].append(row["question_code"])
-
-    users = 0
-    items = set()
-    actions = 0
-    with open("./data/learn-hist/lesson-based.txt", "w") as file:
-        for id, qc_list in sequences.items(): # student_id, question_code
-            if len(qc_list) < 5:
-                continue
+# name -> (granularity, only_correct, output file name)
+SEQUENCE_OUTPUTS = collections.OrderedDict([
+    ("lesson", ("lesson", False, "lesson-based.txt")),
+    ("lesson_oc", ("lesson", True, "lesson-based-OC.txt")),
+    ("unit", ("unit", False, "unit-based.txt")),
+    ("unit_oc", ("unit", True, "unit-based-OC.txt")),
+])
 
-            users += 1
-            actions += len(qc_list)
-            for qc in qc_list:
-                file.write(f"{id} {qc}\n")
-                items.add(qc)
+SequenceSpec = collections.namedtuple(
+    "SequenceSpec",
+    ["name", "granularity", "only_correct", "output_file", "min_len"])
 
 
-def unit_based(df, only_correct=False):
-    sequences = {}
-    for index, row in df.iterrows():
-        if pd.isna(row["question_grad_unit"]):
-            continue
-        elif only_correct and row["correct"] == 0:
-            continue
+def parse_sequence_specs(outputs, output_dir, min_len=5):
+    """Turns `name[:min_len]` strings into `SequenceSpec`s."""
+    specs = []
+    for output in outputs:
+        name, _, spec_min_len = output.partition(":")
+        if name not in SEQUENCE_OUTPUTS:
+            raise ValueError("Unknown sequence output: %s" % name)
+        granularity, only_correct, file_name = SEQUENCE_OUTPUTS[name]
+        specs.append(SequenceSpec(
+            name, granularity, only_correct,
+            os.path.join(output_dir, file_name),
+            int(spec_min_len) if spec_min_len else min_len))
+    return specs
+
+
+def parse_grad_unit(grad_unit, num_fields=4):
+    """Splits `question_grad_unit` strings (e.g. GR15_1_1_1) into int columns.
+
+    Returns an int64 array of shape [len(grad_unit), num_fields] holding
+    grade (4th character of the first field), semester, unit and lesson.
+    """
+    if len(grad_unit) == 0:
+        return np.zeros((0, num_fields), dtype=np.int64)
+    parts = grad_unit.str.split("_", n=num_fields, expand=True)
+    fields = [parts[0].str[3]] + [parts[i] for i in range(1, num_fields)]
+    return np.stack(
+        [field.astype(np.int64).to_numpy() for field in fields], axis=1)
+
+
+def compose_keys(student_ids, fields, granularity):
+    """Combines student ids and parsed grad_unit fields into sequence keys."""
+    student_weight, field_weights = SEQUENCE_KEYS[granularity]
+    return (student_ids * student_weight
+            + fields[:, :len(field_weights)]
+            @ np.asarray(field_weights, dtype=np.int64))
+
+
+def sequence_keys(events, granularity):
+    """Computes the composite student/grad_unit key of every event."""
+    fields = parse_grad_unit(events["question_grad_unit"],
+                             len(SEQUENCE_KEYS[granularity][1]))
+    return compose_keys(events["student_id"].to_numpy().astype(np.int64),
+                        fields, granularity)
+
+
+def parse_events(df, granularities):
+    """Parses every event of `df` once for all `granularities`.
+
+    Returns:
+        (mask, correct, keys): `mask` selects the events that belong to a
+        sequence. For those events, `correct` tells whether they were solved
+        correctly and `keys[granularity]` holds their sequence keys.
+    """
+    mask = df["question_grad_unit"].notna().to_numpy()
+    events = df[mask]
+    num_fields = max(len(SEQUENCE_KEYS[g][1]) for g in granularities)
+    fields = parse_grad_unit(events["question_grad_unit"], num_fields)
+    student_ids = events["student_id"].to_numpy().astype(np.int64)
+
+    correct = (events["correct"] != 0).to_numpy()
+    keys = {g: compose_keys(student_ids, fields, g) for g in granularities}
+    return mask, correct, keys
+
+
+def event_mask(df, only_correct=False):
+    """Selects the events that belong to a sequence."""
+    mask = df["question_grad_unit"].notna()
+    if only_correct:
+        mask &= df["correct"] != 0
+    return mask.to_numpy()
+
+
+def group_sequences(keys):
+    """Groups events by key in order of first appearance.
+
+    Returns:
+        (unique_keys, lengths, order): `order` sorts the events by sequence
+        and keeps the original event order within every sequence.
+    """
+    codes, unique_keys = pd.factorize(keys)
+    order = np.argsort(codes, kind="stable")
+    lengths = np.bincount(codes, minlength=len(unique_keys))
+    return unique_keys, lengths, order
+
+
+def sequence_positions(starts, lengths):
+    """Positions of sequences of `lengths` that start at `starts`."""
+    return (np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            + np.arange(lengths.sum()))
+
+
+def take_sequences(lengths, items, index):
+    """Gathers the sequences `index` of (lengths, back-to-back items).
+
+    Negative entries of `index` give empty sequences.
+    """
+    index = np.asarray(index, dtype=np.int64)
+    if len(lengths) == 0:
+        return np.zeros(len(index), dtype=np.int64), items[:0]
+    valid = index >= 0
+    taken = np.where(valid, lengths[index], 0)
+    starts = np.where(valid, (np.cumsum(lengths) - lengths)[index], 0)
+    return taken, items[sequence_positions(starts, taken)]
+
+
+def take_or(values, index, default):
+    """`values[index]`, with `default` wherever `index` is negative."""
+    if len(values) == 0:
+        return np.full(len(index), default, dtype=values.dtype)
+    return np.where(index >= 0, values[index], default)
+
+
+def concat_sequences(lengths_a, items_a, lengths_b, items_b):
+    """Appends sequence i of b to sequence i of a for every i."""
+    lengths = lengths_a + lengths_b
+    starts = np.cumsum(lengths) - lengths
+    items = np.empty(int(lengths.sum()),
+                     dtype=np.result_type(items_a, items_b))
+    items[sequence_positions(starts, lengths_a)] = items_a
+    items[sequence_positions(starts + lengths_a, lengths_b)] = items_b
+    return lengths, items
+
+
+def sort_sequences(first_rows, keys, lengths, items):
+    """Reorders whole sequences by the csv row of their first event."""
+    order = np.argsort(first_rows, kind="stable")
+    lengths, items = take_sequences(lengths, items, order)
+    return keys[order], lengths, items
+
+
+def build_sequences(df, granularity, only_correct=False):
+    """Groups events into per-key sequences with vectorized ops.
+
+    Keys keep the order of their first event and every sequence keeps the
+    event order of `df`, the same as appending to a dict row by row.
+
+    Returns:
+        (keys, lengths, items): `items` holds the sequences back to back,
+        `lengths[i]` of them belonging to `keys[i]`.
+    """
+    events = df[event_mask(df, only_correct)]
+
+    keys, lengths, order = group_sequences(sequence_keys(events, granularity))
+    items = events["question_code"].to_numpy()[order]
+    return keys, lengths, items
+
+
+def csr_prefix(output_file):
+    """Prefix of the CSR files (see `util.save_sequences`) of a sequence file."""
+    return os.path.splitext(output_file)[0]
+
+
+class SequenceWriter(object):
+    """Writes sequences as "key item" lines and keeps the dataset stats.
+
+    With `csr_prefix`, the sequences are also written in the binary CSR
+    layout of `util.save_sequences`. Items are streamed to a raw int32 file
+    and only the per-sequence keys and lengths are kept in memory.
+    """
+
+    def __init__(self, output_file, min_len=5, flush_size=1 << 20,
+                 csr_prefix=None):
+        self.output_file = output_file
+        self.min_len = min_len
+        self.flush_size = flush_size
+        self.csr_prefix = csr_prefix
+
+        self.users = 0
+        self.actions = 0
+        self.items = set()
+
+        self._file = open(output_file, "w")
+        self._csr_users = []
+        self._csr_lengths = []
+        self._csr_items_file = None
+        if csr_prefix is not None:
+            self._csr_items_file = open(csr_prefix + ".items.raw", "wb")
+        self._keys = []
+        self._lengths = []
+        self._items = []
+        self._buffered = 0
+
+    def write(self, keys, lengths, items):
+        """Buffers sequences given as (keys, lengths, back-to-back items)."""
+        keep = lengths >= self.min_len
+        if not keep.all():
+            items = items[np.repeat(keep, lengths)]
+            keys = keys[keep]
+            lengths = lengths[keep]
+
+        self._keys.append(keys)
+        self._lengths.append(lengths)
+        self._items.append(items)
+        self._buffered += len(items)
+        if self._buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self._items:
+            return
+        keys = np.concatenate(self._keys)
+        lengths = np.concatenate(self._lengths)
+        items = np.concatenate(self._items)
+        self._keys, self._lengths, self._items = [], [], []
+        self._buffered = 0
+
+        pd.DataFrame({
+            "key": np.repeat(keys, lengths),
+            "item": items,
+        }).to_csv(self._file, sep=" ", header=False, index=False)
+        if self._csr_items_file is not None:
+            self._csr_users.append(keys.astype(np.int64))
+            self._csr_lengths.append(lengths.astype(np.int64))
+            items.astype(np.int32).tofile(self._csr_items_file)
+
+        self.users += len(keys)
+        self.actions += len(items)
+        self.items.update(pd.unique(items).tolist())
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        if self._csr_items_file is not None:
+            self._csr_items_file.close()
+            self._save_csr()
+
+    def _save_csr(self):
+        raw_file = self.csr_prefix + ".items.raw"
+        lengths = np.concatenate(self._csr_lengths or [np.zeros(0, np.int64)])
+        if lengths.sum():
+            items = np.memmap(raw_file, dtype=np.int32, mode="r")
+        else:
+            items = np.zeros(0, dtype=np.int32)
+        save_sequences(
+            self.csr_prefix,
+            np.concatenate(self._csr_users or [np.zeros(0, np.int64)]),
+            np.concatenate([[0], np.cumsum(lengths)]),
+            items)
+        del items
+        os.remove(raw_file)
+
+    def print_stats(self):
+        print("#users:", self.users)
+        print("#items:", len(self.items))
+        print("#actions:", self.actions)
+        print("Avg. length:", self.actions / self.users if self.users else 0.0)
+
+
+def write_sequences(output_file, keys, lengths, items, min_len=5,
+                    write_csr=False):
+    """Writes sequences with at least `min_len` events as "key item" lines."""
+    writer = SequenceWriter(
+        output_file, min_len,
+        csr_prefix=csr_prefix(output_file) if write_csr else None)
+    writer.write(keys, lengths, items)
+    writer.close()
+    writer.print_stats()
+    return writer
+
+
+def run_writers(specs, write_fn):
+    """Runs `write_fn(spec)` for every spec in parallel and prints the stats.
+
+    Grouping and csv formatting are mostly numpy/pandas work that releases
+    the GIL, so one thread per output is enough to overlap them.
+    """
+    with concurrent.futures.ThreadPoolExecutor(len(specs)) as pool:
+        writers = list(pool.map(write_fn, specs))
+    for spec, writer in zip(specs, writers):
+        print("[{}] {}".format(spec.name, spec.output_file))
+        writer.print_stats()
+    return writers
+
+
+def build_all_sequences(df, specs, write_csr=False):
+    """Parses `df` once and writes every `SequenceSpec` in `specs`."""
+    mask, correct, keys = parse_events(
+        df, sorted(set(spec.granularity for spec in specs)))
+    items = df["question_code"].to_numpy()[mask]
+
+    def write(spec):
+        spec_keys, spec_items = keys[spec.granularity], items
+        if spec.only_correct:
+            spec_keys, spec_items = spec_keys[correct], spec_items[correct]
+        unique_keys, lengths, order = group_sequences(spec_keys)
+
+        writer = SequenceWriter(
+            spec.output_file, spec.min_len,
+            csr_prefix=csr_prefix(spec.output_file) if write_csr else None)
+        writer.write(unique_keys, lengths, spec_items[order])
+        writer.close()
+        return writer
+
+    return run_writers(specs, write)
+
+
+def spill_events(input_file, granularities, spill_dir, num_partitions,
+                 chunk_size, watermark=None):
+    """Streams `input_file` in chunks into partitions hashed by student.
+
+    Every partition file holds int64 (row, item, correct, keys...) records in
+    row order, one key column per granularity, so all events of a sequence
+    end up in the same partition. With a `Watermark`, it is moved over every
+    event read.
 
-        grad_unit = row["question_grad_unit"].split("_")
-        student_id_grad_unit = (
-            row["student_id"] * 1000
-            + int(grad_unit[0][3]) * 100
-            + int(grad_unit[1]) * 10
-            + int(grad_unit[2])
-        )
-
-        if student_id_grad_unit not in sequences:
-            sequences[student_id_grad_unit] = []
-        sequences[student_id_grad_unit].append(row["question_code"])
-
-    users = 0
-    items = set()
-    actions = 0
-    with open("./data/learn-hist/unit-based-OC.txt", "w") as file:
-        for id, qc_list in sequences.items():  # student_id, question_code
-            if len(qc_list) < 5:
+    Returns:
+        (paths, num_rows): the partition files and the number of csv rows.
+    """
+    paths = [
+        os.path.join(spill_dir, "events-%05d.bin" % i)
+        for i in range(num_partitions)
+    ]
+    files = [open(path, "wb") for path in paths]
+    num_rows = 0
+    usecols = USECOLS + ["event_time"] if watermark is not None else USECOLS
+    try:
+        for chunk in pd.read_csv(input_file, usecols=usecols,
+                                 chunksize=chunk_size):
+            if watermark is not None:
+                watermark.update(chunk)
+            mask, correct, keys = parse_events(chunk, granularities)
+            rows = np.arange(num_rows, num_rows + len(chunk), dtype=np.int64)
+            num_rows += len(chunk)
+            events = chunk[mask]
+
+            records = np.stack([
+                rows[mask],
+                events["question_code"].to_numpy().astype(np.int64),
+                correct.astype(np.int64),
+            ] + [keys[g] for g in granularities], axis=1)
+            partitions = events["student_id"].to_numpy() % num_partitions
+            order = np.argsort(partitions, kind="stable")
+            bounds = np.searchsorted(partitions[order],
+                                     np.arange(num_partitions + 1))
+            records = records[order]
+            for i in np.flatnonzero(np.diff(bounds)):
+                records[bounds[i]:bounds[i + 1]].tofile(files[i])
+    finally:
+        for f in files:
+            f.close()
+    return paths, num_rows
+
+
+def group_partition(path, granularities, specs, keep_state=False):
+    """Groups one spilled partition into sequences and stores them as .npy.
+
+    For every spec, writes the `first_rows`, `keys`, `offsets` and `items`
+    arrays with sequences ordered by the csv row of their first event. With
+    `keep_state`, also writes the `state_keys`, `state_first_rows`,
+    `state_lengths` of all sequences and the `pending_items` of those shorter
+    than `min_len`, for `load_sequence_state`.
+
+    Returns:
+        A dict of spec name -> prefix of its arrays.
+    """
+    records = np.fromfile(path, dtype=np.int64).reshape(
+        -1, 3 + len(granularities))
+    os.remove(path)
+
+    prefixes = {}
+    for spec in specs:
+        spec_records = records
+        if spec.only_correct:
+            spec_records = records[records[:, 2] != 0]
+        key_column = 3 + granularities.index(spec.granularity)
+
+        keys, lengths, order = group_sequences(spec_records[:, key_column])
+        first_rows = spec_records[order[np.cumsum(lengths) - lengths], 0]
+        items = spec_records[order, 1]
+
+        keep = lengths >= spec.min_len
+        prefix = "%s.%s" % (path[:-len(".bin")], spec.name)
+        if keep_state:
+            np.save(prefix + ".state_keys.npy", keys)
+            np.save(prefix + ".state_first_rows.npy", first_rows)
+            np.save(prefix + ".state_lengths.npy", lengths)
+            np.save(prefix + ".pending_items.npy",
+                    items[np.repeat(~keep, lengths)])
+        items = items[np.repeat(keep, lengths)]
+        lengths = lengths[keep]
+
+        np.save(prefix + ".first_rows.npy", first_rows[keep])
+        np.save(prefix + ".keys.npy", keys[keep])
+        np.save(prefix + ".offsets.npy",
+                np.concatenate([[0], np.cumsum(lengths)]))
+        np.save(prefix + ".items.npy", items)
+        prefixes[spec.name] = prefix
+    return prefixes
+
+
+def merge_partitions(prefixes, num_rows, window, writer):
+    """Merges grouped partitions back into first-event order.
+
+    Sequences are handed to `writer` in windows of `window` csv rows, so only
+    the sequences starting inside the current window are held in memory.
+    """
+    parts = []
+    for prefix in prefixes:
+        parts.append([
+            np.load(prefix + ".%s.npy" % name, mmap_mode="r")
+            for name in ("first_rows", "keys", "offsets", "items")
+        ])
+    cursors = [0] * len(parts)
+
+    for window_end in range(window, num_rows + window, window):
+        first_rows, keys, lengths, items = [], [], [], []
+        for i, (part_rows, part_keys, part_offsets, part_items) in enumerate(parts):
+            begin = cursors[i]
+            end = int(np.searchsorted(part_rows, window_end))
+            if begin == end:
                 continue
+            cursors[i] = end
+            first_rows.append(part_rows[begin:end])
+            keys.append(part_keys[begin:end])
+            lengths.append(np.diff(part_offsets[begin:end + 1]))
+            items.append(part_items[part_offsets[begin]:part_offsets[end]])
+        if not first_rows:
+            continue
+
+        writer.write(*sort_sequences(
+            np.concatenate(first_rows), np.concatenate(keys),
+            np.concatenate(lengths), np.concatenate(items)))
+
+
+def build_all_sequences_streaming(input_file, specs, num_partitions=64,
+                                  chunk_size=1 << 20, spill_dir=None,
+                                  write_csr=False, save_state=False):
+    """Builds the same sequence files as `build_all_sequences` with bounded
+    memory.
+
+    The csv is read once in chunks of `chunk_size` rows and spilled to
+    `num_partitions` partitions hashed by student. Every partition is then
+    grouped on its own and the partitions are merged back in first-event order.
+
+    With `save_state`, also saves the state of `--incremental` for every
+    output, so later runs append to the files.
+    """
+    granularities = sorted(set(spec.granularity for spec in specs))
+    watermark = Watermark() if save_state else None
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        paths, num_rows = spill_events(input_file, granularities, tmp_dir,
+                                       num_partitions, chunk_size, watermark)
+        prefixes = [
+            group_partition(path, granularities, specs, save_state)
+            for path in paths
+        ]
+
+        def write(spec):
+            writer = SequenceWriter(
+                spec.output_file, spec.min_len,
+                csr_prefix=csr_prefix(spec.output_file) if write_csr else None)
+            merge_partitions([p[spec.name] for p in prefixes], num_rows,
+                             chunk_size, writer)
+            writer.close()
+            if save_state:
+                state = merge_partition_states(
+                    [p[spec.name] for p in prefixes], spec.min_len)
+                state["watermark"] = watermark.value
+                state["watermark_hashes"] = watermark.hashes
+                state["num_rows"] = num_rows
+                save_sequence_state(spec, state)
+                long_enough = state["lengths"] >= spec.min_len
+                np.savetxt(spec.output_file + ".changed",
+                           state["keys"][long_enough], fmt="%d")
+            return writer
+
+        return run_writers(specs, write)
+
+
+def merge_partition_states(prefixes, min_len):
+    """Concatenates the per-partition state arrays of `group_partition`."""
+    state = {"min_len": min_len}
+    for name, state_name in (("state_keys", "keys"),
+                             ("state_first_rows", "first_rows"),
+                             ("state_lengths", "lengths"),
+                             ("pending_items", "pending_items")):
+        state[state_name] = np.concatenate(
+            [np.zeros(0, dtype=np.int64)] +
+            [np.load(prefix + ".%s.npy" % name) for prefix in prefixes]
+        ).astype(np.int64)
+    return state
+
+
+def build_sequences_streaming(input_file, granularity, only_correct,
+                              output_file, min_len=5, num_partitions=64,
+                              chunk_size=1 << 20, spill_dir=None):
+    """Streaming version of `build_sequences` + `write_sequences`."""
+    spec = SequenceSpec(granularity, granularity, only_correct, output_file,
+                        min_len)
+    return build_all_sequences_streaming(input_file, [spec], num_partitions,
+                                         chunk_size, spill_dir)[0]
+
+
+def load_sequence_state(spec):
+    """Loads the incremental state stored next to `spec.output_file`.
+
+    The state holds the `event_time` watermark, the hashes of the events read
+    at that time (see `Watermark`), the number of csv rows read so far and,
+    for every sequence key, the row of its first event and its length.
+    Sequences shorter than `min_len` are not in the output file yet, so their
+    events are kept in `pending_items`.
+    """
+    path = spec.output_file + ".state.npz"
+    if not os.path.exists(path):
+        return {
+            "watermark": "",
+            "watermark_hashes": np.zeros(0, dtype=np.uint64),
+            "num_rows": 0,
+            "min_len": spec.min_len,
+            "keys": np.zeros(0, dtype=np.int64),
+            "first_rows": np.zeros(0, dtype=np.int64),
+            "lengths": np.zeros(0, dtype=np.int64),
+            "pending_items": np.zeros(0, dtype=np.int64),
+        }
+
+    with np.load(path) as data:
+        state = {name: data[name] for name in data.files}
+    state["watermark"] = str(state["watermark"])
+    # states of older versions read every event at their watermark
+    state.setdefault("watermark_hashes", None)
+    state["num_rows"] = int(state["num_rows"])
+    state["min_len"] = int(state["min_len"])
+    if state["min_len"] != spec.min_len:
+        raise ValueError(
+            "%s was built with min_len=%d, got min_len=%d. Remove the state "
+            "file to rebuild it." % (spec.output_file, state["min_len"],
+                                     spec.min_len))
+    return state
+
+
+def save_sequence_state(spec, state):
+    path = spec.output_file + ".state.npz"
+    state = dict(state)
+    if state.get("watermark_hashes") is None:
+        state.pop("watermark_hashes", None)
+    with open(path + ".tmp", "wb") as output_file:
+        np.savez(output_file, **state)
+    os.replace(path + ".tmp", path)
+
+
+def has_sequence_state(spec):
+    return os.path.exists(spec.output_file + ".state.npz")
+
+
+def event_hashes(events):
+    """A hash of the csv fields of every event, to tell apart the events of
+    one `event_time`."""
+    return pd.util.hash_pandas_object(
+        events[USECOLS + ["event_time"]].astype(str), index=False).to_numpy()
+
+
+class Watermark(object):
+    """The latest `event_time` read and the hashes of the events read at that
+    time. `event_time` has a resolution of a second, so more events of the
+    same second can come after a run; only the ones whose hash was not read
+    yet are new.
+
+    `hashes` None means all events at `value` were read.
+    """
+
+    def __init__(self, value="", hashes=()):
+        self.value = value
+        self.hashes = (None if hashes is None
+                       else np.asarray(hashes, dtype=np.uint64))
 
-            users += 1
-            actions += len(qc_list)
-            for qc in qc_list:
-                file.write(f"{id} {qc}\n")
-                items.add(qc)
+    def new_events(self, events):
+        """Marks the events that are after the watermark, or at it and not
+        read yet. An event read k times at the watermark skips its first k
+        occurrences."""
+        times = events["event_time"]
+        is_new = (times > self.value).to_numpy().copy()
+        tie = (times == self.value).to_numpy()
+        if self.hashes is not None and tie.any():
+            hashes = event_hashes(events[tie])
+            occurrence = pd.Series(hashes).groupby(hashes).cumcount()
+            seen = pd.Series(self.hashes).value_counts()
+            is_new[tie] = (occurrence.to_numpy() >=
+                           seen.reindex(hashes, fill_value=0).to_numpy())
+        return is_new
 
-    print("#users:", users)
-    print("#items:", len(items))
-    print("#actions:", actions)
-    print("Avg. length:", actions/users)
+    def update(self, events):
+        """Moves the watermark over `events`, all of them new."""
+        times = events["event_time"].dropna()
+        if len(times) == 0:
+            return
+        latest = times.max()
+        if latest < self.value:
+            return
+        at_latest = event_hashes(events[(events["event_time"] == latest)
+                                        .to_numpy()])
+        if latest > self.value:
+            self.value, self.hashes = latest, at_latest
+        elif self.hashes is not None:
+            self.hashes = np.concatenate([self.hashes, at_latest])
+
+
+def read_sequence_blocks(path, chunk_size):
+    """Yields (keys, lengths, items) of a "key item" file a chunk at a time.
+
+    A sequence cut by the end of a chunk is carried over to the next one.
+    """
+    carry_keys = np.zeros(0, dtype=np.int64)
+    carry_items = np.zeros(0, dtype=np.int64)
+    for chunk in pd.read_csv(path, sep=" ", header=None, names=["key", "item"],
+                             dtype=np.int64, chunksize=chunk_size):
+        keys = np.concatenate([carry_keys, chunk["key"].to_numpy()])
+        items = np.concatenate([carry_items, chunk["item"].to_numpy()])
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        cut = starts[-1]
+        carry_keys, carry_items = keys[cut:], items[cut:]
+        if cut:
+            yield keys[starts[:-1]], np.diff(starts), items[:cut]
+    if len(carry_keys):
+        yield carry_keys[:1], np.array([len(carry_keys)]), carry_items
+
+
+def append_sequences(spec, state, rows, keys, items, chunk_size,
+                     write_csr=False):
+    """Appends new events to the sequences of `spec.output_file`.
+
+    Sequences that already are in the file get the new events appended,
+    sequences that reach `min_len` are inserted at the position of their
+    first event, so the file is the same as one built from all events.
+
+    Args:
+        rows: csv row number of every new event.
+        keys: sequence key of every new event.
+        items: question_code of every new event.
+
+    Returns:
+        (writer, changed): the `SequenceWriter` of the rewritten file and the
+        keys of the sequences that changed in it.
+    """
+    min_len = spec.min_len
+    new_keys, new_lengths, order = group_sequences(keys)
+    new_first_rows = rows[order[np.cumsum(new_lengths) - new_lengths]]
+    new_items = items[order]
+
+    old_keys = state["keys"]
+    old_lengths = state["lengths"]
+    old_first_rows = state["first_rows"]
+    old_index = pd.Index(old_keys)
+    pending = old_lengths < min_len
+    pending_lengths = old_lengths[pending]
+    pending_rows = np.where(pending, np.cumsum(pending) - 1, -1)
+
+    position = old_index.get_indexer(new_keys)
+    known = position >= 0
+    lengths_before = take_or(old_lengths, position, 0)
+    appended = known & (lengths_before >= min_len)
+    inserted = ~appended & (lengths_before + new_lengths >= min_len)
+
+    # sequences that reach min_len: pending events + new events
+    inserted = np.flatnonzero(inserted)
+    ins_lengths, ins_items = concat_sequences(
+        *take_sequences(pending_lengths, state["pending_items"],
+                        take_or(pending_rows, position[inserted], -1)),
+        *take_sequences(new_lengths, new_items, inserted))
+    ins_first_rows = np.where(known[inserted],
+                              take_or(old_first_rows, position[inserted], -1),
+                              new_first_rows[inserted])
+    ins_order = np.argsort(ins_first_rows, kind="stable")
+    ins_first_rows = ins_first_rows[ins_order]
+    ins_keys = new_keys[inserted][ins_order]
+    ins_lengths, ins_items = take_sequences(ins_lengths, ins_items, ins_order)
+
+    tmp_file = spec.output_file + ".tmp"
+    writer = SequenceWriter(
+        tmp_file, min_len,
+        csr_prefix=csr_prefix(spec.output_file) if write_csr else None)
+    new_index = pd.Index(new_keys)
+    cursor = 0
+    if not pending.all() and os.path.exists(spec.output_file):
+        for blk_keys, blk_lengths, blk_items in read_sequence_blocks(
+                spec.output_file, chunk_size):
+            blk_lengths, blk_items = concat_sequences(
+                blk_lengths, blk_items,
+                *take_sequences(new_lengths, new_items,
+                                new_index.get_indexer(blk_keys)))
+            blk_first_rows = old_first_rows[old_index.get_indexer(blk_keys)]
+
+            end = int(np.searchsorted(ins_first_rows, blk_first_rows[-1]))
+            ins_lengths_part, ins_items_part = take_sequences(
+                ins_lengths, ins_items, np.arange(cursor, end))
+            writer.write(*sort_sequences(
+                np.concatenate([blk_first_rows, ins_first_rows[cursor:end]]),
+                np.concatenate([blk_keys, ins_keys[cursor:end]]),
+                np.concatenate([blk_lengths, ins_lengths_part]),
+                np.concatenate([blk_items, ins_items_part])))
+            cursor = end
+    ins_lengths_part, ins_items_part = take_sequences(
+        ins_lengths, ins_items, np.arange(cursor, len(ins_keys)))
+    writer.write(ins_keys[cursor:], ins_lengths_part, ins_items_part)
+    writer.close()
+    os.replace(tmp_file, spec.output_file)
+
+    # update the state, sequences still shorter than min_len stay pending
+    fresh = np.flatnonzero(~known)
+    keys_after = np.concatenate([old_keys, new_keys[fresh]])
+    new_rows_after = np.full(len(keys_after), -1, dtype=np.int64)
+    new_rows_after[position[known]] = np.flatnonzero(known)
+    new_rows_after[len(old_keys):] = fresh
+    lengths_after = np.concatenate(
+        [old_lengths, np.zeros(len(fresh), dtype=np.int64)])
+    lengths_after += take_sequences(new_lengths, new_items, new_rows_after)[0]
+
+    still_pending = np.flatnonzero(lengths_after < min_len)
+    pending_rows_after = np.concatenate(
+        [pending_rows, np.full(len(fresh), -1, dtype=np.int64)])
+    _, pending_items = concat_sequences(
+        *take_sequences(pending_lengths, state["pending_items"],
+                        pending_rows_after[still_pending]),
+        *take_sequences(new_lengths, new_items,
+                        new_rows_after[still_pending]))
+
+    state["keys"] = keys_after
+    state["lengths"] = lengths_after
+    state["first_rows"] = np.concatenate(
+        [old_first_rows, new_first_rows[fresh]])
+    state["pending_items"] = pending_items.astype(np.int64)
+
+    changed = np.concatenate([new_keys[appended], ins_keys])
+    return writer, changed
+
+
+def build_all_sequences_incremental(input_file, specs, chunk_size=1 << 20,
+                                    write_csr=False, num_partitions=64,
+                                    spill_dir=None):
+    """Appends the events newer than each output's watermark to its file.
+
+    Only the rows at or after the oldest watermark are kept while reading
+    `input_file`, and the rows at a watermark that were read before are
+    skipped (see `Watermark`). New events are numbered after the rows
+    already read, so `input_file` can be either the whole (append-only)
+    learn-hist.csv or a file with only the new events. Rows older than the
+    watermark, e.g. late events, cannot be appended and are counted.
+
+    Outputs without a stored state are built from scratch with
+    `build_all_sequences_streaming`, which also saves their state.
+
+    The keys of the changed sequences of every output are written to
+    `<output_file>.changed`, one per line.
+    """
+    fresh = [spec for spec in specs if not has_sequence_state(spec)]
+    specs = [spec for spec in specs if has_sequence_state(spec)]
+    writers = []
+    if fresh:
+        print("no state for {}, building from scratch".format(
+            ",".join(spec.name for spec in fresh)))
+        writers = build_all_sequences_streaming(
+            input_file, fresh, num_partitions, chunk_size, spill_dir,
+            write_csr, save_state=True)
+    if not specs:
+        return writers
+
+    states = {spec.name: load_sequence_state(spec) for spec in specs}
+    watermarks = {
+        name: Watermark(state["watermark"], state["watermark_hashes"])
+        for name, state in states.items()}
+    watermark = min(state["watermark"] for state in states.values())
+
+    chunks = []
+    num_behind = 0
+    for chunk in pd.read_csv(input_file, usecols=USECOLS + ["event_time"],
+                             chunksize=chunk_size):
+        behind = (chunk["event_time"] < watermark).to_numpy()
+        num_behind += int(behind.sum())
+        chunks.append(chunk[~behind])
+    df = pd.concat(chunks, ignore_index=True)
+    if num_behind:
+        print("skipped {} events older than the watermark {}; they are "
+              "either read already or arrived late".format(num_behind,
+                                                           watermark))
+    if len(df) == 0:
+        print("no events after", watermark)
+        for spec in specs:
+            open(spec.output_file + ".changed", "w").close()
+        return writers
+
+    granularities = sorted(set(spec.granularity for spec in specs))
+    mask, correct, keys = parse_events(df, granularities)
+    items = df["question_code"].to_numpy().astype(np.int64)[mask]
+
+    def write(spec):
+        state = states[spec.name]
+        spec_watermark = watermarks[spec.name]
+        is_new = spec_watermark.new_events(df)
+        rows = state["num_rows"] + np.cumsum(is_new) - 1
+
+        selected = is_new[mask]
+        if spec.only_correct:
+            selected &= correct
+        writer, changed = append_sequences(
+            spec, state, rows[mask][selected],
+            keys[spec.granularity][selected], items[selected], chunk_size,
+            write_csr)
+        np.savetxt(spec.output_file + ".changed", changed, fmt="%d")
+
+        spec_watermark.update(df[is_new])
+        state["watermark"] = spec_watermark.value
+        state["watermark_hashes"] = spec_watermark.hashes
+        state["num_rows"] += int(is_new.sum())
+        save_sequence_state(spec, state)
+
+        writer.changed = len(changed)
+        return writer
+
+    incremental_writers = run_writers(specs, write)
+    for spec, writer in zip(specs, incremental_writers):
+        print("[{}] #changed sequences: {}".format(spec.name, writer.changed))
+    return writers + incremental_writers
+
+
+def lesson_based(df, only_correct=False,
+                 output_file="./data/learn-hist/lesson-based.txt"):
+    keys, lengths, items = build_sequences(df, "lesson", only_correct)
+    write_sequences(output_file, keys, lengths, items)
+
+
+def unit_based(df, only_correct=False,
+               output_file="./data/learn-hist/unit-based-OC.txt"):
+    keys, lengths, items = build_sequences(df, "unit", only_correct)
+    write_sequences(output_file, keys, lengths, items)
 
 
 if __name__ == "__main__":
-    # lesson_based(df)
+    FLAGS(sys.argv)
+
+    specs = parse_sequence_specs(FLAGS.outputs, FLAGS.output_dir,
+                                 FLAGS.min_seq_length)
+
+    if FLAGS.incremental:
+        build_all_sequences_incremental(FLAGS.input_file, specs,
+                                        chunk_size=FLAGS.chunk_size,
+                                        write_csr=FLAGS.write_csr,
+                                        num_partitions=FLAGS.num_partitions,
+                                        spill_dir=FLAGS.spill_dir)
+        sys.exit(0)
+
+    if FLAGS.streaming:
+        build_all_sequences_streaming(
+            FLAGS.input_file, specs,
+            num_partitions=FLAGS.num_partitions,
+            chunk_size=FLAGS.chunk_size,
+            spill_dir=FLAGS.spill_dir,
+            write_csr=FLAGS.write_csr)
+        sys.exit(0)
+
+    df = pd.read_csv(FLAGS.input_file, usecols=USECOLS)
+
+    build_all_sequences(df, specs, write_csr=FLAGS.write_csr)
+    # --outputs=lesson
     # #users: 812,968
     # #items: 3,936
     # #actions: 15.3M
     # Avg.length: 18.8
 
-    unit_based(df, True)
+    # --outputs=unit_oc
     # #users: 199,114
     # #items: 3,923
     # #actions: 9.2M
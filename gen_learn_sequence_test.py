@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import gen_learn_sequence
+from benchmark_sequences import CASES
+
+
+def make_learn_hist(path, num_events=5000, seed=0):
+    """Writes a random learn-hist csv, with some events missing
+    question_grad_unit."""
+    rng = np.random.RandomState(seed)
+    grad_units = np.array([
+        "GR1{}_{}_{}_{}".format(grade, semester, unit, lesson)
+        for grade in range(1, 7) for semester in (1, 2)
+        for unit in range(1, 4) for lesson in range(1, 4)], dtype=object)
+    grad_unit = grad_units[rng.randint(len(grad_units) // 8, size=num_events)]
+    grad_unit[rng.rand(num_events) < 0.02] = None
+    df = pd.DataFrame({
+        "student_id": rng.randint(1, 60, size=num_events),
+        "question_code": rng.randint(1, 500, size=num_events),
+        "correct": rng.randint(0, 2, size=num_events),
+        "event_time": pd.Timestamp("2025-01-01") + pd.to_timedelta(
+            np.sort(rng.randint(0, 3600, size=num_events)), unit="s"),
+        "question_grad_unit": grad_unit,
+    })
+    df.to_csv(path, index=False)
+
+
+class GenLearnSequenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_file = os.path.join(self.tmp_dir.name, "learn-hist.csv")
+        make_learn_hist(self.input_file)
+        self.df = pd.read_csv(self.input_file,
+                              usecols=gen_learn_sequence.USECOLS)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_builders_match_rowwise(self):
+        for name, granularity, rowwise_fn, vectorized_fn, only_correct in CASES:
+            path = os.path.join(self.tmp_dir.name, name + ".{}.txt")
+            rowwise_fn(self.df, only_correct, output_file=path.format("rowwise"))
+            expected = self.read(path.format("rowwise"))
+            self.assertTrue(expected)
+
+            vectorized_fn(self.df, only_correct,
+                          output_file=path.format("vectorized"))
+            self.assertEqual(self.read(path.format("vectorized")), expected)
+
+            gen_learn_sequence.build_sequences_streaming(
+                self.input_file, granularity, only_correct,
+                path.format("streaming"), num_partitions=4, chunk_size=700,
+                spill_dir=self.tmp_dir.name)
+            self.assertEqual(self.read(path.format("streaming")), expected)
+
+    def test_all_outputs_match_rowwise(self):
+        specs = gen_learn_sequence.parse_sequence_specs(
+            ["lesson", "unit_oc"], self.tmp_dir.name)
+        gen_learn_sequence.build_all_sequences(self.df, specs)
+        for spec, (name, _, rowwise_fn, _, only_correct) in zip(specs, CASES):
+            path = os.path.join(self.tmp_dir.name, name + ".rowwise.txt")
+            rowwise_fn(self.df, only_correct, output_file=path)
+            self.assertEqual(self.read(spec.output_file), self.read(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,7 +30,8 @@ class BertConfig(object):
                  attention_probs_dropout_prob=0.1,
                  max_position_embeddings=512,
                  type_vocab_size=16,
-                 initializer_range=0.02):
+                 initializer_range=0.02,
+                 precision="float32"):
         """Constructs BertConfig.
 
         Args:
@@ -54,6 +55,9 @@ class BertConfig(object):
             `BertModel`.
         initializer_range: The stdev of the keras.initializers.TruncatedNormal for
             initializing all weight matrices.
+        precision: "float32", or "bfloat16" to run the matmuls and attention of
+            the encoder in bfloat16. Weights, embeddings, layer norm, softmax
+            and the loss stay in float32.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -66,6 +70,7 @@ class BertConfig(object):
         self.max_position_embeddings = max_position_embeddings
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
+        self.precision = precision
 
     @classmethod
     def from_dict(cls, json_object):
@@ -121,7 +126,8 @@ class BertModel(object):
                  input_mask=None,
                  token_type_ids=None,
                  use_one_hot_embeddings=True,
-                 scope=None):
+                 scope=None,
+                 segment_ids=None):
         """Constructor for BertModel.
 
         Args:
@@ -136,12 +142,17 @@ class BertModel(object):
             it is must faster if this is True, on the CPU or GPU, it is faster if
             this is False.
         scope: (optional) variable scope. Defaults to "bert".
+        segment_ids: (optional) int32 Tensor of shape [batch_size, seq_length]
+            for rows that pack several sequences: 1, 2, ... for the tokens of
+            each sequence and 0 for padding. Sequences only attend to
+            themselves and their positions restart at 0.
 
         Raises:
         ValueError: The config is invalid or one of the input tensor shapes
             is invalid.
         """
         config = copy.deepcopy(config)
+        compute_dtype = get_compute_dtype(config)
         if not is_training:
             config.hidden_dropout_prob = 0.0
             config.attention_probs_dropout_prob = 0.0
@@ -158,6 +169,10 @@ class BertModel(object):
             token_type_ids = tf.zeros(
                 shape=[batch_size, seq_length], dtype=tf.int32)
 
+        position_ids = None
+        if segment_ids is not None:
+            position_ids = create_position_ids_from_segment_ids(segment_ids)
+
         with tf.compat.v1.variable_scope(scope, default_name="bert"):
             with tf.compat.v1.variable_scope("embeddings"):
                 # Perform embedding lookup on the word ids.
@@ -182,14 +197,15 @@ class BertModel(object):
                     position_embedding_name="position_embeddings",
                     initializer_range=config.initializer_range,
                     max_position_embeddings=config.max_position_embeddings,
-                    dropout_prob=config.hidden_dropout_prob)
+                    dropout_prob=config.hidden_dropout_prob,
+                    position_ids=position_ids)
 
             with tf.compat.v1.variable_scope("encoder"):
                 # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
                 # mask of shape [batch_size, seq_length, seq_length] which is used
                 # for the attention scores.
                 attention_mask = create_attention_mask_from_input_mask(
-                    input_ids, input_mask)
+                    input_ids, input_mask, segment_ids)
 
                 # Run the stacked transformer.
                 # `sequence_output` shape = [batch_size, seq_length, hidden_size].
@@ -205,7 +221,8 @@ class BertModel(object):
                     attention_probs_dropout_prob=config.
                     attention_probs_dropout_prob,
                     initializer_range=config.initializer_range,
-                    do_return_all_layers=True)
+                    do_return_all_layers=True,
+                    compute_dtype=compute_dtype)
 
             self.sequence_output = self.all_encoder_layers[-1]
             # The "pooler" converts the encoded sequence tensor of shape
@@ -266,7 +283,8 @@ def gelu(input_tensor):
     Returns:
         `input_tensor` with the GELU activation applied.
     """
-    cdf = 0.5 * (1.0 + tf.math.erf(input_tensor / tf.sqrt(2.0)))
+    cdf = 0.5 * (1.0 + tf.math.erf(
+        input_tensor / tf.sqrt(tf.constant(2.0, input_tensor.dtype))))
     return input_tensor * cdf
 
 
@@ -365,6 +383,24 @@ def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
     return output_tensor
 
 
+def get_compute_dtype(config):
+    """The dtype of the matmuls and attention for `config.precision`."""
+    precision = getattr(config, "precision", "float32")
+    if precision == "float32":
+        return tf.float32
+    if precision == "bfloat16":
+        return tf.bfloat16
+    raise ValueError("Unsupported precision: %s" % precision)
+
+
+def dense_layer_dtype(compute_dtype):
+    """The dtype of a keras Dense layer that keeps float32 weights and casts
+    its inputs to `compute_dtype`."""
+    if compute_dtype == tf.bfloat16:
+        return tf.keras.mixed_precision.Policy("mixed_bfloat16")
+    return None
+
+
 def create_initializer(initializer_range=0.02):
     """Creates a `keras.initializers.TruncatedNormal` with the given range."""
     return tf.keras.initializers.TruncatedNormal(stddev=initializer_range)
@@ -431,7 +467,8 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            position_ids=None):
     """Performs various post-processing on a word embedding tensor.
 
     Args:
@@ -452,6 +489,8 @@ def embedding_postprocessor(input_tensor,
         used with this model. This can be longer than the sequence length of
         input_tensor, but cannot be shorter.
         dropout_prob: float. Dropout probability applied to the final output tensor.
+        position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        The position of every token, if not 0, 1, ... seq_length-1.
 
     Returns:
         float tensor with same shape as `input_tensor`.
@@ -488,15 +527,17 @@ def embedding_postprocessor(input_tensor,
         output += token_type_embeddings
 
     if use_position_embeddings:
+        # created outside the assert, whose input is data when `seq_length`
+        # is dynamic (trimmed batches): the initializer must not depend on it
+        full_position_embeddings = tf.Variable(
+            initial_value=create_initializer(initializer_range)(
+                shape=[max_position_embeddings, width], dtype=tf.float32
+            ),
+            trainable=True,
+            name=position_embedding_name,
+        )
         assert_op = tf.compat.v1.debugging.assert_less_equal(seq_length, max_position_embeddings)
         with tf.control_dependencies([assert_op]):
-            full_position_embeddings = tf.Variable(
-                initial_value=create_initializer(initializer_range)(
-                    shape=[max_position_embeddings, width], dtype=tf.float32
-                ),
-                trainable=True,
-                name=position_embedding_name,
-            )
             # Since the position embedding table is a learned variable, we create it
             # using a (long) sequence length `max_position_embeddings`. The actual
             # sequence length might be shorter than this, for faster training of
@@ -519,18 +560,26 @@ def embedding_postprocessor(input_tensor,
             position_broadcast_shape.extend([seq_length, width])
             position_embeddings = tf.reshape(position_embeddings,
                                              position_broadcast_shape)
+            if position_ids is not None:
+                # packed sequences: every token looks up its own position
+                position_embeddings = tf.gather(full_position_embeddings,
+                                                position_ids)
             output += position_embeddings
 
     output = layer_norm_and_dropout(output, dropout_prob)
     return output
 
 
-def create_attention_mask_from_input_mask(from_tensor, to_mask):
+def create_attention_mask_from_input_mask(from_tensor, to_mask,
+                                          segment_ids=None):
     """Create 3D attention mask from a 2D tensor mask.
 
     Args:
         from_tensor: 2D or 3D Tensor of shape [batch_size, from_seq_length, ...].
         to_mask: int32 Tensor of shape [batch_size, to_seq_length].
+        segment_ids: (optional) int32 Tensor of shape [batch_size, seq_length]
+        of packed sequences. Tokens then only attend to their own sequence,
+        which makes the mask block-diagonal.
 
     Returns:
         float Tensor of shape [batch_size, from_seq_length, to_seq_length].
@@ -556,9 +605,32 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
     # Here we broadcast along two dimensions to create the mask.
     mask = broadcast_ones * to_mask
 
+    if segment_ids is not None:
+        mask *= tf.cast(tf.equal(segment_ids[:, :, None],
+                                 segment_ids[:, None, :]), tf.float32)
+
     return mask
 
 
+def create_position_ids_from_segment_ids(segment_ids):
+    """Positions that restart at 0 with every packed sequence.
+
+    Args:
+        segment_ids: int32 Tensor of shape [batch_size, seq_length] with the
+        same ids for the tokens of one sequence, as consecutive runs.
+
+    Returns:
+        int32 Tensor of shape [batch_size, seq_length].
+    """
+    seq_length = get_shape_list(segment_ids, expected_rank=2)[1]
+    same_segment = tf.cast(tf.equal(segment_ids[:, :, None],
+                                    segment_ids[:, None, :]), tf.int32)
+    # the tokens of the same sequence at or before every position
+    lower = tf.linalg.band_part(tf.ones([seq_length, seq_length], tf.int32),
+                                -1, 0)
+    return tf.reduce_sum(same_segment * lower[None], axis=-1) - 1
+
+
 def attention_layer(from_tensor,
                     to_tensor,
                     attention_mask=None,
@@ -572,7 +644,8 @@ def attention_layer(from_tensor,
                     do_return_2d_tensor=False,
                     batch_size=None,
                     from_seq_length=None,
-                    to_seq_length=None):
+                    to_seq_length=None,
+                    compute_dtype=tf.float32):
     """Performs multi-headed attention from `from_tensor` to `to_tensor`.
 
     This is an implementation of multi-headed attention based on "Attention
@@ -619,9 +692,11 @@ def attention_layer(from_tensor,
         of the 3D version of the `from_tensor`.
         to_seq_length: (Optional) If the input is 2D, this might be the seq length
         of the 3D version of the `to_tensor`.
+        compute_dtype: (Optional) dtype of the projections and the attention
+        matmuls. The mask and the softmax always run in float32.
 
     Returns:
-        float Tensor of shape [batch_size, from_seq_length,
+        `compute_dtype` Tensor of shape [batch_size, from_seq_length,
         num_attention_heads * size_per_head]. (If `do_return_2d_tensor` is
         true, this will be of shape [batch_size * from_seq_length,
         num_attention_heads * size_per_head]).
@@ -673,6 +748,7 @@ def attention_layer(from_tensor,
         activation=query_act,
         name="query",
         kernel_initializer=create_initializer(initializer_range),
+        dtype=dense_layer_dtype(compute_dtype),
     )(from_tensor_2d)
 
     # `key_layer` = [B*T, N*H]
@@ -681,6 +757,7 @@ def attention_layer(from_tensor,
         activation=key_act,
         name="key",
         kernel_initializer=create_initializer(initializer_range),
+        dtype=dense_layer_dtype(compute_dtype),
     )(to_tensor_2d)
 
     # `value_layer` = [B*T, N*H]
@@ -689,6 +766,7 @@ def attention_layer(from_tensor,
         activation=value_act,
         name="value",
         kernel_initializer=create_initializer(initializer_range),
+        dtype=dense_layer_dtype(compute_dtype),
     )(to_tensor_2d)
 
     # `query_layer` = [B, N, F, H]
@@ -705,6 +783,7 @@ def attention_layer(from_tensor,
     # attention scores.
     # `attention_scores` = [B, N, F, T]
     attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
+    attention_scores = tf.cast(attention_scores, tf.float32)
     attention_scores = tf.multiply(attention_scores,
                                    1.0 / math.sqrt(float(size_per_head)))
 
@@ -738,7 +817,8 @@ def attention_layer(from_tensor,
     value_layer = tf.transpose(value_layer, [0, 2, 1, 3])
 
     # `context_layer` = [B, N, F, H]
-    context_layer = tf.matmul(attention_probs, value_layer)
+    context_layer = tf.matmul(tf.cast(attention_probs, compute_dtype),
+                              value_layer)
 
     # `context_layer` = [B, F, N, H]
     context_layer = tf.transpose(context_layer, [0, 2, 1, 3])
@@ -767,7 +847,8 @@ def transformer_model(input_tensor,
                       hidden_dropout_prob=0.1,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
-                      do_return_all_layers=False):
+                      do_return_all_layers=False,
+                      compute_dtype=tf.float32):
     """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
     This is almost an exact implementation of the original Transformer encoder.
@@ -797,6 +878,8 @@ def transformer_model(input_tensor,
         normal).
         do_return_all_layers: Whether to also return all layers or just the final
         layer.
+        compute_dtype: dtype of the matmuls and attention. The residuals and
+        layer norm stay in float32.
 
     Returns:
         float Tensor of shape [batch_size, seq_length, hidden_size], the final
@@ -849,7 +932,8 @@ def transformer_model(input_tensor,
                         do_return_2d_tensor=True,
                         batch_size=batch_size,
                         from_seq_length=seq_length,
-                        to_seq_length=seq_length)
+                        to_seq_length=seq_length,
+                        compute_dtype=compute_dtype)
                     attention_heads.append(attention_head)
 
                 attention_output = None
@@ -866,7 +950,10 @@ def transformer_model(input_tensor,
                     attention_output = tf.keras.layers.Dense(
                         units=hidden_size,
                         kernel_initializer=create_initializer(
-                            initializer_range))(attention_output)
+                            initializer_range),
+                        dtype=dense_layer_dtype(compute_dtype),
+                    )(attention_output)
+                    attention_output = tf.cast(attention_output, tf.float32)
                     attention_output = dropout(attention_output,
                                                hidden_dropout_prob)
                     attention_output = layer_norm(attention_output +
@@ -878,6 +965,7 @@ def transformer_model(input_tensor,
                     units=intermediate_size,
                     activation=intermediate_act_fn,
                     kernel_initializer=create_initializer(initializer_range),
+                    dtype=dense_layer_dtype(compute_dtype),
                 )(attention_output)
 
             # Down-project back to `hidden_size` then add the residual.
@@ -885,7 +973,9 @@ def transformer_model(input_tensor,
                 layer_output = tf.keras.layers.Dense(
                     units=hidden_size,
                     kernel_initializer=create_initializer(initializer_range),
+                    dtype=dense_layer_dtype(compute_dtype),
                 )(intermediate_output)
+                layer_output = tf.cast(layer_output, tf.float32)
                 layer_output = dropout(layer_output, hidden_dropout_prob)
                 layer_output = layer_norm(layer_output + attention_output)
                 prev_output = layer_output
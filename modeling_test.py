@@ -0,0 +1,41 @@
+import numpy as np
+import tensorflow as tf
+
+import modeling
+
+
+class PackedSequenceTest(tf.test.TestCase):
+
+    def test_position_ids_restart_at_segments(self):
+        segment_ids = tf.constant([[1, 1, 1, 2, 2, 3, 0, 0],
+                                   [1, 1, 1, 1, 1, 1, 1, 1],
+                                   [1, 2, 3, 4, 0, 0, 0, 0]])
+        # modeling builds graphs, get_shape_list needs symbolic tensors
+        position_ids = tf.function(
+            modeling.create_position_ids_from_segment_ids)(segment_ids)
+        self.assertAllEqual(position_ids, [[0, 1, 2, 0, 1, 0, 0, 1],
+                                           [0, 1, 2, 3, 4, 5, 6, 7],
+                                           [0, 0, 0, 0, 0, 1, 2, 3]])
+
+    def test_attention_mask_is_block_diagonal(self):
+        segment_ids = tf.constant([[1, 1, 2, 2, 2, 0]])
+        input_mask = tf.cast(segment_ids > 0, tf.int32)
+        mask = tf.function(modeling.create_attention_mask_from_input_mask)(
+            segment_ids, input_mask, segment_ids=segment_ids)
+        expected = np.array([[1, 1, 0, 0, 0, 0],
+                             [1, 1, 0, 0, 0, 0],
+                             [0, 0, 1, 1, 1, 0],
+                             [0, 0, 1, 1, 1, 0],
+                             [0, 0, 1, 1, 1, 0],
+                             [0, 0, 0, 0, 0, 0]], dtype=np.float32)
+        self.assertAllEqual(mask[0], expected)
+
+    def test_unpacked_mask_is_unchanged(self):
+        input_mask = tf.constant([[1, 1, 1, 0]])
+        mask = tf.function(modeling.create_attention_mask_from_input_mask)(
+            input_mask, input_mask)
+        self.assertAllEqual(mask[0], [[1, 1, 1, 0]] * 4)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -23,8 +23,14 @@ import tensorflow as tf
 
 
 def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps,
-                     use_tpu):
-    """Creates an optimizer training op."""
+                     use_tpu, fused=False, lazy_sparse=False):
+    """Creates an optimizer training op.
+
+    With `fused`, dense variables are updated by TF's fused Adam kernel, and
+    with `lazy_sparse`, variables with sparse gradients only in the rows the
+    batch touched (see `AdamWeightDecayOptimizer`); the learning rate
+    schedule is the same.
+    """
     global_step = tf.compat.v1.train.get_or_create_global_step()
 
     learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
@@ -64,7 +70,9 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps,
         beta_1=0.9,
         beta_2=0.999,
         epsilon=1e-6,
-        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+        fused=fused,
+        lazy_sparse=lazy_sparse)
 
     if use_tpu:
         optimizer = tf.compat.v1.tpu.CrossShardOptimizer(optimizer)
@@ -84,7 +92,17 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps,
 
 
 class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
-    """A basic Adam optimizer that includes "correct" L2 weight decay."""
+    """A basic Adam optimizer that includes "correct" L2 weight decay.
+
+    With `fused`, every dense variable is updated by one ResourceApplyAdam
+    kernel (plus one for its weight decay) instead of a dozen element-wise
+    ops. The result is the same up to float rounding.
+
+    With `lazy_sparse`, a variable with an `IndexedSlices` gradient (e.g. an
+    embedding table) is updated lazily by `_apply_sparse_rows`, which is not
+    fused: rows the batch did not touch get no weight decay and keep their
+    m and v. Otherwise such gradients are made dense, as before.
+    """
 
     def __init__(self,
                  learning_rate,
@@ -93,6 +111,8 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
                  beta_2=0.999,
                  epsilon=1e-6,
                  exclude_from_weight_decay=None,
+                 fused=False,
+                 lazy_sparse=False,
                  name="AdamWeightDecayOptimizer"):
         """Constructs a AdamWeightDecayOptimizer."""
         super(AdamWeightDecayOptimizer, self).__init__(False, name)
@@ -103,6 +123,8 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
         self.beta_2 = beta_2
         self.epsilon = epsilon
         self.exclude_from_weight_decay = exclude_from_weight_decay
+        self.fused = fused
+        self.lazy_sparse = lazy_sparse
 
     def apply_gradients(self, grads_and_vars, global_step=None, name=None):
         """See base class."""
@@ -124,6 +146,18 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
                 name=param_name + "/adam_v",
             )
 
+            if isinstance(grad, tf.IndexedSlices):
+                if self.lazy_sparse:
+                    assignments.extend(
+                        self._apply_sparse_rows(grad, param, param_name, m, v))
+                    continue
+                grad = tf.convert_to_tensor(grad)
+
+            if self.fused:
+                assignments.append(
+                    self._apply_fused(grad, param, param_name, m, v))
+                continue
+
             # Standard Adam update.
             next_m = (tf.multiply(self.beta_1, m) +
                       tf.multiply(1.0 - self.beta_1, grad))
@@ -152,6 +186,58 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
                  v.assign(next_v)])
         return tf.group(*assignments, name=name)
 
+    def _apply_sparse_rows(self, grad, param, param_name, m, v):
+        """Lazy Adam update for an `IndexedSlices` gradient, e.g. of an
+        embedding table: only the rows in `grad.indices` of `param`, `m` and
+        `v` are read and written, and only those rows are weight decayed."""
+        # An id can appear many times in a batch; sum its slices first so m
+        # and v see the row's full gradient.
+        indices, segment_ids = tf.unique(grad.indices)
+        grad_rows = tf.math.unsorted_segment_sum(
+            grad.values, segment_ids, tf.shape(indices)[0])
+
+        param_rows = tf.gather(param, indices)
+        next_m = (tf.multiply(self.beta_1, tf.gather(m, indices)) +
+                  tf.multiply(1.0 - self.beta_1, grad_rows))
+        next_v = (tf.multiply(self.beta_2, tf.gather(v, indices)) +
+                  tf.multiply(1.0 - self.beta_2, tf.square(grad_rows)))
+
+        update = next_m / (tf.sqrt(next_v) + self.epsilon)
+
+        if self._do_use_weight_decay(param_name):
+            update += self.weight_decay_rate * param_rows
+
+        next_param = param_rows - self.learning_rate * update
+
+        return [tf.compat.v1.scatter_update(param, indices, next_param),
+                tf.compat.v1.scatter_update(m, indices, next_m),
+                tf.compat.v1.scatter_update(v, indices, next_v)]
+
+    def _apply_fused(self, grad, param, param_name, m, v):
+        """The dense update with TF's fused kernels."""
+        # Decoupled weight decay first, from the weights before this step.
+        decay = []
+        if self._do_use_weight_decay(param_name):
+            decay.append(tf.raw_ops.ResourceApplyGradientDescent(
+                var=param.handle,
+                alpha=self.learning_rate,
+                delta=self.weight_decay_rate * param))
+
+        # beta powers of 0 turn off Adam's bias correction, which this
+        # optimizer does not use, so the kernel's step size is learning_rate.
+        with tf.control_dependencies(decay):
+            return tf.raw_ops.ResourceApplyAdam(
+                var=param.handle,
+                m=m.handle,
+                v=v.handle,
+                beta1_power=0.0,
+                beta2_power=0.0,
+                lr=self.learning_rate,
+                beta1=self.beta_1,
+                beta2=self.beta_2,
+                epsilon=self.epsilon,
+                grad=grad)
+
     def _do_use_weight_decay(self, param_name):
         """Whether to use L2 weight decay for `param_name`."""
         if not self.weight_decay_rate:
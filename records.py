@@ -0,0 +1,170 @@
+"""Feature specs and decoders of the train and test tfrecords written by
+gen_data.py, and the in-graph masking of unmasked windows, shared by
+run.py, run_eval.py and benchmark_input.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def padded_record_features(max_seq_length, max_predictions_per_seq,
+                           masked=True, packed=False):
+    """The features of the padded records, for `decode_record`. Unmasked
+    windows have no masked_lm fields, packed rows also have segment_ids."""
+    name_to_features = {
+        "info":
+        tf.io.FixedLenFeature([1], tf.int64),  #[user]
+        "input_ids":
+        tf.io.FixedLenFeature([max_seq_length], tf.int64),
+        "input_mask":
+        tf.io.FixedLenFeature([max_seq_length], tf.int64),
+    }
+    if masked:
+        name_to_features.update({
+            "masked_lm_positions":
+            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
+            "masked_lm_ids":
+            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
+            "masked_lm_weights":
+            tf.io.FixedLenFeature([max_predictions_per_seq], tf.float32),
+        })
+    if packed:
+        name_to_features["segment_ids"] = tf.io.FixedLenFeature(
+            [max_seq_length], tf.int64)
+    return name_to_features
+
+
+def compact_record_features(masked=True, packed=False):
+    """The features of the compact records, as parsed by
+    `decode_compact_records`."""
+    name_to_features = {
+        "info": tf.io.FixedLenFeature([1], tf.int64),
+        "input_ids": tf.io.VarLenFeature(tf.int64),
+    }
+    if packed:
+        name_to_features["segment_ids"] = tf.io.VarLenFeature(tf.int64)
+    if masked:
+        name_to_features["masked_lm_positions"] = tf.io.VarLenFeature(tf.int64)
+        name_to_features["masked_lm_ids"] = tf.io.VarLenFeature(tf.int64)
+    return name_to_features
+
+
+def decode_record(records, name_to_features):
+    """Decodes a batch of records to a TensorFlow example."""
+    example = tf.io.parse_example(records, name_to_features)
+
+    # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
+    # So cast all int64 to int32.
+    for name in list(example.keys()):
+        t = example[name]
+        if t.dtype == tf.int64:
+            t = tf.cast(t, tf.int32)
+        example[name] = t
+
+    return example
+
+
+def decode_compact_records(records, max_seq_length, max_predictions_per_seq,
+                           masked=True, packed=False):
+    """Parses a batch of compact records into the dense tensors of
+    `decode_record`: padded int32 ids plus the derived input_mask and
+    masked_lm_weights."""
+    parsed = tf.io.parse_example(records,
+                                 compact_record_features(masked, packed))
+
+    def to_dense(sparse, width):
+        sparse = tf.sparse.reset_shape(
+            sparse, tf.stack([sparse.dense_shape[0], width]))
+        dense = tf.cast(tf.sparse.to_dense(sparse), tf.int32)
+        dense.set_shape([None, width])
+        return dense
+
+    example = {
+        "info": tf.cast(parsed["info"], tf.int32),
+        "input_ids": to_dense(parsed["input_ids"], max_seq_length),
+    }
+    example["input_mask"] = tf.cast(example["input_ids"] > 0, tf.int32)
+    if packed:
+        example["segment_ids"] = to_dense(parsed["segment_ids"],
+                                          max_seq_length)
+    if masked:
+        # positions are padded with 0 like in the padded layout, so the
+        # weights come from the number of stored positions
+        num_masked = tf.sparse.reduce_sum(
+            tf.sparse.map_values(tf.ones_like, parsed["masked_lm_ids"]),
+            axis=1)
+        example["masked_lm_positions"] = to_dense(
+            parsed["masked_lm_positions"], max_predictions_per_seq)
+        example["masked_lm_ids"] = to_dense(
+            parsed["masked_lm_ids"], max_predictions_per_seq)
+        example["masked_lm_weights"] = tf.sequence_mask(
+            num_masked, max_predictions_per_seq, dtype=tf.float32)
+        # graph mode does not infer the rank of sequence_mask
+        example["masked_lm_weights"].set_shape([None, max_predictions_per_seq])
+    return example
+
+
+def mask_window(example, max_predictions_per_seq, masked_lm_prob, mask_prob,
+                mask_last_prob, mask_id, item_count):
+    """Masks a batch of decoded windows like
+    gen_data.create_masked_lm_predictions_batch.
+
+    min(max_predictions_per_seq, max(1, round(length * masked_lm_prob)))
+    item positions are chosen uniformly; each becomes `mask_id` with
+    probability `mask_prob`, else keeps its item or gets a random item with
+    equal odds. With probability `mask_last_prob` a window only gets its
+    last item masked instead. Items have the vocab ids 1..item_count.
+    """
+    input_ids = example["input_ids"]
+    seq_length = input_ids.shape[1]
+    num_slots = min(max_predictions_per_seq, seq_length)
+    batch_size = tf.shape(input_ids)[0]
+
+    length = tf.reduce_sum(example["input_mask"], axis=1)
+    cand = tf.logical_and(input_ids > 0, input_ids <= item_count)
+    num_to_predict = tf.cast(
+        tf.round(tf.cast(length, tf.float32) * masked_lm_prob), tf.int32)
+    num_to_predict = tf.minimum(
+        tf.minimum(max_predictions_per_seq, tf.maximum(1, num_to_predict)),
+        tf.reduce_sum(tf.cast(cand, tf.int32), axis=1))
+
+    # the candidates with the smallest random keys, in position order
+    keys = tf.where(cand, tf.random.uniform([batch_size, seq_length]), 2.0)
+    _, positions = tf.math.top_k(-keys, k=num_slots)
+    weights = tf.range(num_slots)[None, :] < num_to_predict[:, None]
+    positions = tf.sort(tf.where(weights, positions, seq_length), axis=1)
+    positions = tf.where(weights, positions, 0)
+
+    labels = tf.gather(input_ids, positions, batch_dims=1)
+    random_items = tf.random.uniform(
+        [batch_size, num_slots], minval=1, maxval=item_count + 1,
+        dtype=tf.int32)
+    masked_tokens = tf.where(
+        tf.random.uniform([batch_size, num_slots]) < mask_prob, mask_id,
+        tf.where(tf.random.uniform([batch_size, num_slots]) < 0.5, labels,
+                 random_items))
+
+    # mask_last: only the last item, always [MASK]
+    is_last = (tf.random.uniform([batch_size]) < mask_last_prob)[:, None]
+    last_weights = tf.range(num_slots)[None, :] < 1
+    weights = tf.where(is_last, last_weights, weights)
+    positions = tf.where(is_last, tf.where(last_weights, length[:, None] - 1, 0),
+                         positions)
+    positions = tf.where(weights, positions, 0)
+    labels = tf.where(weights, tf.gather(input_ids, positions, batch_dims=1), 0)
+    masked_tokens = tf.where(is_last, mask_id, masked_tokens)
+
+    valid = tf.where(weights)
+    example["input_ids"] = tf.tensor_scatter_nd_update(
+        input_ids,
+        tf.stack([valid[:, 0], tf.cast(tf.gather_nd(positions, valid),
+                                       tf.int64)], axis=1),
+        tf.gather_nd(masked_tokens, valid))
+
+    pad = [[0, 0], [0, max_predictions_per_seq - num_slots]]
+    example["masked_lm_positions"] = tf.pad(positions, pad)
+    example["masked_lm_ids"] = tf.pad(labels, pad)
+    example["masked_lm_weights"] = tf.pad(tf.cast(weights, tf.float32), pad)
+    return example
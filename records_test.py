@@ -0,0 +1,231 @@
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import gen_data
+import records
+import util
+
+MAX_SEQ_LENGTH = 50
+MAX_PREDICTIONS_PER_SEQ = 10
+ITEM_COUNT = 1000
+MASK_ID = 1002
+
+
+def make_windows(num_rows, seed=0):
+    """A decoded batch of unmasked item windows of every length 1..50."""
+    rng = np.random.RandomState(seed)
+    lengths = np.arange(num_rows) % MAX_SEQ_LENGTH + 1
+    input_ids = rng.randint(1, ITEM_COUNT + 1,
+                            size=(num_rows, MAX_SEQ_LENGTH)).astype(np.int32)
+    input_ids[np.arange(MAX_SEQ_LENGTH) >= lengths[:, None]] = 0
+    return input_ids, lengths
+
+
+class MaskWindowTest(tf.test.TestCase):
+
+    def mask(self, input_ids, masked_lm_prob=0.2, mask_prob=0.8,
+             mask_last_prob=0.0):
+        example = {
+            "input_ids": tf.constant(input_ids),
+            "input_mask": tf.cast(tf.constant(input_ids) > 0, tf.int32),
+        }
+        example = records.mask_window(
+            example, MAX_PREDICTIONS_PER_SEQ, masked_lm_prob=masked_lm_prob,
+            mask_prob=mask_prob, mask_last_prob=mask_last_prob,
+            mask_id=MASK_ID, item_count=ITEM_COUNT)
+        return {name: value.numpy() for name, value in example.items()}
+
+    def test_mask_counts(self):
+        tf.random.set_seed(0)
+        input_ids, lengths = make_windows(500)
+        for masked_lm_prob in [0.2, 0.5, 1.0]:
+            example = self.mask(input_ids, masked_lm_prob)
+            for name in ["masked_lm_positions", "masked_lm_ids",
+                         "masked_lm_weights"]:
+                self.assertEqual(example[name].shape,
+                                 (500, MAX_PREDICTIONS_PER_SEQ))
+            expected = np.minimum(
+                MAX_PREDICTIONS_PER_SEQ,
+                np.maximum(1, np.round(lengths * masked_lm_prob)))
+            weights = example["masked_lm_weights"]
+            self.assertAllEqual(weights.sum(axis=1), expected)
+            self.assertAllEqual(
+                weights,
+                np.arange(MAX_PREDICTIONS_PER_SEQ) < expected[:, None])
+
+    def test_positions_and_labels(self):
+        tf.random.set_seed(0)
+        input_ids, lengths = make_windows(500)
+        example = self.mask(input_ids)
+        for row in range(len(input_ids)):
+            num_masked = int(example["masked_lm_weights"][row].sum())
+            positions = example["masked_lm_positions"][row, :num_masked]
+            self.assertTrue(np.all(np.diff(positions) > 0))
+            self.assertTrue(np.all(positions < lengths[row]))
+            self.assertAllEqual(example["masked_lm_ids"][row, :num_masked],
+                                input_ids[row, positions])
+            self.assertFalse(example["masked_lm_positions"][
+                row, num_masked:].any())
+            self.assertFalse(example["masked_lm_ids"][row, num_masked:].any())
+
+            # only the masked positions change, to [MASK] or an item
+            output_ids = example["input_ids"][row]
+            changed = np.flatnonzero(output_ids != input_ids[row])
+            self.assertTrue(set(changed) <= set(positions))
+            tokens = output_ids[positions]
+            self.assertTrue(np.all((tokens == MASK_ID) |
+                                   ((tokens >= 1) & (tokens <= ITEM_COUNT))))
+
+    def test_mask_prob(self):
+        tf.random.set_seed(0)
+        input_ids, _ = make_windows(2000)
+        example = self.mask(input_ids, mask_prob=0.8)
+        masked = np.take_along_axis(example["input_ids"],
+                                    example["masked_lm_positions"], axis=1)
+        share = np.mean(masked[example["masked_lm_weights"] > 0] == MASK_ID)
+        self.assertNear(share, 0.8, 0.02)
+
+    def test_mask_last(self):
+        tf.random.set_seed(0)
+        input_ids, lengths = make_windows(200)
+        example = self.mask(input_ids, mask_last_prob=1.0)
+        self.assertAllEqual(example["masked_lm_weights"].sum(axis=1),
+                            np.ones(200))
+        self.assertAllEqual(example["masked_lm_positions"][:, 0], lengths - 1)
+        self.assertAllEqual(example["masked_lm_ids"][:, 0],
+                            input_ids[np.arange(200), lengths - 1])
+        self.assertAllEqual(
+            example["input_ids"][np.arange(200), lengths - 1],
+            np.full(200, MASK_ID))
+
+
+class RoundTripTest(tf.test.TestCase):
+    """Instances written by gen_data.py decode to the same tensors in every
+    record layout."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        documents = {
+            user: [rng.randint(1, ITEM_COUNT + 1, size=length).tolist()
+                   for length in rng.randint(1, MAX_SEQ_LENGTH + 1, size=3)]
+            for user in range(1, 41)}
+        self.instances = gen_data.create_instances_batch(
+            documents, MAX_SEQ_LENGTH, 0.2, MAX_PREDICTIONS_PER_SEQ,
+            np.arange(1, ITEM_COUNT + 1), MASK_ID, rng, 0.8)
+        self.windows = [
+            gen_data.TrainingInstance(info=instance.info,
+                                      tokens=instance.tokens,
+                                      masked_lm_positions=None,
+                                      masked_lm_labels=None)
+            for instance in self.instances]
+        self.packed = gen_data.pack_instances(
+            self.instances, MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, instances, compact):
+        path = os.path.join(self.tmp_dir.name,
+                            "compact" if compact else "padded")
+        gen_data.write_instance_to_example_files(
+            instances, MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ, [path],
+            compact=compact)
+        return tf.data.TFRecordDataset(path).batch(1000)
+
+    def decode_padded(self, instances, masked=True, packed=False):
+        spec = records.padded_record_features(
+            MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ, masked, packed)
+        d = self.write(instances, compact=False)
+        return d.map(lambda batch: records.decode_record(batch, spec))
+
+    def decode_compact(self, instances, masked=True, packed=False):
+        d = self.write(instances, compact=True)
+        return d.map(lambda batch: records.decode_compact_records(
+            batch, MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ, masked, packed))
+
+    def assertSameBatches(self, expected, actual):
+        expected = list(expected)
+        actual = list(actual)
+        self.assertEqual(len(expected), len(actual))
+        for expected_batch, actual_batch in zip(expected, actual):
+            self.assertEqual(set(expected_batch), set(actual_batch))
+            for name in expected_batch:
+                self.assertEqual(expected_batch[name].dtype,
+                                 actual_batch[name].dtype)
+                self.assertAllEqual(expected_batch[name], actual_batch[name])
+
+    def test_compact_equals_padded(self):
+        self.assertSameBatches(self.decode_padded(self.instances),
+                               self.decode_compact(self.instances))
+
+    def test_compact_equals_padded_unmasked(self):
+        self.assertSameBatches(
+            self.decode_padded(self.windows, masked=False),
+            self.decode_compact(self.windows, masked=False))
+
+    def test_compact_equals_padded_packed(self):
+        self.assertSameBatches(
+            self.decode_padded(self.packed, packed=True),
+            self.decode_compact(self.packed, packed=True))
+
+    def assertNpyEqualsPadded(self, instances, masked=True, packed=False):
+        prefix = os.path.join(self.tmp_dir.name, "npy")
+        util.save_examples(prefix, gen_data.create_example_arrays(
+            instances, MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ))
+        examples = util.load_examples(prefix)
+        (expected,) = list(self.decode_padded(instances, masked, packed))
+        # input_mask is not saved, the readers derive it from input_ids
+        self.assertEqual(set(expected), set(examples) | {"input_mask"})
+        self.assertAllEqual(expected["input_mask"],
+                            examples["input_ids"] > 0)
+        for name in examples:
+            self.assertAllEqual(expected[name], examples[name])
+
+    def test_npy_equals_padded(self):
+        self.assertNpyEqualsPadded(self.instances)
+
+    def test_npy_equals_padded_unmasked(self):
+        self.assertNpyEqualsPadded(self.windows, masked=False)
+
+    def test_npy_equals_padded_packed(self):
+        self.assertNpyEqualsPadded(self.packed, packed=True)
+
+    def test_npy_concat(self):
+        prefixes = []
+        for part, beg in enumerate(range(0, len(self.instances), 50)):
+            prefixes.append(os.path.join(self.tmp_dir.name, "part%d" % part))
+            util.save_examples(prefixes[-1], gen_data.create_example_arrays(
+                self.instances[beg:beg + 50], MAX_SEQ_LENGTH,
+                MAX_PREDICTIONS_PER_SEQ))
+        self.assertGreater(len(prefixes), 1)
+        prefix = os.path.join(self.tmp_dir.name, "npy")
+        util.concat_examples(prefix, prefixes)
+        expected = gen_data.create_example_arrays(
+            self.instances, MAX_SEQ_LENGTH, MAX_PREDICTIONS_PER_SEQ)
+        examples = util.load_examples(prefix)
+        self.assertEqual(set(examples), set(expected))
+        for name in expected:
+            self.assertEqual(examples[name].dtype, expected[name].dtype)
+            self.assertAllEqual(examples[name], expected[name])
+        self.assertFalse(util.load_examples(prefixes[0]))
+
+        with self.assertRaises(ValueError):
+            util.concat_examples(prefix, [])
+
+    def test_compact_static_shapes(self):
+        d = self.decode_compact(self.packed, packed=True)
+        for name in ["input_ids", "input_mask", "segment_ids"]:
+            self.assertEqual(d.element_spec[name].shape.as_list(),
+                             [None, MAX_SEQ_LENGTH])
+        for name in ["masked_lm_positions", "masked_lm_ids",
+                     "masked_lm_weights"]:
+            self.assertEqual(d.element_spec[name].shape.as_list(),
+                             [None, MAX_PREDICTIONS_PER_SEQ])
+
+
+if __name__ == "__main__":
+    tf.test.main()
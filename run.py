@@ -18,8 +18,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import os
 import sys
+import time
 
 import tensorflow as tf
 from absl import flags
@@ -27,7 +29,10 @@ import numpy as np
 
 import modeling
 import optimization
-import pickle
+from records import (decode_compact_records, decode_record, mask_window,
+                     padded_record_features)
+from util import load_examples, load_history
+from vocab import load_vocab
 
 FLAGS = flags.FLAGS
 
@@ -116,6 +121,82 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_enum(
+    "record_format", "padded", ["padded", "compact", "npy"],
+    "Record layout written by gen_data.py --record_format. With npy, "
+    "train_input_file and test_input_file are the prefixes of the arrays.")
+
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Train on unmasked windows written by gen_data.py --dynamic_masking and "
+    "mask them in the input pipeline, with fresh masks every epoch.")
+
+flags.DEFINE_float("masked_lm_prob", 0.15,
+                   "Masked LM probability. Only used with dynamic_masking.")
+
+flags.DEFINE_float("mask_prob", 1.0,
+                   "Probability that a chosen position becomes [MASK]. Only "
+                   "used with dynamic_masking.")
+
+flags.DEFINE_float(
+    "mask_last_prob", 0.1,
+    "Fraction of windows that only get their last item masked, like the "
+    "mask_last instances of gen_data.py. Only used with dynamic_masking.")
+
+flags.DEFINE_bool(
+    "pack_sequences", False,
+    "Train on rows packed by gen_data.py --pack_sequences: read their "
+    "segment_ids, so packed windows neither attend to each other nor share "
+    "positions.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 10000,
+    "Records in the training shuffle buffer, after interleaving the files.")
+
+flags.DEFINE_integer(
+    "num_input_threads", 4,
+    "Train files read in parallel by the input pipeline.")
+
+flags.DEFINE_string(
+    "input_cache", None,
+    "Cache the decoded train data and replay it for later epochs: "
+    "'memory', or a directory for a snapshot that later runs on the same "
+    "data reuse.")
+
+flags.DEFINE_integer(
+    "num_length_buckets", 0,
+    "Batch windows of similar length together and trim every batch to its "
+    "longest window. The bucket boundaries split the length histogram of "
+    "the data into this many equal-count buckets. 0 disables bucketing.")
+
+flags.DEFINE_bool(
+    "report_input_bound", False,
+    "Time how long every training step waits for its input batch and "
+    "report that share of the step time after training.")
+
+flags.DEFINE_integer(
+    "num_sampled", 0,
+    "Train with a sampled softmax over this many negative items per batch "
+    "instead of the full softmax over the vocab. Eval always uses the full "
+    "softmax. 0 disables.")
+
+flags.DEFINE_enum(
+    "sampler", "popularity", ["popularity", "uniform"],
+    "Negative items of the sampled softmax: drawn by their counts in the "
+    "vocab, or uniformly.")
+
+flags.DEFINE_bool(
+    "fused_optimizer", False,
+    "Update the dense weights with TF's fused Adam kernels instead of "
+    "element-wise ops. Same updates up to float rounding.")
+
+flags.DEFINE_bool(
+    "lazy_adam", False,
+    "Update the embedding tables (and the output bias with --num_sampled) "
+    "only in the rows the batch touched. Faster for large vocabs, but rows "
+    "not in the batch skip their weight decay and m/v decay that step, so "
+    "the updates differ from the default. Not fused by --fused_optimizer.")
+
 flags.DEFINE_bool("use_pop_random", True, "use pop random negative samples")
 flags.DEFINE_string("vocab_filename", None, "vocab filename")
 flags.DEFINE_string("user_history_filename", None, "user history filename")
@@ -142,22 +223,17 @@ class EvalHooks(tf.compat.v1.train.SessionRunHook):
 
         if FLAGS.user_history_filename is not None:
             print('load user history from :' + FLAGS.user_history_filename)
-            with open(FLAGS.user_history_filename, 'rb') as input_file:
-                self.user_history = pickle.load(input_file)
+            self.user_history = load_history(FLAGS.user_history_filename)
 
         if FLAGS.vocab_filename is not None:
             print('load vocab from :' + FLAGS.vocab_filename)
-            with open(FLAGS.vocab_filename, 'rb') as input_file:
-                self.vocab = pickle.load(input_file)
+            self.vocab = load_vocab(FLAGS.vocab_filename)
 
-            keys = self.vocab.counter.keys()
-            values = self.vocab.counter.values()
-            self.ids = self.vocab.convert_tokens_to_ids(keys)
+            self.ids = self.vocab.get_item_ids()
+            values = self.vocab.get_item_counts()
             # normalize
             # print(values)
-            sum_value = np.sum([x for x in values])
-            # print(sum_value)
-            self.probability = [value / sum_value for value in values]
+            self.probability = values / np.sum(values)
 
     def end(self, session):
         print(
@@ -188,7 +264,7 @@ class EvalHooks(tf.compat.v1.train.SessionRunHook):
             rated.add(0)
             rated.add(masked_lm_ids[idx][0])
             map(lambda x: rated.add(x),
-                self.user_history["user_" + str(info[idx][0])][0])
+                self.user_history[int(info[idx][0])])
             item_idx = [masked_lm_ids[idx][0]]
             # here we need more consideration
             masked_lm_log_probs_elem = masked_lm_log_probs[idx, 0]  
@@ -230,10 +306,64 @@ class EvalHooks(tf.compat.v1.train.SessionRunHook):
             self.ap += 1.0 / (rank + 1)
 
 
+class InputWaitHook(tf.compat.v1.train.SessionRunHook):
+    """Records the wall time of every training step and how long it waited
+    for its input batch, as timed by `timed_input_fn`."""
+
+    def __init__(self, skip_steps=10):
+        self.skip_steps = skip_steps
+        self.step_times = []
+        self.input_waits = []
+
+    def begin(self):
+        self.input_wait = tf.compat.v1.get_collection("input_wait")[0]
+
+    def before_run(self, run_context):
+        self.start_time = time.perf_counter()
+        return tf.compat.v1.train.SessionRunArgs(self.input_wait)
+
+    def after_run(self, run_context, run_values):
+        self.step_times.append(time.perf_counter() - self.start_time)
+        self.input_waits.append(run_values.results)
+
+    def mean_times(self):
+        """Returns the mean (step time, input wait) in seconds, without the
+        first `skip_steps` steps."""
+        step_times = self.step_times[self.skip_steps:] or self.step_times
+        input_waits = self.input_waits[self.skip_steps:] or self.input_waits
+        return np.mean(step_times), np.mean(input_waits)
+
+
+def timed_input_fn(input_fn):
+    """Wraps `input_fn` to return the next batch of its dataset, with the
+    seconds the step spent getting it in the "input_wait" collection."""
+
+    def wrapped_input_fn(params):
+        d = input_fn(params)
+        iterator = tf.compat.v1.data.make_initializable_iterator(d)
+        tf.compat.v1.add_to_collection(
+            tf.compat.v1.GraphKeys.TABLE_INITIALIZERS, iterator.initializer)
+        start_time = tf.timestamp()
+        with tf.control_dependencies([start_time]):
+            features = iterator.get_next()
+        with tf.control_dependencies(tf.nest.flatten(features)):
+            end_time = tf.timestamp()
+        tf.compat.v1.add_to_collection("input_wait", end_time - start_time)
+        # the model only starts after end_time, so it is not taken late
+        with tf.control_dependencies([end_time]):
+            return tf.nest.map_structure(tf.identity, features)
+
+    return wrapped_input_fn
+
+
 def model_fn_builder(bert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings, item_size):
-    """Returns `model_fn` closure for TPUEstimator."""
+                     use_one_hot_embeddings, item_size, sampled_softmax=None,
+                     fused_optimizer=False, lazy_adam=False):
+    """Returns `model_fn` closure for TPUEstimator.
+
+    `sampled_softmax` (see `get_masked_lm_output`) only applies to training.
+    """
 
     def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
         """The `model_fn` for TPUEstimator."""
@@ -247,6 +377,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         info = features["info"]
         input_ids = features["input_ids"]
         input_mask = features["input_mask"]
+        # only packed rows have segment_ids
+        segment_ids = features.get("segment_ids")
         masked_lm_positions = features["masked_lm_positions"]
         masked_lm_ids = features["masked_lm_ids"]
         masked_lm_weights = features["masked_lm_weights"]
@@ -259,7 +391,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
             input_ids=input_ids,
             input_mask=input_mask,
             token_type_ids=None,
-            use_one_hot_embeddings=use_one_hot_embeddings)
+            use_one_hot_embeddings=use_one_hot_embeddings,
+            segment_ids=segment_ids)
 
         #         all_user_and_item = model.get_embedding_table()
         #         item_ids = [i for i in range(0, item_size + 1)]
@@ -270,7 +403,7 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
              bert_config,
              model.get_sequence_output(),
              model.get_embedding_table(), masked_lm_positions, masked_lm_ids,
-             masked_lm_weights)
+             masked_lm_weights, sampled_softmax if is_training else None)
 
         total_loss = masked_lm_loss
 
@@ -307,7 +440,9 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         if mode == tf.estimator.ModeKeys.TRAIN:
             train_op = optimization.create_optimizer(total_loss, learning_rate,
                                                      num_train_steps,
-                                                     num_warmup_steps, use_tpu)
+                                                     num_warmup_steps, use_tpu,
+                                                     fused=fused_optimizer,
+                                                     lazy_sparse=lazy_adam)
 
             output_spec = tf.estimator.EstimatorSpec(
                 mode=mode,
@@ -362,10 +497,34 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
 
 def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
-                         label_ids, label_weights):
-    """Get loss and log probs for the masked LM."""
+                         label_ids, label_weights, sampled_softmax=None):
+    """Get loss and log probs for the masked LM.
+
+    With `sampled_softmax`, a dict of `num_sampled` and the `unigrams` of
+    every vocab id (see `sampled_softmax_unigrams`), the loss is a sampled
+    softmax over the labels and `num_sampled` negatives drawn by `unigrams`
+    for the whole batch, and no log probs (None) are returned.
+
+    Only the masked positions with a non-zero weight go through the output
+    layer; the padding rows of the returned loss and log probs are 0.
+
+    With `bert_config.precision` "bfloat16", the transform and the full
+    softmax's vocab projection run in bfloat16; the softmax and loss do not.
+    """
+    compute_dtype = modeling.get_compute_dtype(bert_config)
     # [batch_size*label_size, dim]
     input_tensor = gather_indexes(input_tensor, positions)
+    num_rows = tf.shape(input_tensor)[0]
+
+    # The `positions` tensor might be zero-padded (if the sequence is too
+    # short to have the maximum number of predictions). Only the rows with a
+    # non-zero weight go through the output layer.
+    label_ids = tf.reshape(label_ids, [-1])
+    label_weights = tf.reshape(label_weights, [-1])
+    real_rows = tf.cast(tf.where(label_weights > 0), tf.int32)
+    input_tensor = tf.gather_nd(input_tensor, real_rows)
+    real_label_ids = tf.gather_nd(label_ids, real_rows)
+    real_label_weights = tf.gather_nd(label_weights, real_rows)
 
     with tf.compat.v1.variable_scope("cls/predictions"):
         # We apply one more non-linear transformation before the output layer.
@@ -377,8 +536,10 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
                 kernel_initializer=modeling.create_initializer(
                     bert_config.initializer_range
                 ),
+                dtype=modeling.dense_layer_dtype(compute_dtype),
             )(input_tensor)
-            input_tensor = modeling.layer_norm(input_tensor)
+            input_tensor = modeling.layer_norm(
+                tf.cast(input_tensor, tf.float32))
 
         # The output weights are the same as the input embeddings, but there is
         # an output-only bias for each token.
@@ -387,30 +548,65 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
             trainable=True,
             name="output_bias",
         )
-        logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
-        logits = tf.nn.bias_add(logits, output_bias)
-        # logits, (bs*label_size, vocab_size)
-        log_probs = tf.nn.log_softmax(logits, -1)
-
-        label_ids = tf.reshape(label_ids, [-1])
-        label_weights = tf.reshape(label_weights, [-1])
-
-        one_hot_labels = tf.one_hot(
-            label_ids, depth=output_weights.shape[0], dtype=tf.float32)
-
-        # The `positions` tensor might be zero-padded (if the sequence is too
-        # short to have the maximum number of predictions). The `label_weights`
-        # tensor has a value of 1.0 for every real prediction and 0.0 for the
-        # padding predictions.
-        per_example_loss = -tf.reduce_sum(
-            log_probs * one_hot_labels, axis=[-1])
-        numerator = tf.reduce_sum(label_weights * per_example_loss)
-        denominator = tf.reduce_sum(label_weights) + 1e-5
+
+        if sampled_softmax is not None:
+            unigrams = sampled_softmax["unigrams"]
+            labels = tf.cast(tf.reshape(real_label_ids, [-1, 1]), tf.int64)
+            sampled_values = tf.random.fixed_unigram_candidate_sampler(
+                true_classes=labels,
+                num_true=1,
+                num_sampled=sampled_softmax["num_sampled"],
+                unique=True,
+                range_max=len(unigrams),
+                unigrams=unigrams)
+            per_example_loss = tf.nn.sampled_softmax_loss(
+                weights=output_weights,
+                biases=output_bias,
+                labels=labels,
+                inputs=input_tensor,
+                num_sampled=sampled_softmax["num_sampled"],
+                num_classes=len(unigrams),
+                sampled_values=sampled_values)
+            log_probs = None
+        else:
+            logits = tf.matmul(tf.cast(input_tensor, compute_dtype),
+                               tf.cast(output_weights, compute_dtype),
+                               transpose_b=True)
+            logits = tf.nn.bias_add(tf.cast(logits, tf.float32), output_bias)
+            # logits, (num_real_rows, vocab_size)
+            real_log_probs = tf.nn.log_softmax(logits, -1)
+
+            one_hot_labels = tf.one_hot(
+                real_label_ids, depth=output_weights.shape[0],
+                dtype=tf.float32)
+            per_example_loss = -tf.reduce_sum(
+                real_log_probs * one_hot_labels, axis=[-1])
+
+            # back to (bs*label_size, vocab_size), zeros for the padding rows
+            log_probs = tf.scatter_nd(
+                real_rows, real_log_probs,
+                tf.stack([num_rows, output_weights.shape[0]]))
+        numerator = tf.reduce_sum(real_label_weights * per_example_loss)
+        denominator = tf.reduce_sum(real_label_weights) + 1e-5
         loss = numerator / denominator
+        per_example_loss = tf.scatter_nd(real_rows, per_example_loss,
+                                         tf.expand_dims(num_rows, 0))
 
     return (loss, per_example_loss, log_probs)
 
 
+def sampled_softmax_unigrams(vocab, vocab_size, sampler):
+    """Sampling weights of the vocab ids 0..vocab_size-1 for the sampled
+    softmax: the item counts for "popularity", 1 per item for "uniform", and
+    0 for padding and special tokens, which are never sampled."""
+    unigrams = np.zeros(vocab_size, dtype=np.float64)
+    if sampler == "uniform":
+        unigrams[vocab.get_item_ids()] = 1.0
+    else:
+        unigrams[vocab.get_item_ids()] = vocab.get_item_counts()
+    return unigrams.tolist()
+
+
 def gather_indexes(sequence_tensor, positions):
     """Gathers the vectors at the specific positions over a minibatch."""
     sequence_shape = modeling.get_shape_list(sequence_tensor, expected_rank=3)
@@ -427,78 +623,279 @@ def gather_indexes(sequence_tensor, positions):
     return output_tensor
 
 
+def input_cache_key(input_files, *args):
+    """Names the cache of `input_files` decoded with `args`: changes when
+    any of the files or the decoding changes, not with the model config."""
+    key = hashlib.sha1()
+    for input_file in sorted(input_files):
+        stat = tf.io.gfile.stat(input_file)
+        key.update(repr((os.path.basename(input_file), stat.length,
+                         stat.mtime_nsec)).encode("utf-8"))
+    key.update(repr(args).encode("utf-8"))
+    return key.hexdigest()[:16]
+
+
 def input_fn_builder(input_files,
                      max_seq_length,
                      max_predictions_per_seq,
                      is_training,
-                     num_cpu_threads=4):
-    """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     num_cpu_threads=4,
+                     masking=None,
+                     compact=False,
+                     shuffle_buffer_size=100,
+                     cache=None,
+                     length_buckets=None,
+                     packed=False):
+    """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+    Records are batched before parsing. For training, the files are read
+    interleaved and shuffled through `shuffle_buffer_size` records.
+
+    With `masking`, a dict of `mask_window` keyword arguments, the records
+    are unmasked windows that get masked on the fly. With `compact`, records
+    use the compact layout of gen_data.py.
+
+    With `cache` ("memory" or a directory), training decodes one pass over
+    the files, in a fixed shuffled file order, and replays it for the later
+    epochs. A directory holds a snapshot under `input_cache_key`, which
+    later runs on the same data reuse; it is written in shards that every
+    epoch reads back in a new order. A memory cache reshuffles its batches
+    every epoch instead. Masking is applied after the cache, so it stays
+    fresh.
+
+    With `length_buckets`, batches are regrouped by `bucket_by_length`.
+    With `packed`, records also have the segment_ids of packed rows.
+    """
 
     def input_fn(params):
         """The actual input function."""
         batch_size = params["batch_size"]
 
-        name_to_features = {
-            "info":
-            tf.io.FixedLenFeature([1], tf.int64),  #[user]
-            "input_ids":
-            tf.io.FixedLenFeature([max_seq_length], tf.int64),
-            "input_mask":
-            tf.io.FixedLenFeature([max_seq_length], tf.int64),
-            "masked_lm_positions":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
-            "masked_lm_ids":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
-            "masked_lm_weights":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.float32)
-        }
+        name_to_features = padded_record_features(
+            max_seq_length, max_predictions_per_seq,
+            masked=masking is None, packed=packed)
+
+        use_cache = is_training and cache is not None
 
         # For training, we want a lot of parallel reading and shuffling.
         # For eval, we want no shuffling and parallel reading doesn't matter.
         if is_training:
-            d = tf.data.TFRecordDataset(input_files)
-            d = d.repeat()
-            d = d.shuffle(buffer_size=100)
+            d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
+            if use_cache:
+                # a cached pass is read once, in the same order every run,
+                # and reshuffled after the cache
+                d = d.shuffle(buffer_size=len(input_files), seed=12345,
+                              reshuffle_each_iteration=False)
+            else:
+                d = d.repeat()
+                d = d.shuffle(buffer_size=len(input_files))
 
             # `cycle_length` is the number of parallel files that get read.
-            #cycle_length = min(num_cpu_threads, len(input_files))
-
-            # `sloppy` mode means that the interleaving is not exact. This adds
-            # even more randomness to the training pipeline.
-            #d = d.apply(
-            #    tf.contrib.data.parallel_interleave(
-            #        tf.data.TFRecordDataset,
-            #        sloppy=is_training,
-            #        cycle_length=cycle_length))
-            #d = d.shuffle(buffer_size=100)
+            # Non-deterministic interleaving adds even more randomness to the
+            # training pipeline.
+            cycle_length = min(num_cpu_threads, len(input_files))
+            d = d.interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=cycle_length,
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=False)
+            if not use_cache:
+                d = d.shuffle(buffer_size=shuffle_buffer_size)
         else:
             d = tf.data.TFRecordDataset(input_files)
 
+        # parse whole batches at once
+        d = d.batch(batch_size=batch_size)
+        if compact:
+            d = d.map(
+                lambda records: decode_compact_records(
+                    records, max_seq_length, max_predictions_per_seq,
+                    masked=masking is None, packed=packed),
+                num_parallel_calls=tf.data.AUTOTUNE)
+        else:
+            d = d.map(
+                lambda records: decode_record(records, name_to_features),
+                num_parallel_calls=tf.data.AUTOTUNE)
+
+        if use_cache:
+            if cache == "memory":
+                d = d.cache()
+                d = d.shuffle(buffer_size=shuffle_buffer_size)
+            else:
+                key = input_cache_key(input_files, max_seq_length,
+                                      max_predictions_per_seq, compact,
+                                      masking is None, packed)
+                num_shards = len(input_files)
+
+                def read_shards(shards):
+                    shards = shards.shuffle(buffer_size=num_shards)
+                    return shards.interleave(
+                        lambda shard: shard,
+                        cycle_length=cycle_length,
+                        num_parallel_calls=tf.data.AUTOTUNE,
+                        deterministic=False)
+
+                d = d.enumerate()
+                d = d.snapshot(os.path.join(cache, key),
+                               reader_func=read_shards,
+                               shard_func=lambda index, _: index % num_shards)
+                d = d.map(lambda index, batch: batch)
+            d = d.repeat()
+            d = d.unbatch()
+            d = d.shuffle(buffer_size=shuffle_buffer_size)
+            d = d.batch(batch_size=batch_size)
+
+        if masking is not None:
+            d = d.map(
+                lambda example: mask_window(
+                    example, max_predictions_per_seq, **masking),
+                num_parallel_calls=tf.data.AUTOTUNE)
+        if length_buckets:
+            d = bucket_by_length(d, batch_size, length_buckets)
+        d = d.prefetch(tf.data.AUTOTUNE)
+        return d
+
+    return input_fn
 
-        d = d.map(
-            lambda record: _decode_record(record, name_to_features),
-            num_parallel_calls=num_cpu_threads)
+
+def npy_input_fn_builder(prefix,
+                         max_seq_length,
+                         max_predictions_per_seq,
+                         is_training,
+                         masking=None,
+                         length_buckets=None):
+    """Creates an `input_fn` reading the memory-mapped arrays that
+    gen_data.py --record_format=npy saved under `prefix`.
+
+    Batches are index ranges read straight from the arrays; contiguous
+    ranges (eval) are zero-copy slices of the memory map. For training, the
+    indices are shuffled over the whole set every epoch. `masking` and
+    `length_buckets` are as for `input_fn_builder`.
+    """
+
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params["batch_size"]
+
+        examples = load_examples(prefix)
+        if not examples:
+            raise ValueError("no arrays found for " + prefix)
+        if (examples["input_ids"].shape[1] != max_seq_length or
+                examples.get("masked_lm_ids", np.zeros(
+                    (0, max_predictions_per_seq))).shape[1] !=
+                max_predictions_per_seq):
+            raise ValueError(
+                "the arrays of {} do not match max_seq_length={} and "
+                "max_predictions_per_seq={}".format(
+                    prefix, max_seq_length, max_predictions_per_seq))
+        names = list(examples)
+        num_examples = len(examples["info"])
+
+        def read_rows(index):
+            index = np.sort(index)
+            if index[-1] - index[0] + 1 == len(index):
+                index = slice(index[0], index[-1] + 1)
+            return [examples[name][index] for name in names]
+
+        def to_features(*columns):
+            example = {}
+            for name, column in zip(names, columns):
+                column.set_shape((None,) + examples[name].shape[1:])
+                example[name] = column
+            example["info"] = tf.cast(example["info"], tf.int32)
+            example["input_mask"] = tf.cast(example["input_ids"] > 0,
+                                            tf.int32)
+            return example
+
+        d = tf.data.Dataset.range(num_examples)
+        if is_training:
+            d = d.shuffle(buffer_size=num_examples)
+            d = d.repeat()
         d = d.batch(batch_size=batch_size)
+        d = d.map(
+            lambda index: to_features(*tf.numpy_function(
+                read_rows, [index],
+                [tf.as_dtype(examples[name].dtype) for name in names])),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        if masking is not None:
+            d = d.map(
+                lambda example: mask_window(
+                    example, max_predictions_per_seq, **masking),
+                num_parallel_calls=tf.data.AUTOTUNE)
+        if length_buckets:
+            d = bucket_by_length(d, batch_size, length_buckets)
+        d = d.prefetch(tf.data.AUTOTUNE)
         return d
 
     return input_fn
 
 
-def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
-    example = tf.io.parse_single_example(record, name_to_features)
+def bucket_by_length(d, batch_size, boundaries):
+    """Regroups batches of examples into batches of windows whose lengths
+    fall in the same bucket of `boundaries` (exclusive upper bounds), and
+    trims input_ids, input_mask (and segment_ids) of every batch to its
+    longest window.
+
+    Windows are left-aligned, so the trimmed columns are padding only.
+    """
+    d = d.unbatch()
+    d = d.bucket_by_sequence_length(
+        lambda example: tf.reduce_sum(example["input_mask"]),
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1))
+    return d.map(trim_batch, num_parallel_calls=tf.data.AUTOTUNE)
 
-    # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
-    # So cast all int64 to int32.
-    for name in list(example.keys()):
-        t = example[name]
-        if t.dtype == tf.int64:
-            t = tf.cast(t, tf.int32)
-        example[name] = t
 
+def trim_batch(example):
+    length = tf.reduce_max(tf.reduce_sum(example["input_mask"], axis=1))
+    for name in ["input_ids", "input_mask", "segment_ids"]:
+        if name in example:
+            example[name] = example[name][:, :length]
     return example
 
 
+def read_sequence_lengths(input_files, record_format, max_records=100000):
+    """Window lengths of up to `max_records` records of `input_files`, read
+    round-robin over the files (the npy prefix for `record_format` npy)."""
+    if record_format == "npy":
+        input_ids = load_examples(input_files[0])["input_ids"]
+        return np.count_nonzero(input_ids[:max_records], axis=1)
+
+    lengths = []
+    iterators = [tf.compat.v1.io.tf_record_iterator(input_file)
+                 for input_file in input_files]
+    while iterators and len(lengths) < max_records:
+        for iterator in list(iterators):
+            record = next(iterator, None)
+            if record is None:
+                iterators.remove(iterator)
+                continue
+            input_ids = tf.train.Example.FromString(record).features.feature[
+                "input_ids"].int64_list.value
+            lengths.append(np.count_nonzero(input_ids))
+    return np.array(lengths[:max_records], dtype=np.int64)
+
+
+def data_length_buckets(input_files, record_format, num_buckets):
+    """`length_bucket_boundaries` of the data in `input_files`, or None."""
+    if num_buckets <= 1:
+        return None
+    lengths = read_sequence_lengths(input_files, record_format)
+    boundaries = length_bucket_boundaries(lengths, num_buckets)
+    print("window length mean:{:.1f}, max:{}, bucket boundaries:{}".format(
+        lengths.mean(), lengths.max(), boundaries))
+    return boundaries
+
+
+def length_bucket_boundaries(lengths, num_buckets):
+    """Boundaries that split the histogram of `lengths` into `num_buckets`
+    buckets of about equal counts, as exclusive upper bounds."""
+    cdf = np.cumsum(np.bincount(lengths)) / float(len(lengths))
+    quantiles = np.arange(1, num_buckets) / float(num_buckets)
+    boundaries = np.searchsorted(cdf, quantiles) + 1
+    return sorted(set(int(b) for b in boundaries if b <= lengths.max()))
+
+
 def main(argv):
     tf.get_logger().setLevel("INFO")
 
@@ -509,20 +906,32 @@ def main(argv):
         raise ValueError(
             "At least one of `do_train` or `do_eval` must be True.")
 
+    if FLAGS.pack_sequences and FLAGS.dynamic_masking:
+        raise ValueError("pack_sequences does not work with dynamic_masking.")
+
+    if FLAGS.num_sampled > 0 and not FLAGS.do_train:
+        raise ValueError("num_sampled only applies to training, eval always "
+                         "uses the full softmax.")
+
     bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
     tf.io.gfile.makedirs(FLAGS.checkpointDir)
 
+    npy = FLAGS.record_format == "npy"
+
     train_input_files = []
     for input_pattern in FLAGS.train_input_file.split(","):
-        train_input_files.extend(tf.io.gfile.glob(input_pattern))
+        # npy data is read by prefix
+        train_input_files.extend(
+            [input_pattern] if npy else tf.io.gfile.glob(input_pattern))
 
     test_input_files = []
     if FLAGS.test_input_file is None:
         test_input_files = train_input_files
     else:
         for input_pattern in FLAGS.test_input_file.split(","):
-            test_input_files.extend(tf.io.gfile.glob(input_pattern))
+            test_input_files.extend(
+                [input_pattern] if npy else tf.io.gfile.glob(input_pattern))
 
     tf.get_logger().info("*** train Input Files ***")
     for input_file in train_input_files:
@@ -540,9 +949,25 @@ def main(argv):
         save_checkpoints_steps=FLAGS.save_checkpoints_steps)
 
     if FLAGS.vocab_filename is not None:
-        with open(FLAGS.vocab_filename, 'rb') as input_file:
-            vocab = pickle.load(input_file)
-    item_size = len(vocab.counter)
+        vocab = load_vocab(FLAGS.vocab_filename)
+    item_size = vocab.get_item_count()
+
+    sampled_softmax = None
+    if FLAGS.num_sampled > 0:
+        unigrams = sampled_softmax_unigrams(vocab, bert_config.vocab_size,
+                                            FLAGS.sampler)
+        # the sampler draws distinct ids, so it would wait forever for more
+        # than there are
+        num_candidates = sum(1 for unigram in unigrams if unigram > 0)
+        if FLAGS.num_sampled >= num_candidates:
+            raise ValueError(
+                "num_sampled={} must be less than the {} items the {} "
+                "sampler can draw.".format(FLAGS.num_sampled, num_candidates,
+                                           FLAGS.sampler))
+        sampled_softmax = {
+            "num_sampled": FLAGS.num_sampled,
+            "unigrams": unigrams,
+        }
 
     model_fn = model_fn_builder(
         bert_config=bert_config,
@@ -552,7 +977,10 @@ def main(argv):
         num_warmup_steps=FLAGS.num_warmup_steps,
         use_tpu=FLAGS.use_tpu,
         use_one_hot_embeddings=FLAGS.use_tpu,
-        item_size=item_size)
+        item_size=item_size,
+        sampled_softmax=sampled_softmax,
+        fused_optimizer=FLAGS.fused_optimizer,
+        lazy_adam=FLAGS.lazy_adam)
 
     # If TPU is not available, this will fall back to normal Estimator on CPU
     # or GPU.
@@ -566,23 +994,77 @@ def main(argv):
     if FLAGS.do_train:
         tf.get_logger().info("***** Running training *****")
         tf.get_logger().info("  Batch size = %d", FLAGS.batch_size)
-        train_input_fn = input_fn_builder(
-            input_files=train_input_files,
-            max_seq_length=FLAGS.max_seq_length,
-            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-            is_training=True)
+        masking = None
+        if FLAGS.dynamic_masking:
+            masking = {
+                "masked_lm_prob": FLAGS.masked_lm_prob,
+                "mask_prob": FLAGS.mask_prob,
+                "mask_last_prob": FLAGS.mask_last_prob,
+                "mask_id": vocab.get_special_token_id("[MASK]"),
+                "item_count": vocab.get_item_count(),
+            }
+        train_length_buckets = data_length_buckets(
+            train_input_files, FLAGS.record_format, FLAGS.num_length_buckets)
+        if npy:
+            train_input_fn = npy_input_fn_builder(
+                prefix=train_input_files[0],
+                max_seq_length=FLAGS.max_seq_length,
+                max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+                is_training=True,
+                masking=masking,
+                length_buckets=train_length_buckets)
+        else:
+            train_input_fn = input_fn_builder(
+                input_files=train_input_files,
+                max_seq_length=FLAGS.max_seq_length,
+                max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+                is_training=True,
+                num_cpu_threads=FLAGS.num_input_threads,
+                masking=masking,
+                compact=FLAGS.record_format == "compact",
+                shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+                cache=FLAGS.input_cache,
+                length_buckets=train_length_buckets,
+                packed=FLAGS.pack_sequences)
+
+        hooks = []
+        if FLAGS.report_input_bound:
+            train_input_fn = timed_input_fn(train_input_fn)
+            input_wait_hook = InputWaitHook()
+            hooks.append(input_wait_hook)
+
         estimator.train(
-            input_fn=train_input_fn, max_steps=FLAGS.num_train_steps)
+            input_fn=train_input_fn, max_steps=FLAGS.num_train_steps,
+            hooks=hooks)
+
+        if FLAGS.report_input_bound and input_wait_hook.step_times:
+            step_time, input_wait = input_wait_hook.mean_times()
+            print("step time: {:.2f} ms, waiting for input: {:.2f} ms "
+                  "({:.1f}% of the step)".format(
+                      1000.0 * step_time, 1000.0 * input_wait,
+                      100.0 * input_wait / step_time))
 
     if FLAGS.do_eval:
         tf.get_logger().info("***** Running evaluation *****")
         tf.get_logger().info("  Batch size = %d", FLAGS.batch_size)
 
-        eval_input_fn = input_fn_builder(
-            input_files=test_input_files,
-            max_seq_length=FLAGS.max_seq_length,
-            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-            is_training=False)
+        test_length_buckets = data_length_buckets(
+            test_input_files, FLAGS.record_format, FLAGS.num_length_buckets)
+        if npy:
+            eval_input_fn = npy_input_fn_builder(
+                prefix=test_input_files[0],
+                max_seq_length=FLAGS.max_seq_length,
+                max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+                is_training=False,
+                length_buckets=test_length_buckets)
+        else:
+            eval_input_fn = input_fn_builder(
+                input_files=test_input_files,
+                max_seq_length=FLAGS.max_seq_length,
+                max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+                is_training=False,
+                compact=FLAGS.record_format == "compact",
+                length_buckets=test_length_buckets)
 
         # tf.get_logger().info('special eval ops:', special_eval_ops)
         result = estimator.evaluate(
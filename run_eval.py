@@ -26,7 +26,9 @@ from absl import flags
 import numpy as np
 
 import modeling
-import pickle
+from records import decode_compact_records, decode_record, padded_record_features
+from util import load_examples, load_history
+from vocab import load_vocab
 
 FLAGS = flags.FLAGS
 
@@ -117,6 +119,13 @@ flags.DEFINE_string("master", None, "[Optional] TensorFlow master URL.")
 flags.DEFINE_bool("use_pop_random", True, "use pop random negative samples")
 flags.DEFINE_string("vocab_filename", None, "vocab filename")
 flags.DEFINE_string("user_history_filename", None, "user history filename")
+flags.DEFINE_enum(
+    "record_format",
+    "padded",
+    ["padded", "compact", "npy"],
+    "Record layout written by gen_data.py --record_format. With npy, "
+    "test_input_file is the prefix of the arrays.",
+)
 
 
 class EvalHooks(tf.compat.v1.train.SessionRunHook):
@@ -140,19 +149,15 @@ class EvalHooks(tf.compat.v1.train.SessionRunHook):
 
         if FLAGS.user_history_filename is not None:
             print("load user history from :" + FLAGS.user_history_filename)
-            with open(FLAGS.user_history_filename, "rb") as input_file:
-                self.user_history = pickle.load(input_file)
+            self.user_history = load_history(FLAGS.user_history_filename)
 
         if FLAGS.vocab_filename is not None:
             print("load vocab from :" + FLAGS.vocab_filename)
-            with open(FLAGS.vocab_filename, "rb") as input_file:
-                self.vocab = pickle.load(input_file)
+            self.vocab = load_vocab(FLAGS.vocab_filename)
 
-            keys = self.vocab.counter.keys()
-            values = self.vocab.counter.values()
-            self.ids = self.vocab.convert_tokens_to_ids(keys)
-            sum_value = np.sum([x for x in values])
-            self.probability = [value / sum_value for value in values]
+            self.ids = self.vocab.get_item_ids()
+            values = self.vocab.get_item_counts()
+            self.probability = values / np.sum(values)
 
     def end(self, session):
         print(
@@ -182,9 +187,9 @@ class EvalHooks(tf.compat.v1.train.SessionRunHook):
             rated = set(input_ids[idx])
             rated.add(0)
             rated.add(masked_lm_ids[idx][0])
-            user_key = "user_" + str(info[idx][0])
-            if user_key in self.user_history:
-                for x in self.user_history[user_key][0]:
+            user = int(info[idx][0])
+            if user in self.user_history:
+                for x in self.user_history[user]:
                     rated.add(x)
 
             item_idx = [masked_lm_ids[idx][0]]
@@ -417,49 +422,91 @@ def gather_indexes(sequence_tensor, positions):
 
 
 def input_fn_builder(
-    input_files, max_seq_length, max_predictions_per_seq, num_cpu_threads=4
+    input_files,
+    max_seq_length,
+    max_predictions_per_seq,
+    num_cpu_threads=4,
+    compact=False,
 ):
     """Creates an `input_fn` closure to be passed to TPUEstimator."""
 
     def input_fn(params):
         batch_size = params["batch_size"]
 
-        name_to_features = {
-            "info": tf.io.FixedLenFeature([1], tf.int64),  # [user]
-            "input_ids": tf.io.FixedLenFeature([max_seq_length], tf.int64),
-            "input_mask": tf.io.FixedLenFeature([max_seq_length], tf.int64),
-            "masked_lm_positions": tf.io.FixedLenFeature(
-                [max_predictions_per_seq], tf.int64
-            ),
-            "masked_lm_ids": tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
-            "masked_lm_weights": tf.io.FixedLenFeature(
-                [max_predictions_per_seq], tf.float32
-            ),
-        }
+        name_to_features = padded_record_features(
+            max_seq_length, max_predictions_per_seq
+        )
 
         d = tf.data.TFRecordDataset(input_files)
 
-        d = d.map(
-            lambda record: _decode_record(record, name_to_features),
-            num_parallel_calls=num_cpu_threads,
-        )
+        # parse whole batches at once
         d = d.batch(batch_size=batch_size)
+        if compact:
+            d = d.map(
+                lambda records: decode_compact_records(
+                    records, max_seq_length, max_predictions_per_seq
+                ),
+                num_parallel_calls=num_cpu_threads,
+            )
+        else:
+            d = d.map(
+                lambda records: decode_record(records, name_to_features),
+                num_parallel_calls=num_cpu_threads,
+            )
         return d
 
     return input_fn
 
 
-def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
-    example = tf.io.parse_single_example(record, name_to_features)
+def npy_input_fn_builder(prefix, max_seq_length, max_predictions_per_seq):
+    """Creates an `input_fn` reading, in order, the memory-mapped arrays
+    that gen_data.py --record_format=npy saved under `prefix`."""
+
+    def input_fn(params):
+        batch_size = params["batch_size"]
 
-    for name in list(example.keys()):
-        t = example[name]
-        if t.dtype == tf.int64:
-            t = tf.cast(t, tf.int32)
-        example[name] = t
+        examples = load_examples(prefix)
+        if not examples:
+            raise ValueError("no arrays found for " + prefix)
+        if (
+            examples["input_ids"].shape[1] != max_seq_length
+            or examples["masked_lm_ids"].shape[1] != max_predictions_per_seq
+        ):
+            raise ValueError(
+                "the arrays of {} do not match max_seq_length={} and "
+                "max_predictions_per_seq={}".format(
+                    prefix, max_seq_length, max_predictions_per_seq
+                )
+            )
+        names = list(examples)
+        num_examples = len(examples["info"])
+
+        def read_rows(start):
+            # zero-copy slices of the memory map
+            return [examples[name][start : start + batch_size] for name in names]
+
+        def to_features(*columns):
+            example = {}
+            for name, column in zip(names, columns):
+                column.set_shape((None,) + examples[name].shape[1:])
+                example[name] = column
+            example["info"] = tf.cast(example["info"], tf.int32)
+            example["input_mask"] = tf.cast(example["input_ids"] > 0, tf.int32)
+            return example
+
+        d = tf.data.Dataset.range(0, num_examples, batch_size)
+        d = d.map(
+            lambda start: to_features(
+                *tf.numpy_function(
+                    read_rows,
+                    [start],
+                    [tf.as_dtype(examples[name].dtype) for name in names],
+                )
+            ),
+        )
+        return d
 
-    return example
+    return input_fn
 
 
 def main(argv):
@@ -468,9 +515,14 @@ def main(argv):
     FLAGS.checkpointDir = FLAGS.checkpointDir + FLAGS.signature
     print("checkpointDir:", FLAGS.checkpointDir)
 
+    npy = FLAGS.record_format == "npy"
+
     test_input_files = []
     for input_pattern in FLAGS.test_input_file.split(","):
-        test_input_files.extend(tf.io.gfile.glob(input_pattern))
+        # npy data is read by prefix
+        test_input_files.extend(
+            [input_pattern] if npy else tf.io.gfile.glob(input_pattern)
+        )
 
     tf.get_logger().info("*** test Input Files ***")
     for input_file in test_input_files:
@@ -486,9 +538,8 @@ def main(argv):
     )
 
     if FLAGS.vocab_filename is not None:
-        with open(FLAGS.vocab_filename, "rb") as input_file:
-            vocab = pickle.load(input_file)
-    item_size = len(vocab.counter)
+        vocab = load_vocab(FLAGS.vocab_filename)
+    item_size = vocab.get_item_count()
 
     model_fn = model_fn_builder(
         bert_config=bert_config,
@@ -506,11 +557,19 @@ def main(argv):
     tf.get_logger().info("***** Running evaluation *****")
     tf.get_logger().info("  Batch size = %d", FLAGS.batch_size)
 
-    eval_input_fn = input_fn_builder(
-        input_files=test_input_files,
-        max_seq_length=FLAGS.max_seq_length,
-        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-    )
+    if npy:
+        eval_input_fn = npy_input_fn_builder(
+            prefix=test_input_files[0],
+            max_seq_length=FLAGS.max_seq_length,
+            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+        )
+    else:
+        eval_input_fn = input_fn_builder(
+            input_files=test_input_files,
+            max_seq_length=FLAGS.max_seq_length,
+            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+            compact=FLAGS.record_format == "compact",
+        )
 
     result = estimator.evaluate(
         input_fn=eval_input_fn, steps=None, hooks=[EvalHooks()]
@@ -31,7 +31,7 @@ fi
 
 
 CUDA_VISIBLE_DEVICES=0 python -u run.py \
-    --train_input_file=./data/${dataset_name}${signature}.train.tfrecord \
+    --train_input_file="./data/${dataset_name}${signature}.train.tfrecord-*" \
     --test_input_file=./data/${dataset_name}${signature}.test.tfrecord \
     --vocab_filename=./data/${dataset_name}${signature}.vocab \
     --user_history_filename=./data/${dataset_name}${signature}.his \
@@ -1,8 +1,14 @@
 from __future__ import print_function
 
+import os
 import sys
+import pickle
 
 from collections import defaultdict
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
 import random
 import copy
 
@@ -39,3 +45,254 @@ def data_partition(fname):
             user_test[user] = []
             user_test[user].append(User[user][-1])
     return [user_train, user_valid, user_test, usernum, itemnum]
+
+
+def save_sequences(prefix, users, offsets, items):
+    """Saves sequences in CSR layout: `users[i]` owns
+    `items[offsets[i]:offsets[i + 1]]`."""
+    np.save(prefix + '.users.npy', np.asarray(users, dtype=np.int64))
+    np.save(prefix + '.offsets.npy', np.asarray(offsets, dtype=np.int64))
+    np.save(prefix + '.items.npy', np.asarray(items, dtype=np.int32))
+
+
+def write_sequences(prefix, users, lengths, seqs):
+    """Same files as `save_sequences`, with the items of the iterable `seqs`
+    written one sequence at a time into a memory-mapped file, so they are
+    never all in memory. `lengths` are the sequence lengths."""
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    np.save(prefix + '.users.npy', np.asarray(users, dtype=np.int64))
+    np.save(prefix + '.offsets.npy', offsets)
+    items = np.lib.format.open_memmap(prefix + '.items.npy', mode='w+',
+                                      dtype=np.int32, shape=(offsets[-1],))
+    for i, seq in enumerate(seqs):
+        items[offsets[i]:offsets[i + 1]] = seq
+    items.flush()
+    del items
+
+
+def load_sequences(prefix, mmap_mode='r'):
+    """Loads (users, offsets, items) saved by `save_sequences`, memory-mapped
+    by default."""
+    users = np.load(prefix + '.users.npy', mmap_mode=mmap_mode)
+    offsets = np.load(prefix + '.offsets.npy', mmap_mode=mmap_mode)
+    items = np.load(prefix + '.items.npy', mmap_mode=mmap_mode)
+    return users, offsets, items
+
+
+def load_sequences_text(fname):
+    """Parses a 'user item' text file into CSR (users, offsets, items).
+
+    The whole file is parsed by numpy in one call. Users keep the order of
+    their first line and items the order of the file, as in `data_partition`.
+    """
+    pairs = np.fromfile(fname, dtype=np.int64, sep=' ').reshape(-1, 2)
+    line_users = pairs[:, 0]
+    if len(line_users) == 0:
+        return (line_users, np.zeros(1, dtype=np.int64),
+                pairs[:, 1].astype(np.int32))
+
+    # files written by gen_learn_sequence.py already hold every user in one
+    # run of lines, then the runs are the sequences
+    run_starts = np.flatnonzero(np.r_[True, line_users[1:] != line_users[:-1]])
+    run_users = line_users[run_starts]
+    if len(np.unique(run_users)) == len(run_users):
+        offsets = np.append(run_starts, len(line_users)).astype(np.int64)
+        return run_users, offsets, pairs[:, 1].astype(np.int32)
+
+    # group the lines by user, users ordered by their first line
+    uniques, first, inverse = np.unique(line_users, return_index=True,
+                                        return_inverse=True)
+    rank = np.empty(len(uniques), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(uniques))
+    codes = rank[inverse]
+    order = np.argsort(codes, kind='stable')
+
+    users = uniques[np.argsort(first, kind='stable')]
+    lengths = np.bincount(codes, minlength=len(users))
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    items = pairs[order, 1].astype(np.int32)
+    return users, offsets, items
+
+
+class LazySequenceDict(Mapping):
+    """Read-only `{user: [items]}` view of index ranges into one item array.
+
+    A user's list is only built when it is looked up, and is then cached so
+    in-place changes (e.g. `d[u].extend(...)`) persist as with a plain dict.
+    """
+
+    def __init__(self, users, starts, ends, all_items):
+        self.users = users
+        self.starts = starts
+        self.ends = ends
+        self.all_items = all_items
+        self._sorter = np.argsort(users, kind='stable')
+        self._cache = {}
+
+    def _row(self, user):
+        pos = np.searchsorted(self.users, user, sorter=self._sorter)
+        if pos < len(self.users):
+            row = self._sorter[pos]
+            if self.users[row] == user:
+                return row
+        return -1
+
+    def __getitem__(self, user):
+        if user in self._cache:
+            return self._cache[user]
+        row = self._row(user)
+        if row < 0:
+            raise KeyError(user)
+        seq = self.all_items[self.starts[row]:self.ends[row]].tolist()
+        self._cache[user] = seq
+        return seq
+
+    def __contains__(self, user):
+        return user in self._cache or self._row(user) >= 0
+
+    def __iter__(self):
+        return iter(self.users.tolist())
+
+    def __len__(self):
+        return len(self.users)
+
+
+class SequencePartition(object):
+    """Train/valid/test split of CSR sequences as index ranges.
+
+    As in `data_partition`, the last two items of every user with at least
+    3 items are the valid and test item, everything else is train.
+    """
+
+    def __init__(self, users, offsets, items):
+        self.users = users
+        self.offsets = offsets
+        self.items = items
+
+        starts = offsets[:-1]
+        ends = offsets[1:]
+        split = (ends - starts) >= 3
+        self.train_ranges = (starts, np.where(split, ends - 2, ends))
+        self.valid_ranges = (np.where(split, ends - 2, ends),
+                             np.where(split, ends - 1, ends))
+        self.test_ranges = (np.where(split, ends - 1, ends), ends)
+
+        self.usernum = int(users.max()) if len(users) else 0
+        self.itemnum = int(items.max()) if len(items) else 0
+
+    def train(self):
+        return LazySequenceDict(self.users, *self.train_ranges,
+                                all_items=self.items)
+
+    def valid(self):
+        return LazySequenceDict(self.users, *self.valid_ranges,
+                                all_items=self.items)
+
+    def test(self):
+        return LazySequenceDict(self.users, *self.test_ranges,
+                                all_items=self.items)
+
+    def to_list(self):
+        """The `[user_train, user_valid, user_test, usernum, itemnum]` list
+        returned by `data_partition`, with lazy dicts."""
+        return [self.train(), self.valid(), self.test(), self.usernum,
+                self.itemnum]
+
+
+def save_history(prefix, users, seqs):
+    """Saves the per-user history (vocab ids) with `save_sequences`."""
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in seqs])])
+    items = np.concatenate(seqs) if len(seqs) else []
+    save_sequences(prefix, users, offsets, items)
+
+
+def load_history(filename):
+    """Returns `{user: [vocab ids]}` for the history saved as `filename`.
+
+    Reads the memory-mapped CSR files of `save_history`, or the `.his` pickle
+    of `{'user_<id>': [[ids]]}` written by older versions of gen_data.py.
+    """
+    if os.path.exists(filename + '.users.npy'):
+        users, offsets, items = load_sequences(filename)
+        return LazySequenceDict(users, offsets[:-1], offsets[1:], items)
+    with open(filename, 'rb') as input_file:
+        history = pickle.load(input_file)
+    return {int(k.split('_')[1]): v[0] for k, v in history.items()}
+
+
+EXAMPLE_FIELDS = ('info', 'input_ids', 'segment_ids', 'masked_lm_positions',
+                  'masked_lm_ids', 'masked_lm_weights')
+
+
+def save_examples(prefix, examples):
+    """Saves a dict of dense example arrays as `<prefix>.<name>.npy`."""
+    for name, array in examples.items():
+        np.save(prefix + '.' + name + '.npy', array)
+
+
+def load_examples(prefix, mmap_mode='r'):
+    """Loads the arrays of `save_examples`, memory-mapped by default.
+
+    Unmasked windows only have info and input_ids, only packed rows have
+    segment_ids.
+    """
+    examples = {}
+    for name in EXAMPLE_FIELDS:
+        filename = prefix + '.' + name + '.npy'
+        if os.path.exists(filename):
+            examples[name] = np.load(filename, mmap_mode=mmap_mode)
+    return examples
+
+
+def concat_examples(prefix, part_prefixes):
+    """Concatenates the example arrays of `part_prefixes` into `prefix`,
+    one part at a time, and removes the parts.
+
+    Parts without rows are skipped; they may lack the masked fields. The
+    other parts must all have the same fields, dtypes and row shapes. At
+    least one part is needed, it gives the fields when all are empty.
+    """
+    if not part_prefixes:
+        raise ValueError("no parts to concatenate into " + prefix)
+    parts = [load_examples(part_prefix) for part_prefix in part_prefixes]
+    filled = [part for part in parts if len(part['info'])]
+    schema = {name: (array.dtype, array.shape[1:])
+              for name, array in (filled or parts)[0].items()}
+    for part_prefix, part in zip(part_prefixes, parts):
+        if not len(part['info']):
+            continue
+        part_schema = {name: (array.dtype, array.shape[1:])
+                       for name, array in part.items()}
+        if part_schema != schema:
+            raise ValueError("%s has fields %s, expected %s" % (
+                part_prefix, part_schema, schema))
+
+    for name, (dtype, row_shape) in schema.items():
+        num_rows = sum(len(part[name]) for part in filled)
+        output = np.lib.format.open_memmap(
+            prefix + '.' + name + '.npy', mode='w+', dtype=dtype,
+            shape=(num_rows,) + row_shape)
+        pos = 0
+        for part in filled:
+            output[pos:pos + len(part[name])] = part[name]
+            pos += len(part[name])
+        output.flush()
+        del output
+
+    del parts, filled
+    for part_prefix in part_prefixes:
+        for name in EXAMPLE_FIELDS:
+            filename = part_prefix + '.' + name + '.npy'
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def data_partition_fast(fname):
+    """Same as `data_partition`, using the vectorized text parser."""
+    return SequencePartition(*load_sequences_text(fname)).to_list()
+
+
+def data_partition_csr(prefix):
+    """Same as `data_partition`, reading the memory-mapped CSR files of
+    `prefix`."""
+    return SequencePartition(*load_sequences(prefix)).to_list()
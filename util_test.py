@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import util
+
+
+def make_sequence_file(path, num_users=60, interleaved=False, seed=0):
+    """Writes a 'user item' file of users with 1..10 items. Users are in one
+    run of lines each, as gen_learn_sequence.py writes them, or with their
+    lines interleaved."""
+    rng = np.random.RandomState(seed)
+    users = rng.permutation(np.arange(1, num_users + 1) * 1000 + 7)
+    lines = [(user, item) for user in users
+             for item in rng.randint(1, 500, size=rng.randint(1, 11))]
+    if interleaved:
+        lines = [lines[i] for i in rng.permutation(len(lines))]
+    with open(path, "w") as f:
+        for user, item in lines:
+            f.write("{} {}\n".format(user, item))
+
+
+class DataPartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertSamePartition(self, expected, actual):
+        for expected_split, actual_split in zip(expected[:3], actual[:3]):
+            self.assertEqual(list(actual_split), list(expected_split))
+            self.assertEqual(len(actual_split), len(expected_split))
+            for user, items in expected_split.items():
+                self.assertEqual(actual_split[user], items)
+        self.assertEqual(actual[3:], expected[3:])
+
+    def check(self, interleaved):
+        fname = os.path.join(self.tmp_dir.name, "seq.txt")
+        make_sequence_file(fname, interleaved=interleaved)
+        expected = util.data_partition(fname)
+        # some users are too short to have a valid and test item
+        self.assertTrue(any(not items for items in expected[2].values()))
+
+        self.assertSamePartition(expected, util.data_partition_fast(fname))
+
+        prefix = os.path.join(self.tmp_dir.name, "seq")
+        util.save_sequences(prefix, *util.load_sequences_text(fname))
+        self.assertSamePartition(expected, util.data_partition_csr(prefix))
+
+        users, offsets, items = util.load_sequences_text(fname)
+        util.write_sequences(
+            prefix, users, np.diff(offsets),
+            (items[beg:end] for beg, end in zip(offsets[:-1], offsets[1:])))
+        self.assertSamePartition(expected, util.data_partition_csr(prefix))
+
+    def test_csr_equals_text(self):
+        self.check(interleaved=False)
+
+    def test_csr_equals_text_interleaved(self):
+        self.check(interleaved=True)
+
+    def test_lazy_lookups(self):
+        fname = os.path.join(self.tmp_dir.name, "seq.txt")
+        make_sequence_file(fname)
+        user_train = util.data_partition_fast(fname)[0]
+        user = next(iter(user_train))
+        self.assertIn(user, user_train)
+        self.assertNotIn(-1, user_train)
+        with self.assertRaises(KeyError):
+            user_train[-1]
+        # in-place changes persist, as with the dicts of data_partition
+        user_train[user].append(0)
+        self.assertEqual(user_train[user][-1], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,14 @@
+import os
+import pickle
 from collections import Counter
 
+import numpy as np
+
+# version of the binary vocab artifact written by `save_vocab`
+VOCAB_FORMAT_VERSION = 1
+# special tokens get the ids right after the items, in this order
+SPECIAL_TOKENS = ("[pad]", "[MASK]", "[NO_USE]")
+
 
 def convert_by_vocab(vocab, items):
     """Converts a sequence of [tokens|ids] using the vocab."""
@@ -9,6 +18,30 @@ def convert_by_vocab(vocab, items):
     return output
 
 
+def raw_item_id(token):
+    """Returns the raw integer id of an item token ('item_12' or 12), or None
+    for special tokens."""
+    if isinstance(token, (int, np.integer)):
+        return int(token)
+    if token.startswith('item_'):
+        return int(token[len('item_'):])
+    return None
+
+
+def lookup_item_ids(item_to_id, items, pad_item=None):
+    """Maps raw item ids through the `item_to_id` array, raising KeyError for
+    unknown items."""
+    items = np.asarray(items, dtype=np.int64)
+    ids = np.full(items.shape, -1, dtype=np.int32)
+    known = (items >= 0) & (items < len(item_to_id))
+    ids[known] = item_to_id[items[known]]
+    if pad_item is not None:
+        ids[items == pad_item] = 0
+    if (ids < 0).any():
+        raise KeyError(int(items[ids < 0].flat[0]))
+    return ids
+
+
 class FreqVocab(object):
     """Runs end-to-end tokenziation."""
 
@@ -26,7 +59,7 @@ class FreqVocab(object):
 
         self.user_count = len(self.user_set)
         self.item_count = len(self.counter.keys())
-        self.special_tokens = {"[pad]", "[MASK]", '[NO_USE]'}
+        self.special_tokens = list(SPECIAL_TOKENS)
         self.token_to_ids = {}  # index begin from 1
         #first items
         for token, count in self.counter.most_common():
@@ -43,12 +76,67 @@ class FreqVocab(object):
         self.id_to_tokens = {v: k for k, v in self.token_to_ids.items()}
         self.vocab_words = list(self.token_to_ids.keys())
 
+        self._build_item_lookup()
+
+    def _build_item_lookup(self):
+        """Builds the raw item id <-> vocab id lookup arrays."""
+        raw_ids = []
+        ids = []
+        for token, idx in self.token_to_ids.items():
+            raw_id = raw_item_id(token)
+            if raw_id is not None:
+                raw_ids.append(raw_id)
+                ids.append(idx)
+        raw_ids = np.asarray(raw_ids, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        # raw item id -> vocab id, -1 for unknown items
+        self.item_to_id = np.full(
+            raw_ids.max() + 1 if len(raw_ids) else 0, -1, dtype=np.int32)
+        self.item_to_id[raw_ids] = ids
+        # vocab id -> raw item id, -1 for padding and special tokens
+        self.id_to_item = np.full(
+            len(self.token_to_ids) + 1, -1, dtype=np.int64)
+        self.id_to_item[ids] = raw_ids
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # vocab pickled before the lookup arrays existed
+        if 'item_to_id' not in state:
+            self._build_item_lookup()
+
     def convert_tokens_to_ids(self, tokens):
         return convert_by_vocab(self.token_to_ids, tokens)
 
     def convert_ids_to_tokens(self, ids):
         return convert_by_vocab(self.id_to_tokens, ids)
 
+    def convert_items_to_ids(self, items, pad_item=None):
+        """Maps raw integer item ids to vocab ids in one vectorized lookup.
+
+        `items` can have any shape, e.g. a [N, max_seq_length] batch. Entries
+        equal to `pad_item` map to the padding id 0.
+        """
+        return lookup_item_ids(self.item_to_id, items, pad_item)
+
+    def convert_ids_to_items(self, ids):
+        """Maps vocab ids back to raw integer item ids, -1 for padding and
+        special tokens."""
+        return self.id_to_item[np.asarray(ids, dtype=np.int64)]
+
+    def get_item_ids(self):
+        """Vocab ids of all items, in id order."""
+        return np.arange(1, self.item_count + 1, dtype=np.int64)
+
+    def get_item_counts(self):
+        """Frequency of every item, aligned with `get_item_ids`."""
+        return np.asarray(
+            [self.counter[self.id_to_tokens[i]] for i in self.get_item_ids()],
+            dtype=np.int64)
+
+    def get_special_token_id(self, token):
+        return self.token_to_ids[token]
+
     def get_vocab_words(self):
         return self.vocab_words  # not in order
 
@@ -72,3 +160,92 @@ class FreqVocab(object):
 
     def get_vocab_size(self):
         return self.get_item_count() + self.get_special_token_count() + 1 #self.get_user_count()
+
+
+class VocabArrays(object):
+    """Read-only vocab loaded from the binary artifact of `save_vocab`.
+
+    Holds what training and evaluation need as (memory-mapped) arrays:
+    vocab ids 1..item_count are the items, followed by the special tokens
+    in `SPECIAL_TOKENS` order.
+    """
+
+    def __init__(self, meta, items, counts):
+        version = int(meta[0])
+        if version != VOCAB_FORMAT_VERSION:
+            raise ValueError('unsupported vocab format version: {}'.format(
+                version))
+        self.item_count = int(meta[1])
+        self.user_count = int(meta[2])
+        num_special = int(meta[3])
+        self.special_tokens = list(SPECIAL_TOKENS[:num_special])
+        self.special_ids = dict(
+            zip(self.special_tokens, meta[4:4 + num_special].tolist()))
+        self.items = items
+        self.counts = counts
+
+        self.item_to_id = np.full(
+            int(items.max()) + 1 if len(items) else 0, -1, dtype=np.int32)
+        self.item_to_id[items] = np.arange(1, len(items) + 1)
+        self.id_to_item = np.full(
+            self.item_count + num_special + 1, -1, dtype=np.int64)
+        self.id_to_item[1:len(items) + 1] = items
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        return cls(
+            np.load(prefix + '.meta.npy'),
+            np.load(prefix + '.items.npy', mmap_mode=mmap_mode),
+            np.load(prefix + '.counts.npy', mmap_mode=mmap_mode))
+
+    def convert_items_to_ids(self, items, pad_item=None):
+        return lookup_item_ids(self.item_to_id, items, pad_item)
+
+    def convert_ids_to_items(self, ids):
+        return self.id_to_item[np.asarray(ids, dtype=np.int64)]
+
+    def get_item_ids(self):
+        return np.arange(1, self.item_count + 1, dtype=np.int64)
+
+    def get_item_counts(self):
+        return self.counts
+
+    def get_special_token_id(self, token):
+        return self.special_ids[token]
+
+    def get_item_count(self):
+        return self.item_count
+
+    def get_user_count(self):
+        return self.user_count
+
+    def get_special_token_count(self):
+        return len(self.special_tokens)
+
+    def get_special_token(self):
+        return self.special_tokens
+
+    def get_vocab_size(self):
+        return self.item_count + len(self.special_tokens) + 1
+
+
+def save_vocab(vocab, prefix):
+    """Writes `vocab` as `<prefix>.meta.npy` (format version, item count,
+    user count, special token ids), `<prefix>.items.npy` (raw item id of
+    every vocab id) and `<prefix>.counts.npy` (item frequencies)."""
+    special_ids = [vocab.get_special_token_id(t) for t in SPECIAL_TOKENS]
+    meta = [VOCAB_FORMAT_VERSION, vocab.get_item_count(),
+            vocab.get_user_count(), len(special_ids)] + special_ids
+    np.save(prefix + '.meta.npy', np.asarray(meta, dtype=np.int64))
+    np.save(prefix + '.items.npy',
+            vocab.convert_ids_to_items(vocab.get_item_ids()))
+    np.save(prefix + '.counts.npy', vocab.get_item_counts())
+
+
+def load_vocab(filename, mmap_mode='r'):
+    """Loads the binary vocab artifact of `filename`, falling back to a
+    pickled `FreqVocab` written by older versions of gen_data.py."""
+    if os.path.exists(filename + '.meta.npy'):
+        return VocabArrays.load(filename, mmap_mode=mmap_mode)
+    with open(filename, 'rb') as input_file:
+        return pickle.load(input_file)